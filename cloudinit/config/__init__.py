@@ -19,9 +19,11 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from cloudinit.settings import (PER_INSTANCE, FREQUENCIES)
+from cloudinit.settings import (PER_INSTANCE, FREQUENCIES, RES_ALL,
+                                INPUT_BOOT)
 
 from cloudinit import log as logging
+from cloudinit import registry
 
 LOG = logging.getLogger(__name__)
 
@@ -44,6 +46,13 @@ def form_module_name(name):
     return canon_name
 
 
+def find_module(mod_name):
+    # Modules that ship with cloud-init are found using the registry,
+    # others are searched for at the top level and in this package
+    return registry.find_module('config', mod_name,
+                                ['', __name__], ['handle'])
+
+
 def fixup_module(mod, def_freq=PER_INSTANCE):
     if not hasattr(mod, 'frequency'):
         setattr(mod, 'frequency', def_freq)
@@ -55,4 +64,24 @@ def fixup_module(mod, def_freq=PER_INSTANCE):
         setattr(mod, 'distros', [])
     if not hasattr(mod, 'osfamilies'):
         setattr(mod, 'osfamilies', [])
+    if not hasattr(mod, 'reads') and not hasattr(mod, 'writes'):
+        setattr(mod, 'writes', [RES_ALL])
+    if not hasattr(mod, 'reads'):
+        setattr(mod, 'reads', [])
+    if not hasattr(mod, 'writes'):
+        setattr(mod, 'writes', [])
+    if not hasattr(mod, 'inputs'):
+        setattr(mod, 'inputs', [INPUT_BOOT])
     return mod
+
+
+def conflicts(mod_a, mod_b):
+    # Modules conflict (and must run in their configured order) if either
+    # one writes something the other one reads or writes.
+    a_writes = set(mod_a.writes)
+    b_writes = set(mod_b.writes)
+    if RES_ALL in a_writes or RES_ALL in b_writes:
+        return True
+    a_uses = a_writes | set(mod_a.reads)
+    b_uses = b_writes | set(mod_b.reads)
+    return bool(a_writes & b_uses) or bool(b_writes & a_uses)
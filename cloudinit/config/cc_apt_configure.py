@@ -223,7 +223,7 @@ def find_apt_mirror_info(cloud, cfg):
 
     search = cfg.get("apt_mirror_search", None)
     if not mirror and search:
-        mirror = util.search_for_mirror(search)
+        mirror = cloud.distro.search_for_mirror(search)
 
     if (not mirror and
         util.get_cfg_option_bool(cfg, "apt_mirror_search_dns", False)):
@@ -244,7 +244,7 @@ def find_apt_mirror_info(cloud, cfg):
         for post in doms:
             mirror_list.append(mirrorfmt % (post))
 
-        mirror = util.search_for_mirror(mirror_list)
+        mirror = cloud.distro.search_for_mirror(mirror_list)
 
     mirror_info = cloud.datasource.get_package_mirror_info()
 
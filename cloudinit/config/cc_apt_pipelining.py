@@ -16,11 +16,13 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from cloudinit.settings import PER_INSTANCE
+from cloudinit.settings import (PER_INSTANCE, RES_PACKAGES)
 from cloudinit import util
 
 frequency = PER_INSTANCE
 
+writes = [RES_PACKAGES]
+
 distros = ['ubuntu', 'debian']
 
 DEFAULT_FILE = "/etc/apt/apt.conf.d/90cloud-init-pipelining"
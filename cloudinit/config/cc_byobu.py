@@ -25,8 +25,14 @@ from cloudinit import distros as ds
 
 from cloudinit import util
 
+from cloudinit.settings import (RES_PACKAGES, RES_USERS)
+
 distros = ['ubuntu', 'debian']
 
+# Reconfiguring byobu (via debconf/dpkg) takes the package lock
+reads = [RES_USERS]
+writes = [RES_PACKAGES, 'byobu']
+
 
 def handle(name, cfg, cloud, log, args):
     if len(args) != 0:
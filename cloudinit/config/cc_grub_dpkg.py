@@ -22,8 +22,13 @@ import os
 
 from cloudinit import util
 
+from cloudinit.settings import RES_PACKAGES
+
 distros = ['ubuntu', 'debian']
 
+# Changing the debconf selections takes the package lock
+writes = [RES_PACKAGES]
+
 
 def handle(_name, cfg, _cloud, log, _args):
     idevs = None
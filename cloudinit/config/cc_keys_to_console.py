@@ -20,11 +20,14 @@
 
 import os
 
-from cloudinit.settings import PER_INSTANCE
+from cloudinit.settings import (PER_INSTANCE, RES_CONSOLE, RES_SSH)
 from cloudinit import util
 
 frequency = PER_INSTANCE
 
+reads = [RES_SSH]
+writes = [RES_CONSOLE]
+
 # This is a tool that cloud init provides
 HELPER_TOOL = '/usr/libexec/cloud-init/write-ssh-key-fingerprints'
 
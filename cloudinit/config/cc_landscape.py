@@ -29,10 +29,12 @@ from configobj import ConfigObj
 from cloudinit import type_utils
 from cloudinit import util
 
-from cloudinit.settings import PER_INSTANCE
+from cloudinit.settings import (PER_INSTANCE, RES_PACKAGES)
 
 frequency = PER_INSTANCE
 
+writes = [RES_PACKAGES, 'landscape']
+
 LSC_CLIENT_CFG_FILE = "/etc/landscape/client.conf"
 LS_DEFAULT_FILE = "/etc/default/landscape-client"
 
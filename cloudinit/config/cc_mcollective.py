@@ -29,6 +29,10 @@ from configobj import ConfigObj
 
 from cloudinit import util
 
+from cloudinit.settings import RES_PACKAGES
+
+writes = [RES_PACKAGES, 'mcollective']
+
 PUBCERT_FILE = "/etc/mcollective/ssl/server-public.pem"
 PRICERT_FILE = "/etc/mcollective/ssl/server-private.pem"
 SERVER_CFG = '/etc/mcollective/server.cfg'
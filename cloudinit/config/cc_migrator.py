@@ -26,10 +26,14 @@ from cloudinit import helpers
 from cloudinit import util
 
 from cloudinit.settings import PER_ALWAYS, PER_INSTANCE, PER_ONCE, FREQUENCIES
+from cloudinit.settings import INPUT_CONFIG
 from cloudinit.config.cc_scripts_user import SCRIPT_SUBDIR
 
 
 frequency = PER_ALWAYS
+
+# Nothing new needs migrating unless the config (or cloud-init) changed
+inputs = [INPUT_CONFIG]
 LEGACY_SEM_MAP = {
     'apt-update-upgrade': [
         'config-apt-configure',
@@ -189,6 +193,21 @@ def _migrate_user_scripts(cloud, log):
         log.warning("Migrated script %s to %s", p, new_path)
 
 
+def _migrate_to_journal(cloud, log):
+    """Records the semaphore files in the journals (when those are used)."""
+    backend = cloud.cfg.get('semaphore_backend')
+    if backend != helpers.SEM_BACKEND_JOURNAL:
+        return
+    for sem_path in (cloud.paths.get_ipath('sem'),
+                     cloud.paths.get_cpath('sem')):
+        if not sem_path or not os.path.isdir(sem_path):
+            continue
+        found = helpers.JournalSemaphores(sem_path).import_files()
+        if found:
+            log.warning("Migrated %s semaphores in %s to its journal",
+                        len(found), sem_path)
+
+
 def handle(name, cfg, cloud, log, _args):
     do_migrate = util.get_cfg_option_str(cfg, "migrate", True)
     if not util.translate_bool(do_migrate):
@@ -198,3 +217,4 @@ def handle(name, cfg, cloud, log, _args):
     _migrate_legacy_per_instance(cloud, log)
     _migrate_legacy_sems(cloud, log)
     _migrate_user_scripts(cloud, log)
+    _migrate_to_journal(cloud, log)
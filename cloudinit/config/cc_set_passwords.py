@@ -30,8 +30,13 @@ from cloudinit import distros as ds
 from cloudinit import ssh_util
 from cloudinit import util
 
+from cloudinit.settings import (RES_SSH, RES_USERS)
+
 from string import letters, digits  # pylint: disable=W0402
 
+# Passwords are changed and sshd's password authentication may be adjusted
+writes = [RES_USERS, RES_SSH]
+
 # We are removing certain 'painful' letters/numbers
 PW_SET = (letters.translate(None, 'loLOI') +
           digits.translate(None, '01'))
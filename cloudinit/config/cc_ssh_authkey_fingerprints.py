@@ -29,6 +29,11 @@ from cloudinit import distros as ds
 from cloudinit import ssh_util
 from cloudinit import util
 
+from cloudinit.settings import (RES_CONSOLE, RES_SSH, RES_USERS)
+
+reads = [RES_USERS, RES_SSH]
+writes = [RES_CONSOLE]
+
 
 def _split_hash(bin_hash):
     split_up = []
@@ -26,10 +26,15 @@ from cloudinit import distros as ds
 from cloudinit import util
 import pwd
 
+from cloudinit.settings import (RES_NETWORK, RES_SSH, RES_USERS)
+
 # The ssh-import-id only seems to exist on ubuntu (for now)
 # https://launchpad.net/ssh-import-id
 distros = ['ubuntu']
 
+reads = [RES_USERS, RES_NETWORK]
+writes = [RES_SSH]
+
 
 def handle(_name, cfg, cloud, log, args):
 
@@ -21,10 +21,14 @@
 from cloudinit import templater
 from cloudinit import util
 
-from cloudinit.settings import PER_ALWAYS
+from cloudinit.settings import PER_ALWAYS, INPUT_CONFIG, INPUT_METADATA
 
 frequency = PER_ALWAYS
 
+# The hostname comes from the config or the metadata, /etc/hosts is rewritten
+# (when managed) if it was changed by something else
+inputs = [INPUT_CONFIG, INPUT_METADATA, '/etc/hosts']
+
 
 def handle(name, cfg, cloud, log, _args):
     manage_hosts = util.get_cfg_option_str(cfg, "manage_etc_hosts", False)
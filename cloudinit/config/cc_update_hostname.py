@@ -20,11 +20,14 @@
 
 import os
 
-from cloudinit.settings import PER_ALWAYS
+from cloudinit.settings import PER_ALWAYS, INPUT_CONFIG, INPUT_METADATA
 from cloudinit import util
 
 frequency = PER_ALWAYS
 
+# The hostname comes from the config or the metadata
+inputs = [INPUT_CONFIG, INPUT_METADATA]
+
 
 def handle(name, cfg, cloud, log, _args):
     if util.get_cfg_option_bool(cfg, "preserve_hostname", False):
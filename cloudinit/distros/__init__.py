@@ -32,6 +32,7 @@ import re
 
 from cloudinit import importer
 from cloudinit import log as logging
+from cloudinit import registry
 from cloudinit import ssh_util
 from cloudinit import type_utils
 from cloudinit import util
@@ -122,7 +123,28 @@ class Distro(object):
         arch_info = self._get_arch_package_mirror_info(arch)
         return _get_package_mirror_info(services_domain=services_domain,
                                         availability_zone=availability_zone,
-                                        region=region, mirror_info=arch_info)
+                                        region=region, mirror_info=arch_info,
+                                        mirror_filter=self.search_for_mirror)
+
+    def search_for_mirror(self, candidates):
+        # Searches the candidates as the 'mirror_search' option says to
+        # (keeping what was found for this instance, so that later stages
+        # and modules do not probe the same candidates again)
+        search_cfg = self.get_option('mirror_search') or {}
+        cache_fn = None
+        if self._paths is not None:
+            cache_fn = self._paths.get_ipath_cur('mirror_search')
+        deadline = search_cfg.get('deadline')
+        if deadline is not None:
+            try:
+                deadline = float(deadline)
+            except (TypeError, ValueError):
+                LOG.warn("Invalid mirror search deadline %r", deadline)
+                deadline = None
+        return util.search_for_mirror(candidates,
+                                      probe=search_cfg.get('probe'),
+                                      deadline=deadline,
+                                      cache_fn=cache_fn)
 
     def apply_network(self, settings, bring_up=True):
         # Write it out
@@ -841,7 +863,7 @@ def extract_default(users, default_name=None, default_config=None):
 
 
 def fetch(name):
-    locs = importer.find_module(name,
+    locs = registry.find_module('distros', name,
                                 ['', __name__],
                                 ['Distro'])
     if not locs:
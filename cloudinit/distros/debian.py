@@ -51,7 +51,7 @@ class Distro(distros.Distro):
         # This will be used to restrict certain
         # calls from repeatly happening (when they
         # should only happen say once per instance...)
-        self._runner = helpers.Runners(paths)
+        self._runner = helpers.Runners(paths, cfg.get('semaphore_backend'))
         self.osfamily = 'debian'
 
     def apply_locale(self, locale, out_fn=None):
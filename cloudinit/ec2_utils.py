@@ -18,55 +18,198 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import boto.utils as boto_utils
-
-# Versions of boto >= 2.6.0 (and possibly 2.5.2)
-# try to lazily load the metadata backing, which
-# doesn't work so well in cloud-init especially
-# since the metadata is serialized and actions are
-# performed where the metadata server may be blocked
-# (thus the datasource will start failing) resulting
-# in url exceptions when fields that do exist (or
-# would have existed) do not exist due to the blocking
-# that occurred.
-
-# TODO(harlowja): https://github.com/boto/boto/issues/1401
-# When boto finally moves to using requests, we should be able
-# to provide it ssl details, it does not yet, so we can't provide them...
-
-
-def _unlazy_dict(mp):
-    if not isinstance(mp, (dict,)):
-        return mp
-    # Walk over the keys/values which
-    # forces boto to unlazy itself and
-    # has no effect on dictionaries that
-    # already have there items.
-    for (_k, v) in mp.items():
-        _unlazy_dict(v)
-    return mp
+import json
+
+from collections import deque
+
+from cloudinit import log as logging
+from cloudinit import url_helper
+from cloudinit import workers
+
+LOG = logging.getLogger(__name__)
+
+# The metadata tree is crawled breadth-first, each listing (and each value
+# in it) is read by one of at most this many threads, so a tree with many
+# block device mappings, public keys or network interfaces is read using
+# a few round trips instead of one request after another.
+MAX_WORKERS = 8
+
+# How many times a request is retried (on connection errors)
+DEF_RETRIES = 5
+
+
+def _leaf_value(contents):
+    # Like boto, values that look like json are decoded and values that
+    # span lines are split into a list of them
+    if contents and contents[0] == '{':
+        try:
+            return json.loads(contents)
+        except ValueError:
+            pass
+    if contents.find("\n") > 0:
+        return contents.split("\n")
+    return contents
+
+
+class MetadataCrawler(object):
+    """
+    Reads the user-data, meta-data and the identity document of an instance
+    (in the shapes boto returns them in) using a bounded pool of threads.
+    """
+
+    def __init__(self, api_version='latest',
+                 metadata_address='http://169.254.169.254',
+                 max_workers=MAX_WORKERS, timeout=None, retries=DEF_RETRIES,
+                 ssl_details=None, retry_policy=None):
+        self.base_url = "%s/%s/" % (metadata_address.rstrip("/"),
+                                    api_version)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.ssl_details = ssl_details
+        self.retry_policy = retry_policy
+
+    def _read(self, url):
+        resp = url_helper.readurl(url, timeout=self.timeout,
+                                  retries=self.retries,
+                                  ssl_details=self.ssl_details,
+                                  check_status=False,
+                                  retry_policy=self.retry_policy)
+        if resp.code == 404:
+            # Not there, which boto reads as empty
+            return ''
+        if not resp.ok():
+            raise url_helper.UrlError(ValueError("Bad status code [%s]"
+                                                 % (resp.code)),
+                                      code=resp.code, headers=resp.headers)
+        return resp.contents
+
+    def _read_optional(self, url):
+        # Like boto, what can not be read (after the retries) below the top
+        # of the meta-data (or of the identity) is left empty instead of
+        # failing the whole crawl
+        try:
+            return self._read(url)
+        except url_helper.UrlError as e:
+            LOG.warn("Failed reading %s, leaving it empty: %s", url, e)
+            return ''
+
+    def _walk(self, pool, submit, url, tree, required=False):
+        # Reads a listing of the tree (leaves are read concurrently, sub
+        # trees are listed once the listings before them were)
+        if required:
+            contents = pool.submit(self._read, url)
+        else:
+            contents = pool.submit(self._read_optional, url)
+
+        def on_listed(listing):
+            for field in listing.split("\n"):
+                field = field.strip()
+                if not field:
+                    continue
+                if field.endswith("/"):
+                    key = field[0:-1]
+                    tree[key] = {}
+                    submit(self._walk, url + field, tree[key])
+                    continue
+                pos = field.find("=")
+                if pos > 0:
+                    # Public keys are listed as '0=name', the key itself
+                    # is found under '0/openssh-key'
+                    key = field[pos + 1:]
+                    resource = field[0:pos] + "/openssh-key"
+                else:
+                    key = resource = field
+                tree[key] = None
+                submit(self._read_leaf, url + resource, tree, key)
+
+        return (contents, on_listed)
+
+    def _read_leaf(self, pool, _submit, url, tree, key):
+
+        def on_read(contents):
+            tree[key] = _leaf_value(contents)
+
+        return (pool.submit(self._read_optional, url), on_read)
+
+    def _read_identity(self, pool, submit, url, identity):
+
+        def on_read(field, contents):
+            # Only the document is decoded (the signatures are kept as is)
+            if contents and contents[0] == '{':
+                contents = json.loads(contents)
+            identity[field] = contents
+
+        def read_field(pool, _submit, field):
+            return (pool.submit(self._read_optional, url + field),
+                    lambda contents: on_read(field, contents))
+
+        def on_listed(listing):
+            for field in listing.split("\n"):
+                field = field.strip()
+                if field:
+                    submit(read_field, field)
+
+        return (pool.submit(self._read_optional, url), on_listed)
+
+    def _read_userdata(self, pool, _submit, url, result):
+
+        def on_read(contents):
+            result['user-data'] = contents or ''
+
+        return (pool.submit(self._read, url), on_read)
+
+    def crawl(self, userdata=True, metadata=True, identity=True):
+        """
+        Reads what was asked for at once, returning a dictionary with the
+        'user-data' (a string), 'meta-data' and 'identity' (dictionaries).
+        """
+        result = {}
+        started = deque()
+        pool = workers.Pool(self.max_workers, name='ec2-metadata')
+
+        def submit(reader, *args):
+            started.append(reader(pool, submit, *args))
+
+        try:
+            if userdata:
+                submit(self._read_userdata, self.base_url + "user-data",
+                       result)
+            if metadata:
+                result['meta-data'] = {}
+                submit(self._walk, self.base_url + "meta-data/",
+                       result['meta-data'], True)
+            if identity:
+                result['identity'] = {}
+                submit(self._read_identity,
+                       self.base_url + "dynamic/instance-identity/",
+                       result['identity'])
+            # Handled in the order started, which is breadth-first
+            while started:
+                (task, on_done) = started.popleft()
+                on_done(task.result())
+        finally:
+            pool.shutdown(wait=False, cancel_pending=True)
+        return result
+
+
+def get_instance_data(api_version, metadata_address, identity=True,
+                      **kwargs):
+    """Reads the user-data, meta-data and (optionally) identity at once."""
+    crawler = MetadataCrawler(api_version, metadata_address, **kwargs)
+    return crawler.crawl(identity=identity)
 
 
 def get_instance_userdata(api_version, metadata_address):
-    # Note: boto.utils.get_instance_metadata returns '' for empty string
-    # so the change from non-true to '' is not specifically necessary, but
-    # this way cloud-init will get consistent behavior even if boto changed
-    # in the future to return a None on "no user-data provided".
-    ud = boto_utils.get_instance_userdata(api_version, None, metadata_address)
-    if not ud:
-        ud = ''
-    return ud
+    crawler = MetadataCrawler(api_version, metadata_address)
+    return crawler.crawl(metadata=False, identity=False)['user-data']
 
 
 def get_instance_metadata(api_version, metadata_address):
-    metadata = boto_utils.get_instance_metadata(api_version, metadata_address)
-    if not isinstance(metadata, (dict,)):
-        metadata = {}
-    return _unlazy_dict(metadata)
+    crawler = MetadataCrawler(api_version, metadata_address)
+    return crawler.crawl(userdata=False, identity=False)['meta-data']
 
 
 def get_instance_identity(api_version, metadata_address):
-    identity = boto_utils.get_instance_identity(api_version, metadata_address)
-    if not isinstance(identity, (dict,)):
-        identity = {}
-    return identity
+    crawler = MetadataCrawler(api_version, metadata_address)
+    return crawler.crawl(userdata=False, metadata=False)['identity']
@@ -73,3 +73,15 @@ class Filter(object):
         if self.wanted_idx is None:
             return root_message
         return self._do_filter(root_message)
+
+    def apply_parts(self, parts):
+        # Like apply, but for (and yielding) handlers.Part objects
+        discarded = 0
+        for part in parts:
+            if self.wanted_idx is None or self._select(part.headers):
+                yield part
+            else:
+                discarded += 1
+        if discarded:
+            LOG.debug(("Discarded %s parts which do not match launch"
+                       " index %s"), discarded, self.wanted_idx)
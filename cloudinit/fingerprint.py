@@ -0,0 +1,207 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2014 Amazon.com, Inc. or its affiliates.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+
+from cloudinit import log as logging
+from cloudinit import util
+from cloudinit import version
+
+from cloudinit.settings import (INPUT_BOOT, INPUT_CONFIG, INPUT_METADATA)
+
+LOG = logging.getLogger(__name__)
+
+# A boot fingerprint identifies everything that decides what a boot does
+# (the instance, its user-data, the merged config and the version of
+# cloud-init). Each boot records its fingerprint along with the per-always
+# modules that ran (and a digest of what each of those depends on), once a
+# boot has finished without failures the next boot with the same
+# fingerprint only has to run the per-always modules whose inputs changed.
+#
+# Bump this when the layout of the boot record changes
+RECORD_VERSION = 1
+
+
+def digest(obj):
+    blob = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha1(blob).hexdigest()
+
+
+def compute(datasource, cfg):
+    userdata_raw = datasource.get_userdata_raw() or ''
+    return digest({
+        'cloudinit': version.version_string(),
+        'instance_id': str(datasource.get_instance_id()),
+        'userdata': hashlib.sha1(str(userdata_raw)).hexdigest(),
+        'config': digest(cfg),
+    })
+
+
+def _file_sig(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+
+class Inputs(object):
+    """
+    Digests what config modules depend on (each input is only looked at
+    when a module that depends on it is first asked about).
+    """
+
+    def __init__(self, datasource, cfg):
+        self._getters = {
+            INPUT_CONFIG: lambda: cfg,
+            INPUT_METADATA: lambda: datasource.metadata,
+        }
+        self._values = {}
+
+    def _value(self, name):
+        if name not in self._values:
+            if name in self._getters:
+                self._values[name] = digest(self._getters[name]())
+            elif name.startswith("/"):
+                self._values[name] = _file_sig(name)
+            else:
+                # Not known, so assume it changed
+                self._values[name] = None
+        return self._values[name]
+
+    def changes_every_boot(self, inputs):
+        if INPUT_BOOT in inputs:
+            return True
+        return [i for i in inputs if self._value(i) is None] != []
+
+    def digest(self, inputs):
+        if self.changes_every_boot(inputs):
+            return None
+        return digest([(i, self._value(i)) for i in sorted(inputs)])
+
+
+class BootRecord(object):
+    """What the modules run for a given boot fingerprint did."""
+
+    def __init__(self, fn, fingerprint):
+        self.fn = fn
+        self.fingerprint = fingerprint
+        self.complete = False
+        self.failed = False
+        self.sections = {}
+
+    def to_dict(self):
+        return {
+            'version': RECORD_VERSION,
+            'fingerprint': self.fingerprint,
+            'complete': self.complete,
+            'failed': self.failed,
+            'sections': self.sections,
+        }
+
+    def save(self):
+        try:
+            util.write_file(self.fn, json.dumps(self.to_dict(), indent=1,
+                                                sort_keys=True), mode=0600)
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed writing boot record to %s", self.fn)
+            return False
+        return True
+
+    def matches(self, section_name=None):
+        """
+        Whether a previous boot with the same fingerprint finished (and ran
+        the given section) without failures.
+        """
+        if not self.complete or self.failed:
+            return False
+        if section_name is not None and section_name not in self.sections:
+            return False
+        return True
+
+    def changed_modules(self, section_name, inputs):
+        """
+        Returns the names of the per-always modules (that ran in the given
+        section) whose inputs changed since they last ran.
+        """
+        changed = []
+        for entry in self.sections.get(section_name, []):
+            mod_digest = inputs.digest(entry['inputs'])
+            if mod_digest is None or mod_digest != entry['digest']:
+                changed.append(entry['name'])
+        return changed
+
+    def record_section(self, section_name, entries, failed):
+        """
+        Records the per-always modules that ran in the given section, as
+        (name, inputs, inputs digest) entries.
+        """
+        old_entries = self.sections.get(section_name, [])
+        by_name = dict([(e['name'], e) for e in old_entries])
+        for (name, mod_inputs, mod_digest) in entries:
+            by_name[name] = {
+                'name': name,
+                'inputs': list(mod_inputs),
+                'digest': mod_digest,
+            }
+        self.sections[section_name] = [by_name[n]
+                                       for n in sorted(by_name.keys())]
+        if failed:
+            self.failed = True
+            self.complete = False
+        self.save()
+
+    def finish(self):
+        """Marks the boot as having finished (if nothing failed)."""
+        if self.failed:
+            return False
+        self.complete = True
+        return self.save()
+
+
+def load(fn, fingerprint):
+    """
+    Loads the record of a previous boot with the given fingerprint, or
+    starts a new (and incomplete) record if the last boot had a different
+    fingerprint (or there is no usable record of it).
+    """
+    record = BootRecord(fn, fingerprint)
+    try:
+        contents = util.load_file(fn, quiet=True)
+    except (IOError, OSError):
+        contents = ''
+    if not contents:
+        return record
+    try:
+        loaded = json.loads(contents)
+        if (loaded['version'] != RECORD_VERSION or
+            loaded['fingerprint'] != fingerprint):
+            return record
+        record.complete = bool(loaded['complete'])
+        record.failed = bool(loaded['failed'])
+        record.sections = dict(loaded['sections'])
+        for entries in record.sections.values():
+            for entry in entries:
+                for key in ('name', 'inputs', 'digest'):
+                    if key not in entry:
+                        raise ValueError("Entry %r is missing %r"
+                                         % (entry, key))
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        LOG.warn("Ignoring unusable boot record %s: %s", fn, e)
+        return BootRecord(fn, fingerprint)
+    return record
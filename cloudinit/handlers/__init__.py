@@ -69,6 +69,34 @@ INCLUSION_SRCH = sorted(list(INCLUSION_TYPES_MAP.keys()),
                         key=(lambda e: 0 - len(e)))
 
 
+class Part(object):
+    """A (non-multipart) part of the user-data as handlers are given it."""
+
+    def __init__(self, ctype, filename, payload, headers):
+        self.ctype = ctype
+        self.filename = filename
+        self.payload = payload
+        self.headers = headers
+
+    def __repr__(self):
+        return "%s: [%s, %s]" % (type_utils.obj_name(self), self.ctype,
+                                 self.filename)
+
+    @classmethod
+    def from_message(cls, part, partnum):
+        ctype = part.get_content_type()
+        if ctype is None:
+            ctype = OCTET_TYPE
+
+        filename = part.get_filename()
+        if not filename:
+            filename = PART_FN_TPL % (partnum)
+
+        headers = dict(part)
+        headers['Content-Type'] = ctype
+        return cls(ctype, filename, part.get_payload(decode=True), headers)
+
+
 class Handler(object):
     __metaclass__ = abc.ABCMeta
 
@@ -209,28 +237,28 @@ def walker_callback(data, filename, payload, headers):
         LOG.debug("Empty payload of type %s", content_type)
 
 
-# Callback is a function that will be called with
-# (data, content_type, filename, payload)
-def walk(msg, callback, data):
-    partnum = 0
+# Yields the parts of a message (numbered from partnum) as Part objects
+def message_parts(msg, partnum=0):
     for part in msg.walk():
         # multipart/* are just containers
         if part.get_content_maintype() == 'multipart':
             continue
+        yield Part.from_message(part, partnum)
+        partnum = partnum + 1
 
-        ctype = part.get_content_type()
-        if ctype is None:
-            ctype = OCTET_TYPE
 
-        filename = part.get_filename()
-        if not filename:
-            filename = PART_FN_TPL % (partnum)
+# Callback is a function that will be called with
+# (data, filename, payload, headers)
+def walk(msg, callback, data):
+    walk_parts(message_parts(msg), callback, data)
 
-        headers = dict(part)
-        LOG.debug(headers)
-        headers['Content-Type'] = ctype
-        callback(data, filename, part.get_payload(decode=True), headers)
-        partnum = partnum + 1
+
+# Like walk, but for parts (Part objects) that are handled as they are
+# yielded (so only the current one needs to be kept)
+def walk_parts(parts, callback, data):
+    for part in parts:
+        LOG.debug(part.headers)
+        callback(data, part.filename, part.payload, part.headers)
 
 
 def fixup_handler(mod, def_freq=PER_INSTANCE):
@@ -22,9 +22,14 @@
 
 from time import time
 
+import atexit
 import contextlib
+import copy
+import errno
+import fcntl
 import io
 import os
+import threading
 
 from ConfigParser import (NoSectionError, NoOptionError, RawConfigParser)
 
@@ -32,11 +37,23 @@ from cloudinit.settings import (PER_INSTANCE, PER_ALWAYS, PER_ONCE,
                                 CFG_ENV_NAME)
 
 from cloudinit import log as logging
+from cloudinit import timing
 from cloudinit import type_utils
 from cloudinit import util
 
 LOG = logging.getLogger(__name__)
 
+# The semaphore backends (see 'semaphore_backend')
+SEM_BACKEND_FILE = 'file'
+SEM_BACKEND_JOURNAL = 'journal'
+
+# Journals are fsynced after this many records were appended (and when the
+# process exits or sync_semaphores is called)
+SEM_JOURNAL_SYNC_BATCH = 16
+
+# Values of these types can be handed out without copying
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))
+
 
 class LockFailure(Exception):
     pass
@@ -153,9 +170,280 @@ class FileSemaphores(object):
             return os.path.join(sem_path, "%s.%s" % (name, freq))
 
 
+class JournalLock(object):
+    def __init__(self, fn, key):
+        self.fn = fn
+        self.key = key
+
+    def __str__(self):
+        return "<%s using %r in journal %r>" % (type_utils.obj_name(self),
+                                               self.key, self.fn)
+
+
+class SemaphoreJournal(object):
+    """
+    The markers of one semaphore scope, kept as '+' (ran) and '-' (cleared)
+    records in a single append-only file that is read once per process
+    (and then only the records other processes appended are read).
+    """
+
+    def __init__(self, fn, sem_path):
+        self.fn = fn
+        self.sem_path = sem_path
+        self.markers = set()
+        self._seen = set()
+        self._offset = 0
+        self._partial = 0
+        self._loaded = False
+        self._pending = 0
+        self._lock = threading.RLock()
+
+    def _replay(self, data):
+        # Only complete lines are used (a partial last line is what a crash
+        # in the middle of an append leaves behind)
+        used = data.rfind("\n") + 1
+        for line in data[0:used].splitlines():
+            fields = line.split()
+            if len(fields) != 4 or fields[0] not in ('+', '-'):
+                continue
+            (op, key) = fields[0:2]
+            self._seen.add(key)
+            if op == '+':
+                self.markers.add(key)
+            else:
+                self.markers.discard(key)
+        self._offset += used
+        self._partial = len(data) - used
+
+    def _read_new(self, fd):
+        os.lseek(fd, self._offset, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self._replay("".join(chunks))
+
+    def _import_files(self):
+        # Semaphore files (written before the journal existed, or by runners
+        # using the file backend) count as ran unless the journal says
+        # otherwise
+        found = []
+        try:
+            names = os.listdir(self.sem_path)
+        except OSError:
+            return found
+        for name in sorted(names):
+            if name in self._seen:
+                continue
+            if os.path.isfile(os.path.join(self.sem_path, name)):
+                self.markers.add(name)
+                found.append(name)
+        return found
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                fd = os.open(self.fn, os.O_RDONLY)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                fd = None
+            if fd is not None:
+                try:
+                    self._read_new(fd)
+                finally:
+                    os.close(fd)
+            self._import_files()
+            self._loaded = True
+
+    def has(self, key):
+        self.load()
+        return key in self.markers
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            self.load()
+            util.ensure_dir(os.path.dirname(self.fn))
+            fd = os.open(self.fn, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                # This is a real lock, so other processes appending to the
+                # same journal wait for us (and we see what they appended)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._read_new(fd)
+                yield fd
+            finally:
+                os.close(fd)
+
+    def _append(self, fd, records):
+        blob = "".join(["%s %s %s %s\n" % (op, key, os.getpid(), time())
+                        for (op, key) in records])
+        if self._partial:
+            # Never append to what is left of an interrupted append
+            blob = "\n%s" % (blob)
+        os.write(fd, blob)
+        self._read_new(fd)
+        self._pending += len(records)
+        if self._pending >= SEM_JOURNAL_SYNC_BATCH:
+            self._sync(fd)
+
+    def _sync(self, fd):
+        os.fsync(fd)
+        self._pending = 0
+
+    def acquire(self, key):
+        """Marks the given key as ran, unless it already was."""
+        with self._locked() as fd:
+            if key in self.markers:
+                return False
+            self._append(fd, [('+', key)])
+            return True
+
+    def release(self, key):
+        with self._locked() as fd:
+            if key not in self.markers and key not in self._seen:
+                return
+            self._append(fd, [('-', key)])
+
+    def import_files(self):
+        """Records the semaphore files found (that are not yet recorded)."""
+        with self._locked() as fd:
+            found = self._import_files()
+            if found:
+                self._append(fd, [('+', key) for key in found])
+                self._sync(fd)
+            return found
+
+    def sync(self):
+        with self._lock:
+            if not self._pending:
+                return
+            try:
+                fd = os.open(self.fn, os.O_RDONLY)
+            except OSError:
+                util.logexc(LOG, "Failed opening semaphore journal %s",
+                            self.fn)
+                return
+            try:
+                self._sync(fd)
+            finally:
+                os.close(fd)
+
+    def forget(self):
+        with self._lock:
+            self.markers = set()
+            self._seen = set()
+            self._offset = 0
+            self._partial = 0
+            self._pending = 0
+            self._loaded = False
+
+
+# The journals used by this process (so each is only read once)
+_SEM_JOURNALS = {}
+_SEM_JOURNALS_LOCK = threading.Lock()
+
+
+def _get_sem_journal(sem_path):
+    with _SEM_JOURNALS_LOCK:
+        if not _SEM_JOURNALS:
+            atexit.register(sync_semaphores)
+        if sem_path not in _SEM_JOURNALS:
+            _SEM_JOURNALS[sem_path] = SemaphoreJournal("%s.journal"
+                                                       % (sem_path), sem_path)
+        return _SEM_JOURNALS[sem_path]
+
+
+def sync_semaphores():
+    """Makes sure the semaphores recorded in any journal are on disk."""
+    with _SEM_JOURNALS_LOCK:
+        journals = list(_SEM_JOURNALS.values())
+    for journal in journals:
+        journal.sync()
+
+
+class JournalSemaphores(FileSemaphores):
+    """
+    Semaphores kept in a journal next to the semaphore directory (for
+    example /var/lib/cloud/sem.journal), acquiring one is atomic (even
+    across processes) and does not need a file for each semaphore.
+    """
+
+    def __init__(self, sem_path):
+        FileSemaphores.__init__(self, sem_path)
+        self.journal = _get_sem_journal(sem_path)
+
+    def clear(self, name, freq):
+        name = canon_sem_name(name)
+        try:
+            self.journal.release(self._get_key(name, freq))
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed clearing semaphore %s in %s", name,
+                        self.journal.fn)
+            return False
+        return True
+
+    def clear_all(self):
+        FileSemaphores.clear_all(self)
+        try:
+            util.del_file(self.journal.fn)
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed deleting semaphore journal %s",
+                        self.journal.fn)
+        self.journal.forget()
+
+    def import_files(self):
+        return self.journal.import_files()
+
+    def _acquire(self, name, freq):
+        key = self._get_key(name, freq)
+        try:
+            if not self.journal.acquire(key):
+                return None
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed recording semaphore %s in %s", name,
+                        self.journal.fn)
+            return None
+        return JournalLock(self.journal.fn, key)
+
+    def has_run(self, name, freq):
+        if not freq or freq == PER_ALWAYS:
+            return False
+
+        cname = canon_sem_name(name)
+        if self.journal.has(self._get_key(cname, freq)):
+            return True
+
+        if cname != name and self.journal.has(self._get_key(name, freq)):
+            LOG.warn("%s has run without canonicalized name [%s].\n"
+                "likely the migrator has not yet run. It will run next boot.\n"
+                "run manually with: cloud-init single --name=migrator"
+                % (name, cname))
+            return True
+
+        return False
+
+    def _get_key(self, name, freq):
+        return os.path.basename(self._get_path(name, freq))
+
+
+def get_semaphores(sem_path, backend=None):
+    if backend == SEM_BACKEND_JOURNAL:
+        return JournalSemaphores(sem_path)
+    if backend and backend != SEM_BACKEND_FILE:
+        LOG.warn("Unknown semaphore backend %r, using %r", backend,
+                 SEM_BACKEND_FILE)
+    return FileSemaphores(sem_path)
+
+
 class Runners(object):
-    def __init__(self, paths):
+    def __init__(self, paths, backend=None):
         self.paths = paths
+        self.backend = backend
         self.sems = {}
 
     def _get_sem(self, freq):
@@ -174,7 +462,7 @@ class Runners(object):
         if not sem_path:
             return None
         if sem_path not in self.sems:
-            self.sems[sem_path] = FileSemaphores(sem_path)
+            self.sems[sem_path] = get_semaphores(sem_path, self.backend)
         return self.sems[sem_path]
 
     def run(self, name, functor, args, freq=None, clear_on_fail=False):
@@ -183,19 +471,21 @@ class Runners(object):
             sem = DummySemaphores()
         if not args:
             args = []
-        if sem.has_run(name, freq):
-            LOG.debug("%s already ran (freq=%s)", name, freq)
-            return (False, None)
-        with sem.lock(name, freq, clear_on_fail) as lk:
-            if not lk:
-                raise LockFailure("Failed to acquire lock for %s" % name)
-            else:
-                LOG.debug("Running %s using lock (%s)", name, lk)
-                if isinstance(args, (dict)):
-                    results = functor(**args)
+        with timing.timed(name) as timer:
+            if sem.has_run(name, freq):
+                LOG.debug("%s already ran (freq=%s)", name, freq)
+                timer.result = timing.RESULT_SKIPPED
+                return (False, None)
+            with sem.lock(name, freq, clear_on_fail) as lk:
+                if not lk:
+                    raise LockFailure("Failed to acquire lock for %s" % name)
                 else:
-                    results = functor(*args)
-                return (True, results)
+                    LOG.debug("Running %s using lock (%s)", name, lk)
+                    if isinstance(args, (dict)):
+                        results = functor(**args)
+                    else:
+                        results = functor(*args)
+                    return (True, results)
 
 
 class ConfigMerger(object):
@@ -277,6 +567,104 @@ class ConfigMerger(object):
         return self._cfg
 
 
+# A copy-on-write view of a (master) configuration dictionary that
+# can be handed out instead of a full deep copy of that configuration.
+#
+# The view starts as a shallow copy of the top level of the master, each
+# top level branch is then only (deep) copied the first time it is looked
+# up through the view, so modules that only look at a few keys only pay
+# for copying those keys (and modules that alter what they are given can
+# never affect the master configuration or other modules).
+#
+# Note: the fast paths that python uses for dict(view), {}.update(view)
+# and func(**view) bypass the view, those will share any branch that was
+# not yet looked up with the master, so do not alter those (or use
+# copy.deepcopy(view) which always returns a fully detached dictionary).
+class ConfigView(dict):
+    def __init__(self, source=None):
+        if source is None:
+            source = {}
+        dict.__init__(self, source)
+        # Keys whose values are now owned by this view
+        self._owned = set()
+
+    def _own(self, key):
+        value = dict.__getitem__(self, key)
+        if key not in self._owned:
+            if not isinstance(value, _IMMUTABLE_TYPES):
+                value = copy.deepcopy(value)
+                dict.__setitem__(self, key, value)
+            self._owned.add(key)
+        return value
+
+    def __getitem__(self, key):
+        return self._own(key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._owned.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._owned.discard(key)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self._own(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self._own(key)
+
+    def pop(self, key, *args):
+        if key not in self:
+            return dict.pop(self, key, *args)
+        value = self._own(key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(iter(self))
+        return (key, self.pop(key))
+
+    def update(self, *args, **kwargs):
+        for (k, v) in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    def iteritems(self):
+        for k in list(self.keys()):
+            yield (k, self._own(k))
+
+    def itervalues(self):
+        for (_k, v) in self.iteritems():
+            yield v
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        # Whatever this view has already copied (and possibly altered)
+        # is treated as a master by the new view (and copied on lookup).
+        return ConfigView(dict(self))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self.iteritems()), memo)
+
+    def __reduce__(self):
+        # Pickle (and friends) get a plain dictionary
+        return (dict, (dict(self.iteritems()),))
+
+
 class ContentHandlers(object):
 
     def __init__(self):
@@ -337,8 +725,12 @@ class Paths(object):
            "userdata_raw": "user-data.txt",
            "userdata": "user-data.txt.i",
            "obj_pkl": "obj.pkl",
+           "obj_cache": "obj.d",
+           "boot_timing": "boot-timing.jsonl",
+           "boot_fingerprint": "boot-fingerprint.json",
            "cloud_config": "cloud-config.txt",
            "data": "data",
+           "mirror_search": "mirror-search.json",
         }
         # Set when a datasource becomes active
         self.datasource = ds
@@ -365,7 +757,11 @@ class Paths(object):
     def _get_ipath(self, name=None):
         if not self.datasource:
             return None
-        iid = self.datasource.get_instance_id()
+        # Avoid loading the metadata of a datasource restored from
+        # the instance cache just to find out its instance id
+        iid = getattr(self.datasource, 'cached_instance_id', None)
+        if iid is None:
+            iid = self.datasource.get_instance_id()
         if iid is None:
             return None
         ipath = os.path.join(self.cloud_dir, 'instances', str(iid))
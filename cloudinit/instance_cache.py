@@ -0,0 +1,256 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2014 Amazon.com, Inc. or its affiliates.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle as pickle
+
+import json
+import os
+
+from cloudinit import importer
+from cloudinit import log as logging
+from cloudinit import sources
+from cloudinit import type_utils
+from cloudinit import util
+from cloudinit import version
+
+LOG = logging.getLogger(__name__)
+
+# The instance cache is a directory containing a small json header (which
+# says what instance and datasource class the cache is for) and a pickled
+# blob per large datasource attribute (which are only loaded when that
+# attribute is first used) + a blob with the rest of the datasource state.
+#
+# Bump this when the layout of the cache changes, caches written with a
+# different version are ignored (and the datasource is searched for again).
+SCHEMA_VERSION = 1
+
+HEADER_FN = 'header.json'
+STATE_BLOB = 'state'
+
+# Datasource attributes that are stored in their own (lazily loaded) blobs
+# and the types that the loaded values must have.
+LAZY_BLOBS = {
+    'metadata': (dict,),
+    'userdata_raw': (basestring,),
+    'userdata': (object,),
+}
+
+# Datasource attributes that are not cached since they are recreated (from
+# the current configuration) when the datasource is restored.
+NOT_CACHED = ['sys_cfg', 'distro', 'paths', 'ud_proc', 'ds_cfg', '_loaders',
+              'cached_instance_id']
+
+HEADER_TYPES = {
+    'schema': (int, long),
+    'cloudinit': (basestring,),
+    'instance_id': (basestring,),
+    'datasource': (basestring,),
+    'blobs': (dict,),
+}
+
+# Attributes a (legacy) pickled datasource must have to be used
+LEGACY_ATTRS = ['sys_cfg', 'distro', 'paths', 'metadata', 'userdata_raw']
+
+
+class InvalidCache(ValueError):
+    pass
+
+
+def _blob_fn(name):
+    return "%s.pkl" % (name)
+
+
+def validate_header(header):
+    if not isinstance(header, dict):
+        raise InvalidCache("Header is a %s and not a dict"
+                           % (type_utils.obj_name(header)))
+    for (key, types) in HEADER_TYPES.items():
+        if key not in header:
+            raise InvalidCache("Header is missing %r" % (key))
+        if not isinstance(header[key], types):
+            raise InvalidCache("Header %r is a %s" %
+                               (key, type_utils.obj_name(header[key])))
+    if header['schema'] != SCHEMA_VERSION:
+        raise InvalidCache("Header schema %s is not the supported schema %s"
+                           % (header['schema'], SCHEMA_VERSION))
+    for (name, fn) in header['blobs'].items():
+        if name != STATE_BLOB and name not in LAZY_BLOBS:
+            raise InvalidCache("Unknown blob %r" % (name))
+        if fn != _blob_fn(name):
+            raise InvalidCache("Blob %r has unexpected filename %r"
+                               % (name, fn))
+    if STATE_BLOB not in header['blobs']:
+        raise InvalidCache("Header is missing the %r blob" % (STATE_BLOB))
+    return header
+
+
+def read_header(cache_dir):
+    """
+    Returns the validated header of the cache in the given directory (or
+    None if there is no usable cache there).
+    """
+    header_fn = os.path.join(cache_dir, HEADER_FN)
+    try:
+        contents = util.load_file(header_fn, quiet=True)
+    except (IOError, OSError):
+        contents = ''
+    if not contents:
+        return None
+    try:
+        header = validate_header(json.loads(contents))
+        for fn in header['blobs'].values():
+            if not os.path.isfile(os.path.join(cache_dir, fn)):
+                raise InvalidCache("Blob %s is missing" % (fn))
+        return header
+    except (ValueError, TypeError) as e:
+        LOG.warn("Ignoring unusable instance cache header %s: %s",
+                 header_fn, e)
+        return None
+
+
+def _load_blob(cache_dir, name, types):
+    fn = os.path.join(cache_dir, _blob_fn(name))
+    value = pickle.loads(util.load_file(fn))
+    if value is not None and not isinstance(value, types):
+        raise InvalidCache("Blob %s contains a %s" %
+                           (fn, type_utils.obj_name(value)))
+    return value
+
+
+def _make_loader(cache_dir, name):
+
+    def loader():
+        try:
+            return _load_blob(cache_dir, name, LAZY_BLOBS[name])
+        except Exception:
+            util.logexc(LOG, "Failed loading cached %s from %s",
+                        name, cache_dir)
+            return None
+
+    return loader
+
+
+def _find_class(cls_name):
+    (mod_name, _sep, name) = cls_name.rpartition('.')
+    if not mod_name:
+        raise InvalidCache("Datasource class %r is not importable"
+                           % (cls_name))
+    try:
+        cls = getattr(importer.import_module(mod_name), name)
+    except (ImportError, AttributeError) as e:
+        raise InvalidCache("Datasource class %r is not importable: %s"
+                           % (cls_name, e))
+    if not isinstance(cls, type) or not issubclass(cls, sources.DataSource):
+        raise InvalidCache("%r is not a datasource class" % (cls_name))
+    return cls
+
+
+def restore(cache_dir, sys_cfg, distro, paths, header=None):
+    """
+    Recreates the cached datasource (using the given configuration, distro
+    and paths, just like a freshly found one would), the cached metadata
+    and user-data are only read when first used. Returns None if there is
+    no usable cache in the given directory.
+    """
+    if header is None:
+        header = read_header(cache_dir)
+    if not header:
+        return None
+    try:
+        cls = _find_class(header['datasource'])
+        state = _load_blob(cache_dir, STATE_BLOB, (dict,))
+        ds = cls(sys_cfg, distro, paths)
+        for (name, value) in state.items():
+            if name in NOT_CACHED or name in LAZY_BLOBS:
+                continue
+            setattr(ds, name, value)
+        for name in LAZY_BLOBS:
+            if name in header['blobs']:
+                ds.set_loader(name, _make_loader(cache_dir, name))
+            else:
+                setattr(ds, name, None)
+        ds.cached_instance_id = header['instance_id']
+        return ds
+    except Exception:
+        util.logexc(LOG, "Failed restoring datasource from %s", cache_dir)
+        return None
+
+
+def write(cache_dir, ds):
+    """
+    Writes the datasource into the cache in the given directory (replacing
+    any cache that was there), the header is written last so that a cache
+    that was only partially written is never used.
+    """
+    cls = type(ds)
+    header = {
+        'schema': SCHEMA_VERSION,
+        'cloudinit': version.version_string(),
+        'instance_id': str(ds.get_instance_id()),
+        'datasource': "%s.%s" % (cls.__module__, cls.__name__),
+        'blobs': {},
+    }
+    blobs = {}
+    state = {}
+    for (name, value) in ds.__getstate__().items():
+        if name in NOT_CACHED:
+            continue
+        if name in LAZY_BLOBS:
+            if value is not None:
+                blobs[name] = value
+        else:
+            state[name] = value
+    blobs[STATE_BLOB] = state
+    util.del_file(os.path.join(cache_dir, HEADER_FN))
+    util.ensure_dir(cache_dir, 0700)
+    for (name, value) in blobs.items():
+        fn = _blob_fn(name)
+        util.write_file(os.path.join(cache_dir, fn),
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        mode=0600)
+        header['blobs'][name] = fn
+    util.write_file(os.path.join(cache_dir, HEADER_FN),
+                    json.dumps(header, indent=1, sort_keys=True),
+                    mode=0600)
+    return header
+
+
+def load_legacy(pickle_fn):
+    """
+    Loads a datasource pickled (in full) by older versions, but only if what
+    was unpickled still looks like a datasource.
+    """
+    try:
+        contents = util.load_file(pickle_fn, quiet=True)
+    except (IOError, OSError):
+        contents = ''
+    if not contents:
+        return None
+    try:
+        ds = pickle.loads(contents)
+    except Exception:
+        util.logexc(LOG, "Failed loading pickled blob from %s", pickle_fn)
+        return None
+    if not isinstance(ds, sources.DataSource):
+        LOG.warn("Ignoring pickled %s from %s (not a datasource)",
+                 type_utils.obj_name(ds), pickle_fn)
+        return None
+    missing = [a for a in LEGACY_ATTRS if a not in ds.__dict__]
+    if missing:
+        LOG.warn("Ignoring pickled datasource from %s (missing %s)",
+                 pickle_fn, missing)
+        return None
+    return ds
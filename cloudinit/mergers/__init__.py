@@ -16,10 +16,13 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import re
+import threading
 
 from cloudinit import importer
 from cloudinit import log as logging
+from cloudinit import registry
 from cloudinit import type_utils
 
 NAME_MTCH = re.compile(r"(^[a-zA-Z_][A-Za-z0-9_]*)\((.*?)\)$")
@@ -29,36 +32,96 @@ DEF_MERGE_TYPE = "list()+dict()+str()"
 MERGER_PREFIX = 'm_'
 MERGER_ATTR = 'Merger'
 
+# Mergers keep no state of their own while merging so the ones constructed
+# for a merge specification are kept (keyed by the canonical form of that
+# specification) and shared by all later merges using the same one
+MAX_CONSTRUCTED = 128
+_CONSTRUCTED = {}
+_CONSTRUCTED_LOCK = threading.Lock()
+
+# The merge session (if any) of the thread doing the merging
+_LOCAL = threading.local()
+
 
 class UnknownMerger(object):
+    def __init__(self):
+        # Type -> the method that merges values of that type (filled
+        # in as the types are first seen)
+        self._method_table = {}
+
     # Named differently so auto-method finding
     # doesn't pick this up if there is ever a type
     # named "unknown"
     def _handle_unknown(self, _meth_wanted, value, _merge_with):
         return value
 
-    # This merging will attempt to look for a '_on_X' method
-    # in our own object for a given object Y with type X,
-    # if found it will be called to perform the merge of a source
-    # object and a object to merge_with.
-    #
-    # If not found the merge will be given to a '_handle_unknown'
-    # function which can decide what to do wit the 2 values.
-    def merge(self, source, merge_with):
-        type_name = type_utils.obj_name(source)
-        type_name = type_name.lower()
+    def _methods(self):
+        return self._method_table
+
+    # Finds the method that merges values of the given type, this is
+    # a '_on_X' method in our own object for a type named X, if not
+    # found the merge will be given to a '_handle_unknown' function
+    # which can decide what to do wit the 2 values.
+    def _find_method(self, type_name):
         method_name = "_on_%s" % (type_name)
-        meth = None
-        args = [source, merge_with]
-        if hasattr(self, method_name):
-            meth = getattr(self, method_name)
+        meth = getattr(self, method_name, None)
         if not meth:
-            meth = self._handle_unknown
-            args.insert(0, method_name)
-        LOG.debug("Merging '%s' into '%s' using method '%s' of '%s'",
-                  type_name, type_utils.obj_name(merge_with),
-                  meth.__name__, self)
-        return meth(*args)
+            meth = functools.partial(self._handle_unknown, method_name)
+        return meth
+
+    # This merging will look up (finding it the first time that
+    # type is seen) the method for the type of the source object
+    # and call it to perform the merge of a source object and a
+    # object to merge_with.
+    def merge(self, source, merge_with):
+        source_type = type(source)
+        methods = self._methods()
+        try:
+            meth = methods[source_type]
+        except KeyError:
+            type_name = type_utils.obj_name(source).lower()
+            meth = self._find_method(type_name)
+            methods[source_type] = meth
+            LOG.debug("Merging '%s' values using '%s' of '%s'",
+                      type_name, getattr(meth, '__name__', meth), self)
+        return meth(source, merge_with)
+
+
+class MergeSession(object):
+    # The mergers share what they do not change between what they merge
+    # and what they return and copy only what they change, in a session
+    # the copies they made belong to it so later merges done in the same
+    # session can change those (and only those) in place instead of copying
+    # them again. What the merges of a session return must not be used by
+    # anything else until the session is done merging.
+    def __init__(self):
+        # Id -> copy, which also keeps the copies alive so that no other
+        # object can get one of their ids
+        self._owned = {}
+
+    def writable(self, value, copier):
+        if self._owned.get(id(value)) is value:
+            return value
+        value = copier(value)
+        self._owned[id(value)] = value
+        return value
+
+    def merge(self, merger, source, merge_with):
+        prior = getattr(_LOCAL, 'session', None)
+        _LOCAL.session = self
+        try:
+            return merger.merge(source, merge_with)
+        finally:
+            _LOCAL.session = prior
+
+
+def writable(value, copier):
+    # What a merger that is about to change a value should change, this is
+    # a copy (made by the copier) unless the merge session already owns it
+    session = getattr(_LOCAL, 'session', None)
+    if session is None:
+        return copier(value)
+    return session.writable(value, copier)
 
 
 class LookupMerger(UnknownMerger):
@@ -69,9 +132,35 @@ class LookupMerger(UnknownMerger):
         else:
             self._lookups = lookups
 
+        self._methods_for = len(self._lookups)
+
     def __str__(self):
         return 'LookupMerger: (%s)' % (len(self._lookups))
 
+    # Which merger handles a type depends on the lookups, so what was
+    # found is forgotten whenever they are added to
+    def _methods(self):
+        if self._methods_for != len(self._lookups):
+            self._method_table = {}
+            self._methods_for = len(self._lookups)
+        return self._method_table
+
+    def _find_method(self, type_name):
+        method_name = "_on_%s" % (type_name)
+        meth = getattr(self, method_name, None)
+        if meth:
+            return meth
+        for merger in self._lookups:
+            meth = getattr(merger, method_name, None)
+            if meth:
+                # First one that has that method/attr gets to be
+                # the one that will be called
+                LOG.debug(("Merging using located merger '%s'"
+                            " since it had method '%s'"), merger, method_name)
+                return meth
+        return functools.partial(UnknownMerger._handle_unknown, self,
+                                 method_name)
+
     # For items which can not be merged by the parent this object
     # will lookup in a internally maintained set of objects and
     # find which one of those objects can perform the merge. If
@@ -143,12 +232,53 @@ def default_mergers():
     return tuple(string_extract_mergers(DEF_MERGE_TYPE))
 
 
+def _merger_name(m_name):
+    m_name = str(m_name).strip()
+    if not m_name.startswith(MERGER_PREFIX):
+        m_name = MERGER_PREFIX + m_name
+    return m_name
+
+
+def canonicalize(parsed_mergers):
+    # The (hashable) canonical form of parsed mergers, where the ways of
+    # naming the same merger (and of listing its options) are made the
+    # same, or none when the options are not a list (or tuple) of strings
+    canonical = []
+    for (m_name, m_ops) in parsed_mergers:
+        if not isinstance(m_ops, (list, tuple)):
+            return None
+        for m in m_ops:
+            if not isinstance(m, basestring):
+                return None
+        canonical.append((_merger_name(m_name), tuple(m_ops)))
+    return tuple(canonical)
+
+
+def clear_constructed():
+    with _CONSTRUCTED_LOCK:
+        _CONSTRUCTED.clear()
+
+
 def construct(parsed_mergers):
+    key = canonicalize(parsed_mergers)
+    if key is None:
+        return _construct(parsed_mergers)
+    with _CONSTRUCTED_LOCK:
+        merger = _CONSTRUCTED.get(key)
+    if merger is not None:
+        return merger
+    merger = _construct(key)
+    with _CONSTRUCTED_LOCK:
+        if key not in _CONSTRUCTED and len(_CONSTRUCTED) >= MAX_CONSTRUCTED:
+            _CONSTRUCTED.clear()
+        return _CONSTRUCTED.setdefault(key, merger)
+
+
+def _construct(parsed_mergers):
     mergers_to_be = []
     for (m_name, m_ops) in parsed_mergers:
-        if not m_name.startswith(MERGER_PREFIX):
-            m_name = MERGER_PREFIX + str(m_name)
-        merger_locs = importer.find_module(m_name,
+        m_name = _merger_name(m_name)
+        merger_locs = registry.find_module('mergers', m_name,
                                            [__name__],
                                            [MERGER_ATTR])
         if not merger_locs:
@@ -16,6 +16,8 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from cloudinit import mergers
+
 DEF_MERGE_TYPE = 'no_replace'
 MERGE_TYPES = ('replace', DEF_MERGE_TYPE,)
 
@@ -64,23 +66,38 @@ class Merger(object):
             # Otherwise leave it be...
             return old_v
 
+        # The value is only copied (see mergers.writable) once a key of
+        # it actually changes, the keys that do not change (and whatever
+        # is taken from what is merged with it) are shared.
+        merged = value
+        copied = False
         for (k, v) in merge_with.items():
-            if k in value:
+            delete = False
+            if k in merged:
                 if v is None and self._allow_delete:
-                    value.pop(k)
+                    delete = True
                 else:
-                    value[k] = merge_same_key(value[k], v)
+                    new_v = merge_same_key(merged[k], v)
+                    if new_v is merged[k]:
+                        continue
+            else:
+                new_v = v
+            if not copied:
+                merged = mergers.writable(value, dict)
+                copied = True
+            if delete:
+                merged.pop(k)
             else:
-                value[k] = v
-        return value
+                merged[k] = new_v
+        return merged
 
     def _on_dict(self, value, merge_with):
         if not isinstance(merge_with, (dict)):
             return value
         if self._method == 'replace':
-            merged = self._do_dict_replace(dict(value), merge_with, True)
+            merged = self._do_dict_replace(value, merge_with, True)
         elif self._method == 'no_replace':
-            merged = self._do_dict_replace(dict(value), merge_with, False)
+            merged = self._do_dict_replace(value, merge_with, False)
         else:
             raise NotImplementedError("Unknown merge type %s" % (self._method))
         return merged
@@ -16,6 +16,8 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from cloudinit import mergers
+
 DEF_MERGE_TYPE = 'replace'
 MERGE_TYPES = ('append', 'prepend', DEF_MERGE_TYPE, 'no_replace')
 
@@ -55,21 +57,21 @@ class Merger(object):
             not isinstance(merge_with, (tuple, list))):
             return merge_with
 
-        # Ok we now know that what we are merging with is a list or tuple.
-        merged_list = []
-        if self._method == 'prepend':
-            merged_list.extend(merge_with)
-            merged_list.extend(value)
-            return merged_list
-        elif self._method == 'append':
-            merged_list.extend(value)
-            merged_list.extend(merge_with)
+        # The value is only copied (see mergers.writable) when it changes,
+        # the items that do not change (and whatever is taken from what is
+        # merged with it) are shared.
+        is_list = isinstance(merge_with, (tuple, list))
+        if self._method in ('prepend', 'append'):
+            if is_list and not merge_with:
+                return value
+            merged_list = mergers.writable(value, list)
+            if self._method == 'prepend':
+                merged_list[0:0] = merge_with
+            else:
+                merged_list.extend(merge_with)
             return merged_list
 
         def merge_same_index(old_v, new_v):
-            if self._method == 'no_replace':
-                # Leave it be...
-                return old_v
             if isinstance(new_v, (list, tuple)) and self._recurse_array:
                 return self._merger.merge(old_v, new_v)
             if isinstance(new_v, (str, basestring)) and self._recurse_str:
@@ -78,9 +80,24 @@ class Merger(object):
                 return self._merger.merge(old_v, new_v)
             return new_v
 
+        common_len = min(len(value), len(merge_with))
+        if not is_list:
+            # Only what is at the same indexes is merged (and what can
+            # not be indexed can not be merged)
+            merge_with = [merge_with[i] for i in xrange(0, common_len)]
+        if self._method == 'no_replace':
+            # Leave it be...
+            return value
+
         # Ok now we are replacing same indexes
-        merged_list.extend(value)
-        common_len = min(len(merged_list), len(merge_with))
+        merged_list = value
+        copied = False
         for i in xrange(0, common_len):
-            merged_list[i] = merge_same_index(merged_list[i], merge_with[i])
+            new_v = merge_same_index(merged_list[i], merge_with[i])
+            if new_v is merged_list[i]:
+                continue
+            if not copied:
+                merged_list = mergers.writable(value, list)
+                copied = True
+            merged_list[i] = new_v
         return merged_list
@@ -0,0 +1,311 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2014 Amazon.com, Inc. or its affiliates.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import json
+import os
+import socket
+
+from cloudinit import log as logging
+from cloudinit import util
+
+from cloudinit.settings import (BOOT_SOCKET)
+
+LOG = logging.getLogger(__name__)
+
+# The boot orchestrator is a single process ('cloud-init boot') that runs
+# every stage of a boot, so that what one stage built (the init object,
+# the datasource, the distro and the merged config) is reused by the later
+# stages instead of being rebuilt by a new process for each of them.
+#
+# The init system still decides when each stage runs: it starts the usual
+# 'cloud-init init' (or 'modules') commands, which (when the orchestrator
+# is listening) hand their stage over to it and wait for it to finish,
+# exiting with the result that stage had. So the init system sees each
+# stage become ready (or fail) exactly as it would have without it.
+#
+# The stages (in the order they are expected to be run)
+STAGES = ['init-local', 'init', 'modules-init', 'modules-config',
+          'modules-final']
+
+# Give up (and exit) if no stage is asked for in this many seconds
+DEF_IDLE_TIMEOUT = 3600
+
+# Requests and replies are single (small) json lines
+MAX_MSG_LEN = 64 * 1024
+
+
+class SharedState(object):
+    """What the stages run by one orchestrator share between them."""
+
+    def __init__(self):
+        self.init = None
+        self.mods = None
+        self.cfg_files = None
+        self.output = None
+
+    def setup_output(self, cfg, name):
+        """
+        Closes stdin and redirects the output as util.fixup_output does, but
+        only once for all the stages, the later stages write to the same
+        (already redirected) stdout and stderr of this process. So their
+        output goes where the orchestrator's goes (the console and journal
+        of cloud-init-boot.service, then the configured output command),
+        not to the process that handed the stage over.
+        """
+        if self.output is None:
+            util.close_stdin()
+        if self.output is None or self.output == (None, None):
+            self.output = tuple(util.fixup_output(cfg, name))
+        elif self.output != tuple(util.get_output_cfg(cfg, name)):
+            LOG.warn("Not changing the output of stage %s to %s, an earlier"
+                     " stage already redirected it to %s", name,
+                     util.get_output_cfg(cfg, name), self.output)
+        return self.output
+
+    def reusable(self, cfg_files):
+        return self.mods is not None and self.cfg_files == cfg_files
+
+    def keep(self, init, mods, cfg_files):
+        self.init = init
+        self.mods = mods
+        self.cfg_files = cfg_files
+
+
+def notify(state):
+    """
+    Sends the given state (ie 'READY=1') to systemd (when running under a
+    systemd service that asked for it), returns whether it was sent.
+    """
+    addr = os.environ.get('NOTIFY_SOCKET')
+    if not addr:
+        return False
+    if addr[0] == '@':
+        # An abstract socket
+        addr = "\0%s" % (addr[1:])
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(state, addr)
+        return True
+    except socket.error:
+        util.logexc(LOG, "Failed notifying systemd of %r", state)
+        return False
+    finally:
+        sock.close()
+
+
+def _send_msg(sock, msg):
+    sock.sendall("%s\n" % (json.dumps(msg)))
+
+
+def _read_msg(fh):
+    line = fh.readline(MAX_MSG_LEN)
+    if not line:
+        raise ValueError("Connection closed before a message was read")
+    msg = json.loads(line)
+    if not isinstance(msg, dict):
+        raise ValueError("Message %r is not a dictionary" % (msg))
+    return msg
+
+
+def _exit_code(value):
+    # What the process would have exited with (see sys.exit)
+    if value is None:
+        return 0
+    if isinstance(value, (int, long)):
+        return value
+    return 1
+
+
+class Orchestrator(object):
+    """
+    Runs the stages that are asked for (over a unix socket) using the given
+    run_stage(stage, argv) callable, which returns the stages exit code.
+    """
+
+    def __init__(self, run_stage, sock_fn=BOOT_SOCKET,
+                 idle_timeout=DEF_IDLE_TIMEOUT):
+        self.run_stage = run_stage
+        self.sock_fn = sock_fn
+        self.idle_timeout = idle_timeout
+        self.ran = []
+        self._sock = None
+
+    def listen(self):
+        util.ensure_dir(os.path.dirname(self.sock_fn), 0755)
+        # Any socket that is already there was left by a previous boot
+        util.del_file(self.sock_fn)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0077)
+        try:
+            sock.bind(self.sock_fn)
+        finally:
+            os.umask(old_umask)
+        sock.listen(len(STAGES))
+        self._sock = sock
+        LOG.debug("Boot orchestrator listening on %s", self.sock_fn)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            util.del_file(self.sock_fn)
+
+    def _refuse_reason(self, stage, argv):
+        if stage not in STAGES:
+            return "unknown stage %r" % (stage)
+        if not isinstance(argv, list):
+            return "arguments are not a list"
+        if self.ran:
+            (last_stage, _result) = self.ran[-1]
+            if STAGES.index(stage) <= STAGES.index(last_stage):
+                return "stage %s was asked for after %s" % (stage,
+                                                            last_stage)
+        return None
+
+    def handle(self, conn):
+        """Runs the stage asked for over the given connection (if any)."""
+        try:
+            request = _read_msg(conn.makefile('rb'))
+        except (socket.error, ValueError) as e:
+            LOG.warn("Ignoring unreadable stage request: %s", e)
+            return None
+        stage = request.get('stage')
+        argv = request.get('argv')
+        reason = self._refuse_reason(stage, argv)
+        if reason:
+            LOG.warn("Refusing to run stage %s: %s", stage, reason)
+            _send_msg(conn, {'status': 'refused', 'reason': reason})
+            return None
+        _send_msg(conn, {'status': 'running'})
+        notify("STATUS=Running %s" % (stage))
+        try:
+            result = _exit_code(self.run_stage(stage,
+                                               [str(a) for a in argv]))
+        except SystemExit as e:
+            result = _exit_code(e.code)
+        except Exception:
+            util.logexc(LOG, "Running stage %s failed", stage)
+            result = 1
+        self.ran.append((stage, result))
+        notify("STATUS=Finished %s (%s)" % (stage, result))
+        try:
+            _send_msg(conn, {'status': 'done', 'result': result})
+        except socket.error:
+            LOG.warn("Stage %s finished (%s) after its caller went away",
+                     stage, result)
+        return stage
+
+    def _accept(self):
+        while True:
+            try:
+                return self._sock.accept()[0]
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+    def serve(self):
+        """
+        Serves stages until the last stage has run (or until no stage is
+        asked for within the idle timeout), returns the stages that ran.
+        """
+        self._sock.settimeout(self.idle_timeout or None)
+        try:
+            while True:
+                try:
+                    conn = self._accept()
+                except socket.timeout:
+                    LOG.warn("No stage asked for in %s seconds, exiting",
+                             self.idle_timeout)
+                    break
+                try:
+                    conn.settimeout(None)
+                    stage = self.handle(conn)
+                finally:
+                    conn.close()
+                if stage == STAGES[-1]:
+                    break
+        finally:
+            self.close()
+        return self.ran
+
+
+def start(orch, fork=False):
+    """
+    Starts listening, tells the init system that the orchestrator is ready
+    (systemd is notified, when forking the parent exits once the child is
+    listening) and then serves the stages that are asked for.
+    """
+    if not fork:
+        orch.listen()
+        notify("READY=1")
+        orch.serve()
+        return 0
+    (read_fd, write_fd) = os.pipe()
+    if os.fork():
+        os.close(write_fd)
+        ready = os.read(read_fd, 1)
+        os.close(read_fd)
+        if not ready:
+            return 1
+        return 0
+    os.close(read_fd)
+    os.setsid()
+    try:
+        orch.listen()
+        os.write(write_fd, '1')
+    finally:
+        os.close(write_fd)
+    notify("READY=1")
+    orch.serve()
+    return 0
+
+
+def delegate(stage, argv, sock_fn=BOOT_SOCKET):
+    """
+    Asks a listening orchestrator to run the given stage and waits for it
+    to finish, returning its result. Returns None when the stage was not
+    started by an orchestrator (so it should be run by the caller).
+    """
+    if not os.path.exists(sock_fn):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(sock_fn)
+            _send_msg(sock, {'stage': stage, 'argv': list(argv)})
+            fh = sock.makefile('rb')
+            reply = _read_msg(fh)
+        except (socket.error, ValueError) as e:
+            LOG.debug("Not using the boot orchestrator at %s: %s",
+                      sock_fn, e)
+            return None
+        if reply.get('status') != 'running':
+            LOG.debug("Boot orchestrator did not run %s: %s", stage,
+                      reply.get('reason'))
+            return None
+        try:
+            reply = _read_msg(fh)
+        except (socket.error, ValueError):
+            reply = {}
+        result = reply.get('result')
+        if reply.get('status') != 'done' or not isinstance(result, int):
+            LOG.warn("Boot orchestrator stopped while running %s", stage)
+            return 1
+        return result
+    finally:
+        sock.close()
@@ -0,0 +1,165 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2014 Amazon.com, Inc. or its affiliates.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ast
+import os
+import pprint
+
+from cloudinit import importer
+from cloudinit import log as logging
+from cloudinit import settings
+
+LOG = logging.getLogger(__name__)
+
+# The registry maps the names of the modules that ship with cloud-init to
+# where they live (and what they provide) so that finding them does not
+# require trying to import each name from every possible package. It is
+# generated (by setup.py at install time, or by tools/build-registry) into
+# the module below, names that are not in it (or that are out of date) are
+# still searched for the old way.
+REGISTRY_MOD = 'cloudinit._registry'
+REGISTRY_FN = '_registry.py'
+
+# What gets registered:
+#   kind -> (package, module name prefix, attributes the module must have)
+KINDS = {
+    'config': ('cloudinit.config', 'cc_', ['handle']),
+    'distros': ('cloudinit.distros', '', ['Distro']),
+    'mergers': ('cloudinit.mergers', 'm_', ['Merger']),
+    'sources': ('cloudinit.sources', 'DataSource', ['get_datasource_list']),
+}
+
+# Module level values that are recorded (when they are literals or
+# constants from cloudinit.settings) along with the module location
+RECORDED_VALUES = ['frequency', 'distros', 'osfamilies']
+
+_REGISTRY = []
+
+
+def _read_value(node):
+    if isinstance(node, ast.Name):
+        value = getattr(settings, node.id, None)
+        if isinstance(value, (basestring, list, tuple)):
+            return value
+        raise ValueError("Unknown constant %s" % (node.id))
+    return ast.literal_eval(node)
+
+
+def scan_module(fn):
+    """
+    Finds the top level names (and the values of those that are recorded)
+    that a module defines without importing it (so that this works even
+    when the modules dependencies are not installed).
+    """
+    with open(fn, 'rb') as fh:
+        tree = ast.parse(fh.read(), fn)
+    names = set()
+    values = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if not isinstance(target, ast.Name):
+                    continue
+                names.add(target.id)
+                if target.id in RECORDED_VALUES:
+                    try:
+                        values[target.id] = _read_value(node.value)
+                    except ValueError:
+                        pass
+    return (names, values)
+
+
+def build(base_dir):
+    """
+    Builds the registry for the cloudinit package in the given directory.
+    """
+    registry = {}
+    for (kind, (package, prefix, required_attrs)) in KINDS.items():
+        entries = {}
+        pkg_dir = os.path.join(base_dir, *package.split(".")[1:])
+        for fn in sorted(os.listdir(pkg_dir)):
+            (mod_name, ext) = os.path.splitext(fn)
+            if ext != '.py' or mod_name.startswith("_"):
+                continue
+            if not mod_name.startswith(prefix):
+                continue
+            (names, values) = scan_module(os.path.join(pkg_dir, fn))
+            attrs = [a for a in required_attrs if a in names]
+            if len(attrs) != len(required_attrs):
+                continue
+            entry = {
+                'path': "%s.%s" % (package, mod_name),
+                'attrs': attrs,
+            }
+            entry.update(values)
+            entries[mod_name] = entry
+        registry[kind] = entries
+    return registry
+
+
+def write(fn, base_dir):
+    registry = build(base_dir)
+    contents = [
+        "# This file is generated by cloudinit.registry, do not edit it!",
+        "",
+        "REGISTRY = %s" % (pprint.pformat(registry)),
+        "",
+    ]
+    with open(fn, 'wb') as fh:
+        fh.write("\n".join(contents))
+    return registry
+
+
+def get_registry():
+    if not _REGISTRY:
+        registry = {}
+        try:
+            registry = importer.import_module(REGISTRY_MOD).REGISTRY
+        except (ImportError, AttributeError):
+            LOG.debug("No module registry found, modules will be searched for")
+        _REGISTRY.append(registry)
+    return _REGISTRY[0]
+
+
+def lookup(kind, base_name):
+    return get_registry().get(kind, {}).get(base_name)
+
+
+def find_module(kind, base_name, search_paths, required_attrs=None):
+    """
+    Like importer.find_module but the registry (for the given kind of
+    module) is consulted first.
+    """
+    if not required_attrs:
+        required_attrs = []
+    entry = lookup(kind, base_name)
+    if entry and not [a for a in required_attrs if a not in entry['attrs']]:
+        try:
+            mod = importer.import_module(entry['path'])
+            missing = [a for a in required_attrs if not hasattr(mod, a)]
+            if not missing:
+                return [entry['path']]
+            LOG.debug("Registered module %s is missing %s",
+                      entry['path'], missing)
+        except ImportError:
+            LOG.debug("Registered module %s could not be imported",
+                      entry['path'], exc_info=True)
+    return importer.find_module(base_name, search_paths, required_attrs)
@@ -18,6 +18,14 @@
 
 import yaml
 
+from cloudinit import helpers
+
+# PyYAML built with libyaml has C versions of the parser and emitter which
+# are much quicker (they only replace the scanning/parsing and emitting, the
+# constructors and representers used are the same python ones) and those
+# are used when available.
+HAS_LIBYAML = bool(getattr(yaml, '__with_libyaml__', False))
+
 
 class _CustomSafeLoader(yaml.SafeLoader):
     def construct_python_unicode(self, node):
@@ -27,6 +35,57 @@ _CustomSafeLoader.add_constructor(
     u'tag:yaml.org,2002:python/unicode',
     _CustomSafeLoader.construct_python_unicode)
 
+_CustomCSafeLoader = None
+_Dumper = yaml.Dumper
+if HAS_LIBYAML:
+    class _CustomCSafeLoader(yaml.CSafeLoader):
+        construct_python_unicode = \
+            _CustomSafeLoader.construct_python_unicode.im_func
+
+    _CustomCSafeLoader.add_constructor(
+        u'tag:yaml.org,2002:python/unicode',
+        _CustomCSafeLoader.construct_python_unicode)
+
+    class _CustomCDumper(yaml.CDumper):
+        def represent_scalar(self, tag, value, style=None):
+            # The python emitter never writes a scalar that has its tag
+            # written out as plain, but libyaml does, so ask libyaml for
+            # the quoting the python emitter would use (which then gives
+            # the same output)
+            if (style is None and self.default_style is None and
+                tag != self.resolve(yaml.ScalarNode, value, (True, False))):
+                style = "'"
+            return yaml.CDumper.represent_scalar(self, tag, value, style)
+
+    _Dumper = _CustomCDumper
+
 
 def load(blob):
-    return(yaml.load(blob, Loader=_CustomSafeLoader))
+    if _CustomCSafeLoader is None:
+        return(yaml.load(blob, Loader=_CustomSafeLoader))
+    try:
+        return(yaml.load(blob, Loader=_CustomCSafeLoader))
+    except yaml.YAMLError:
+        # Whatever libyaml rejects is given to the python parser (which
+        # raises its own error if it rejects it too) so that both accept
+        # the same yaml
+        return(yaml.load(blob, Loader=_CustomSafeLoader))
+
+
+# Dump config views just like the dictionaries they are standing in for
+_DUMPERS = [yaml.Dumper, yaml.SafeDumper]
+if HAS_LIBYAML:
+    _DUMPERS.extend([yaml.CDumper, yaml.CSafeDumper, _CustomCDumper])
+for _dumper in _DUMPERS:
+    _dumper.add_representer(helpers.ConfigView,
+                            yaml.representer.SafeRepresenter.represent_dict)
+
+
+def dumps(obj):
+    return yaml.dump(obj,
+                     Dumper=_Dumper,
+                     line_break="\n",
+                     indent=4,
+                     explicit_start=True,
+                     explicit_end=True,
+                     default_flow_style=False)
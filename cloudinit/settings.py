@@ -26,6 +26,17 @@ CFG_ENV_NAME = "CLOUD_CFG"
 # This is expected to be a yaml formatted file
 CLOUD_CONFIG = '/etc/cloud/cloud.cfg'
 
+# Where the merged base configuration (the system config, its conf.d
+# files and the kernel command line config) is looked for before the
+# paths are known, it is cached in the data directory of the cloud
+# directory that the base configuration sets (when that is not this one
+# this only says where the cache is)
+BASE_CONFIG_CACHE = '/var/lib/cloud/data/base-config.pkl'
+
+# Where the boot orchestrator ('cloud-init boot') listens for the stages
+# that the init system wants it to run
+BOOT_SOCKET = '/var/run/cloud-init/boot.sock'
+
 # What u get if no config is provided
 CFG_BUILTIN = {
     'datasource_list': [
@@ -58,3 +69,22 @@ PER_ONCE = "once"
 
 # Used to sanity check incoming handlers/modules frequencies
 FREQUENCIES = [PER_INSTANCE, PER_ALWAYS, PER_ONCE]
+
+# Shared resources that config modules can declare (in their module level
+# 'reads' and 'writes' lists) as using, modules may also name resources of
+# their own (ie 'locale'). Modules that declare neither list are assumed to
+# write everything (RES_ALL) and so never run alongside any other module.
+RES_PACKAGES = 'packages'
+RES_USERS = 'users'
+RES_SSH = 'ssh'
+RES_NETWORK = 'network'
+RES_FILES = 'files'
+RES_CONSOLE = 'console'
+RES_ALL = '*'
+
+# What the outcome of a config module depends on (declared in its module
+# level 'inputs' list, which may also name files). Modules that declare no
+# inputs are assumed to depend on the boot itself (and so always run).
+INPUT_CONFIG = 'config'
+INPUT_METADATA = 'metadata'
+INPUT_BOOT = 'boot'
@@ -79,7 +79,9 @@ class DataSourceCloudStack(sources.DataSource):
         urls = [self.metadata_address + "/latest/meta-data/instance-id"]
         start_time = time.time()
         url = uhelp.wait_for_url(urls=urls, max_wait=max_wait,
-                                timeout=timeout, status_cb=LOG.warn)
+                                timeout=timeout, status_cb=LOG.warn,
+                                race=True,
+                                retry_policy=self.get_retry_policy())
 
         if url:
             LOG.debug("Using metadata source: '%s'", url)
@@ -101,10 +103,11 @@ class DataSourceCloudStack(sources.DataSource):
             if not self.wait_for_metadata_service():
                 return False
             start_time = time.time()
-            self.userdata_raw = ec2.get_instance_userdata(self.api_ver,
-                self.metadata_address)
-            self.metadata = ec2.get_instance_metadata(self.api_ver,
-                                                      self.metadata_address)
+            crawled = ec2.get_instance_data(
+                self.api_ver, self.metadata_address, identity=False,
+                retry_policy=self.get_retry_policy())
+            self.userdata_raw = crawled['user-data']
+            self.metadata = crawled['meta-data']
             LOG.debug("Crawl of metadata service took %s seconds",
                       int(time.time() - start_time))
             return True
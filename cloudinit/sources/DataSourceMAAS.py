@@ -18,9 +18,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from email.utils import parsedate
 import errno
-import oauth.oauth as oauth
 import os
 import time
 import urllib2
@@ -79,9 +77,9 @@ class DataSourceMAAS(sources.DataSource):
 
             self.base_url = url
 
-            (userdata, metadata) = read_maas_seed_url(self.base_url,
-                                                      self._md_headers,
-                                                      paths=self.paths)
+            (userdata, metadata) = read_maas_seed_url(
+                self.base_url, self._md_headers, paths=self.paths,
+                retry_policy=self.get_retry_policy())
             self.userdata_raw = userdata
             self.metadata = metadata
             return True
@@ -136,7 +134,9 @@ class DataSourceMAAS(sources.DataSource):
         url = url_helper.wait_for_url(urls=urls, max_wait=max_wait,
                                       timeout=timeout,
                                       exception_cb=self._except_cb,
-                                      headers_cb=self._md_headers)
+                                      headers_cb=self._md_headers,
+                                      race=True,
+                                      retry_policy=self.get_retry_policy())
 
         if url:
             LOG.debug("Using metadata source: '%s'", url)
@@ -155,6 +155,8 @@ class DataSourceMAAS(sources.DataSource):
             LOG.warn("Missing header 'date' in %s response", exception.code)
             return
 
+        from email.utils import parsedate
+
         date = exception.headers['date']
         try:
             ret_time = time.mktime(parsedate(date))
@@ -191,11 +193,12 @@ def read_maas_seed_dir(seed_d):
 
 
 def read_maas_seed_url(seed_url, header_cb=None, timeout=None,
-                       version=MD_VERSION, paths=None):
+                       version=MD_VERSION, paths=None, retry_policy=None):
     """
     Read the maas datasource at seed_url.
       - header_cb is a method that should return a headers dictionary for
         a given url
+      - retry_policy (if given) is how the meta-data files are retried
 
     Expected format of seed_url is are the following files:
       * <seed_url>/<version>/meta-data/instance-id
@@ -225,15 +228,18 @@ def read_maas_seed_url(seed_url, header_cb=None, timeout=None,
 
         if name == 'user-data':
             retries = 0
+            policy = None
         else:
             retries = None
+            policy = retry_policy
 
         try:
             ssl_details = util.fetch_ssl_details(paths)
             resp = util.read_file_or_url(url, retries=retries,
                                          headers_cb=header_cb,
                                          timeout=timeout,
-                                         ssl_details=ssl_details)
+                                         ssl_details=ssl_details,
+                                         retry_policy=policy)
             if resp.ok():
                 md[name] = str(resp)
             else:
@@ -272,6 +278,9 @@ def check_seed_contents(content, seed):
 
 def oauth_headers(url, consumer_key, token_key, token_secret, consumer_secret,
                   timestamp=None):
+    # Only needed (and imported) when maas is actually being used
+    import oauth.oauth as oauth
+
     consumer = oauth.OAuthConsumer(consumer_key, consumer_secret)
     token = oauth.OAuthToken(token_key, token_secret)
 
@@ -23,11 +23,15 @@
 import abc
 import os
 
+from cloudinit import handlers
 from cloudinit import importer
 from cloudinit import log as logging
+from cloudinit import registry
 from cloudinit import type_utils
+from cloudinit import url_helper
 from cloudinit import user_data as ud
 from cloudinit import util
+from cloudinit import workers
 
 from cloudinit.filters import launch_index
 
@@ -35,6 +39,9 @@ DEP_FILESYSTEM = "FILESYSTEM"
 DEP_NETWORK = "NETWORK"
 DS_PREFIX = 'DataSource'
 
+# How many data sources may be probed at once (when probing concurrently)
+DEF_PROBE_WORKERS = 4
+
 LOG = logging.getLogger(__name__)
 
 
@@ -42,10 +49,52 @@ class DataSourceNotFoundException(Exception):
     pass
 
 
+class _LazyAttr(object):
+    """
+    A datasource attribute whose value may instead be provided by a loader
+    that is only called when the attribute is first accessed (the instance
+    cache uses this so that large blobs are only read when needed).
+    """
+
+    def __init__(self, name, invalidates=None):
+        self.name = name
+        self.invalidates = invalidates
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        values = obj.__dict__
+        if self.name in values:
+            return values[self.name]
+        value = None
+        loader = values.get('_loaders', {}).get(self.name)
+        if loader:
+            value = loader()
+        values[self.name] = value
+        values.get('_loaders', {}).pop(self.name, None)
+        return value
+
+    def __set__(self, obj, value):
+        values = obj.__dict__
+        values.get('_loaders', {}).pop(self.name, None)
+        if self.invalidates:
+            values.pop(self.invalidates, None)
+        values[self.name] = value
+
+
 class DataSource(object):
 
     __metaclass__ = abc.ABCMeta
 
+    userdata = _LazyAttr('userdata')
+    userdata_raw = _LazyAttr('userdata_raw')
+    metadata = _LazyAttr('metadata', invalidates='cached_instance_id')
+
+    # Set when restored from the instance cache so that the instance id
+    # is known without loading the cached metadata (reset if the metadata
+    # is replaced).
+    cached_instance_id = None
+
     def __init__(self, sys_cfg, distro, paths, ud_proc=None):
         self.sys_cfg = sys_cfg
         self.distro = distro
@@ -66,6 +115,20 @@ class DataSource(object):
     def __str__(self):
         return type_utils.obj_name(self)
 
+    def __getstate__(self):
+        # Loaders can't be pickled, so load whatever they would provide
+        state = dict(self.__dict__)
+        for name in state.pop('_loaders', {}).keys():
+            state[name] = getattr(self, name)
+        return state
+
+    def set_loader(self, name, loader):
+        if not isinstance(getattr(type(self), name, None), _LazyAttr):
+            raise ValueError("Attribute %s of %s can not be lazily loaded"
+                             % (name, self))
+        self.__dict__.pop(name, None)
+        self.__dict__.setdefault('_loaders', {})[name] = loader
+
     def get_userdata(self, apply_filter=False):
         if self.userdata is None:
             self.userdata = self.ud_proc.process(self.get_userdata_raw())
@@ -73,6 +136,26 @@ class DataSource(object):
             return self._filter_userdata(self.userdata)
         return self.userdata
 
+    def get_userdata_parts(self, apply_filter=False):
+        # The parts of the user-data (handlers.Part objects) one at a time,
+        # only processing the user-data as they are needed unless all of
+        # it was already processed
+        if self.userdata is not None:
+            parts = handlers.message_parts(self.userdata)
+        else:
+            parts = self.ud_proc.iter_parts(self.get_userdata_raw())
+        if apply_filter:
+            return self.filter_userdata_parts(parts)
+        return parts
+
+    def filter_userdata_parts(self, parts):
+        filters = [
+            launch_index.Filter(util.safe_int(self.launch_index)),
+        ]
+        for f in filters:
+            parts = f.apply_parts(parts)
+        return parts
+
     @property
     def launch_index(self):
         if not self.metadata:
@@ -97,6 +180,12 @@ class DataSource(object):
     def get_userdata_raw(self):
         return self.userdata_raw
 
+    def get_retry_policy(self):
+        # How urls are retried (None when the datasource config has no
+        # 'retry_policy', so the defaults of each caller are used)
+        return url_helper.retry_policy_from_config(
+            (self.ds_cfg or {}).get('retry_policy'))
+
     # the data sources' config_obj is a cloud-config formated
     # object that came to it from ways other than cloud-config
     # because cloud-config content would be handled elsewhere
@@ -231,20 +320,63 @@ def find_source(sys_cfg, distro, paths, ds_deps, cfg_list, pkg_list):
     ds_names = [type_utils.obj_name(f) for f in ds_list]
     LOG.debug("Searching for data source in: %s", ds_names)
 
-    for cls in ds_list:
-        try:
-            LOG.debug("Seeing if we can get any data from %s", cls)
-            s = cls(sys_cfg, distro, paths)
-            if s.get_data():
-                return (s, type_utils.obj_name(cls))
-        except Exception:
-            util.logexc(LOG, "Getting data from %s failed", cls)
+    if util.get_cfg_option_bool(sys_cfg, 'datasource_parallel_probe', False):
+        max_workers = util.safe_int(sys_cfg.get('datasource_probe_workers'))
+        if not max_workers or max_workers <= 0:
+            max_workers = DEF_PROBE_WORKERS
+        found = _find_source_concurrent(sys_cfg, distro, paths,
+                                        ds_list, max_workers)
+    else:
+        found = _find_source_serial(sys_cfg, distro, paths, ds_list)
+    if found:
+        return found
 
     msg = ("Did not find any data source,"
            " searched classes: (%s)") % (", ".join(ds_names))
     raise DataSourceNotFoundException(msg)
 
 
+def _probe_source(cls, sys_cfg, distro, paths):
+    try:
+        LOG.debug("Seeing if we can get any data from %s", cls)
+        s = cls(sys_cfg, distro, paths)
+        if s.get_data():
+            return s
+    except Exception:
+        util.logexc(LOG, "Getting data from %s failed", cls)
+    return None
+
+
+def _find_source_serial(sys_cfg, distro, paths, ds_list):
+    for cls in ds_list:
+        s = _probe_source(cls, sys_cfg, distro, paths)
+        if s:
+            return (s, type_utils.obj_name(cls))
+    return None
+
+
+# All candidates probe at the same time (on a bounded set of workers) but
+# the result is still picked in 'datasource_list' order, so the winner is
+# the same one that the serial search would have found; the only difference
+# is that a slow (or blocked) candidate no longer delays those after it.
+def _find_source_concurrent(sys_cfg, distro, paths, ds_list, max_workers):
+    if not ds_list:
+        return None
+    max_workers = min(max_workers, len(ds_list))
+    LOG.debug("Probing %s data sources using %s workers",
+              len(ds_list), max_workers)
+    probes = []
+    for cls in ds_list:
+        probes.append((_probe_source, (cls, sys_cfg, distro, paths)))
+    (i, s) = workers.run_ordered(probes, max_workers)
+    if i is None:
+        return None
+    abandoned = [type_utils.obj_name(cls) for cls in ds_list[i + 1:]]
+    if abandoned:
+        LOG.debug("Abandoning lower priority data sources: %s", abandoned)
+    return (s, type_utils.obj_name(ds_list[i]))
+
+
 # Return a list of classes that have the same depends as 'depends'
 # iterate through cfg_list, loading "DataSource*" modules
 # and calling their "get_datasource_list".
@@ -257,7 +389,7 @@ def list_sources(cfg_list, depends, pkg_list):
     for ds_name in cfg_list:
         if not ds_name.startswith(DS_PREFIX):
             ds_name = '%s%s' % (DS_PREFIX, ds_name)
-        m_locs = importer.find_module(ds_name,
+        m_locs = registry.find_module('sources', ds_name,
                                       pkg_list,
                                       ['get_datasource_list'])
         for m_loc in m_locs:
@@ -26,30 +26,34 @@ import copy
 import os
 import sys
 
-from cloudinit.settings import (PER_INSTANCE, FREQUENCIES, CLOUD_CONFIG)
+from cloudinit.settings import (PER_INSTANCE, PER_ALWAYS, FREQUENCIES,
+                                CLOUD_CONFIG, BASE_CONFIG_CACHE, CFG_BUILTIN)
 
 from cloudinit import handlers
 
-# Default handlers (used if not overridden)
-from cloudinit.handlers import boot_hook as bh_part
-from cloudinit.handlers import cloud_config as cc_part
-from cloudinit.handlers import shell_script as ss_part
-from cloudinit.handlers import upstart_job as up_part
-
 from cloudinit import cloud
 from cloudinit import config
 from cloudinit import distros
+from cloudinit import fingerprint
 from cloudinit import helpers
 from cloudinit import importer
+from cloudinit import instance_cache
 from cloudinit import log as logging
 from cloudinit import sources
+from cloudinit import timing
 from cloudinit import type_utils
+from cloudinit import user_data as ud
 from cloudinit import util
+from cloudinit import version
+from cloudinit import workers
 
 LOG = logging.getLogger(__name__)
 
 NULL_DATA_SOURCE = None
 
+# How many modules may run at once (when running them concurrently)
+DEF_MODULE_WORKERS = 4
+
 
 class Init(object):
     def __init__(self, ds_deps=None):
@@ -61,8 +65,12 @@ class Init(object):
         self._cfg = None
         self._paths = None
         self._distro = None
+        # Where the base config is cached (known once the config was read)
+        self._base_cfg_cache_fn = None
         # Changed only when a fetch occurs
         self.datasource = NULL_DATA_SOURCE
+        # Where the processed user-data was stored (by update())
+        self._stored_userdata = None
 
     def _reset(self, reset_ds=False):
         # Recreated on access
@@ -78,6 +86,11 @@ class Init(object):
             # Try to find the right class to use
             system_config = self._extract_cfg('system')
             distro_name = system_config.pop('distro', 'ubuntu')
+            # What the distro runs once (like updating its package sources)
+            # is recorded with the same semaphores as the modules
+            backend = self.cfg.get('semaphore_backend')
+            if backend and 'semaphore_backend' not in system_config:
+                system_config['semaphore_backend'] = backend
             distro_cls = distros.fetch(distro_name)
             LOG.debug("Using distro class %s", distro_cls)
             self._distro = distro_cls(distro_name, system_config, self.paths)
@@ -96,16 +109,17 @@ class Init(object):
     def _extract_cfg(self, restriction):
         # Ensure actually read
         self.read_cfg()
-        # Nobody gets the real config
-        ocfg = copy.deepcopy(self._cfg)
-        if restriction == 'restricted':
-            ocfg.pop('system_info', None)
-        elif restriction == 'system':
+        # Nobody gets the real config (only a copy-on-write view of it)
+        ocfg = self._cfg
+        if restriction == 'system':
             ocfg = util.get_cfg_by_path(ocfg, ('system_info',), {})
         elif restriction == 'paths':
             ocfg = util.get_cfg_by_path(ocfg, ('system_info', 'paths'), {})
         if not isinstance(ocfg, (dict)):
-            ocfg = {}
+            return {}
+        ocfg = helpers.ConfigView(ocfg)
+        if restriction == 'restricted' and 'system_info' in ocfg:
+            del ocfg['system_info']
         return ocfg
 
     @property
@@ -161,51 +175,54 @@ class Init(object):
     def read_cfg(self, extra_fns=None):
         # None check so that we don't keep on re-loading if empty
         if self._cfg is None:
-            self._cfg = self._read_cfg(extra_fns)
+            with timing.timed('read_cfg'):
+                self._cfg = self._read_cfg(extra_fns)
             # LOG.debug("Loaded 'init' config %s", self._cfg)
+            self._base_cfg_cache_fn = os.path.join(
+                self.paths.get_cpath('data'), BASE_CONFIG_CACHE_FN)
+
+    def set_yaml_cache(self):
+        # Keep what yaml was parsed between the stages (unless disabled)
+        fn = None
+        if util.get_cfg_option_bool(self.cfg, 'yaml_cache', True):
+            fn = os.path.join(self.paths.get_cpath('data'), YAML_CACHE_FN)
+        util.set_yaml_cache_file(fn)
+        return fn
 
     def _read_cfg(self, extra_fns):
         no_cfg_paths = helpers.Paths({}, self.datasource)
+        base_cfg = fetch_base_config(cache_fn=self._base_cfg_cache_fn)
         merger = helpers.ConfigMerger(paths=no_cfg_paths,
                                       datasource=self.datasource,
                                       additional_fns=extra_fns,
-                                      base_cfg=fetch_base_config())
+                                      base_cfg=base_cfg)
         return merger.cfg
 
     def _restore_from_cache(self):
         # We try to restore from a current link and static path
         # by using the instance link, if purge_cache was called
-        # the file wont exist.
-        pickled_fn = self.paths.get_ipath_cur('obj_pkl')
-        pickle_contents = None
-        try:
-            pickle_contents = util.load_file(pickled_fn)
-        except Exception:
-            pass
-        # This is expected so just return nothing
-        # successfully loaded...
-        if not pickle_contents:
-            return None
-        try:
-            return pickle.loads(pickle_contents)
-        except Exception:
-            util.logexc(LOG, "Failed loading pickled blob from %s", pickled_fn)
-            return None
+        # the files wont exist.
+        cache_dir = self.paths.get_ipath_cur('obj_cache')
+        header = instance_cache.read_header(cache_dir)
+        if header:
+            return instance_cache.restore(cache_dir, self.cfg, self.distro,
+                                          self.paths, header=header)
+        # Older versions pickled the whole datasource, these are used
+        # (and moved to the instance cache when it is next written) if
+        # they still look sane...
+        return instance_cache.load_legacy(self.paths.get_ipath_cur('obj_pkl'))
 
     def _write_to_cache(self):
         if self.datasource is NULL_DATA_SOURCE:
             return False
-        pickled_fn = self.paths.get_ipath_cur("obj_pkl")
+        cache_dir = self.paths.get_ipath_cur("obj_cache")
         try:
-            pk_contents = pickle.dumps(self.datasource)
+            instance_cache.write(cache_dir, self.datasource)
         except Exception:
-            util.logexc(LOG, "Failed pickling datasource %s", self.datasource)
-            return False
-        try:
-            util.write_file(pickled_fn, pk_contents, mode=0400)
-        except Exception:
-            util.logexc(LOG, "Failed pickling datasource to %s", pickled_fn)
+            util.logexc(LOG, "Failed caching datasource %s to %s",
+                        self.datasource, cache_dir)
             return False
+        util.del_file(self.paths.get_ipath_cur("obj_pkl"))
         return True
 
     def _get_datasources(self):
@@ -305,7 +322,8 @@ class Init(object):
         return iid
 
     def fetch(self):
-        return self._get_data_source()
+        with timing.timed('fetch'):
+            return self._get_data_source()
 
     def instancify(self):
         return self._reflect_cur_instance()
@@ -314,7 +332,9 @@ class Init(object):
         # Form the needed options to cloudify our members
         return cloud.Cloud(self.datasource,
                            self.paths, self.cfg,
-                           self.distro, helpers.Runners(self.paths))
+                           self.distro,
+                           helpers.Runners(self.paths,
+                                           self.cfg.get('semaphore_backend')))
 
     def update(self):
         if not self._write_to_cache():
@@ -324,15 +344,39 @@ class Init(object):
     def _store_userdata(self):
         raw_ud = "%s" % (self.datasource.get_userdata_raw())
         util.write_file(self._get_ipath('userdata_raw'), raw_ud, 0600)
-        processed_ud = "%s" % (self.datasource.get_userdata())
-        util.write_file(self._get_ipath('userdata'), processed_ud, 0600)
+        # The processed user-data is written a part at a time as it is
+        # processed (and later read back the same way to be consumed)
+        self._stored_userdata = None
+        ud_fn = self._get_ipath('userdata')
+        util.ensure_dir(os.path.dirname(ud_fn))
+        with util.SeLinuxGuard(path=ud_fn):
+            with open(ud_fn, 'wb') as fh:
+                util.chmod(ud_fn, 0600)
+                count = ud.write_parts(self.datasource.get_userdata_parts(),
+                                       fh)
+        LOG.debug("Wrote %s processed user-data parts to %s", count, ud_fn)
+        self._stored_userdata = ud_fn
+
+    def _userdata_parts(self):
+        # Read back what update() stored instead of processing the
+        # user-data again (when it did store it)
+        ud_fn = self._stored_userdata
+        if ud_fn and os.path.isfile(ud_fn):
+            return self.datasource.filter_userdata_parts(
+                _read_userdata_parts(ud_fn))
+        return self.datasource.get_userdata_parts(True)
 
     def _default_userdata_handlers(self):
         opts = {
             'paths': self.paths,
             'datasource': self.datasource,
         }
-        # TODO(harlowja) Hmmm, should we dynamically import these??
+        # These are only imported when user-data is actually consumed
+        from cloudinit.handlers import boot_hook as bh_part
+        from cloudinit.handlers import cloud_config as cc_part
+        from cloudinit.handlers import shell_script as ss_part
+        from cloudinit.handlers import upstart_job as up_part
+
         def_handlers = [
             cc_part.CloudConfigPartHandler(**opts),
             ss_part.ShellScriptPartHandler(**opts),
@@ -342,6 +386,10 @@ class Init(object):
         return def_handlers
 
     def consume_userdata(self, frequency=PER_INSTANCE):
+        with timing.timed('consume_userdata:%s' % (frequency)):
+            self._consume_userdata(frequency)
+
+    def _consume_userdata(self, frequency=PER_INSTANCE):
         cdir = self.paths.get_cpath("handlers")
         idir = self._get_ipath("handlers")
 
@@ -353,7 +401,7 @@ class Init(object):
             sys.path.insert(0, idir)
 
         # Ensure datasource fetched before activation (just incase)
-        user_data_msg = self.datasource.get_userdata(True)
+        user_data_parts = self._userdata_parts()
 
         # This keeps track of all the active handlers
         c_handlers = helpers.ContentHandlers()
@@ -405,7 +453,8 @@ class Init(object):
             # names...
             'handlercount': 0,
         }
-        handlers.walk(user_data_msg, handlers.walker_callback, data=part_data)
+        handlers.walk_parts(user_data_parts, handlers.walker_callback,
+                            data=part_data)
 
         # Give callbacks opportunity to finalize
         called = []
@@ -433,6 +482,7 @@ class Modules(object):
         self.cfg_files = cfg_files
         # Created on first use
         self._cached_cfg = None
+        self._boot_record = None
 
     @property
     def cfg(self):
@@ -444,8 +494,34 @@ class Modules(object):
                                           base_cfg=self.init.cfg)
             self._cached_cfg = merger.cfg
             # LOG.debug("Loading 'module' config %s", self._cached_cfg)
-        # Only give out a copy so that others can't modify this...
-        return copy.deepcopy(self._cached_cfg)
+        # Only give out a view so that others can't modify this...
+        return helpers.ConfigView(self._cached_cfg)
+
+    @property
+    def boot_record(self):
+        # What was done by previous boots (and this one), only kept when
+        # the boot fingerprint is enabled...
+        if self._boot_record is None:
+            cfg = self.cfg
+            if not util.get_cfg_option_bool(cfg, 'boot_fingerprint', False):
+                return None
+            if self.init.datasource is NULL_DATA_SOURCE:
+                return None
+            boot_fp = fingerprint.compute(self.init.datasource,
+                                          self._cached_cfg)
+            fn = self.init.paths.get_cpath('boot_fingerprint')
+            self._boot_record = fingerprint.load(fn, boot_fp)
+        return self._boot_record
+
+    def boot_unchanged(self):
+        record = self.boot_record
+        return record is not None and record.matches()
+
+    def finish_boot(self):
+        record = self.boot_record
+        if record is None:
+            return False
+        return record.finish()
 
     def _read_modules(self, name):
         module_list = []
@@ -506,9 +582,7 @@ class Modules(object):
                           " has an unknown frequency %s"), raw_name, freq)
                 # Reset it so when ran it will get set to a known value
                 freq = None
-            mod_locs = importer.find_module(mod_name,
-                                            ['', type_utils.obj_name(config)],
-                                            ['handle'])
+            mod_locs = config.find_module(mod_name)
             if not mod_locs:
                 LOG.warn("Could not find module named %s", mod_name)
                 continue
@@ -516,20 +590,22 @@ class Modules(object):
             mostly_mods.append([mod, raw_name, freq, run_args])
         return mostly_mods
 
-    def _run_modules(self, mostly_mods):
-        d_name = self.init.distro.name
-        cc = self.init.cloudify()
-        # Return which ones ran
-        # and which ones failed + the exception of why it failed
-        failures = []
-        which_ran = []
-        for (mod, name, freq, args) in mostly_mods:
-            try:
-                # Try the modules frequency, otherwise fallback to a known one
-                if not freq:
-                    freq = mod.frequency
-                if not freq in FREQUENCIES:
-                    freq = PER_INSTANCE
+    def _resolve_freq(self, mod, freq):
+        # Try the modules frequency, otherwise fallback
+        # to a known one
+        if not freq:
+            freq = mod.frequency
+        if not freq in FREQUENCIES:
+            freq = PER_INSTANCE
+        return freq
+
+    def _run_module(self, cc, d_name, mod, name, freq, args):
+        # Returns if the module was started (this is what marks it as
+        # having ran) and the exception it failed with (if it failed)
+        started = False
+        try:
+            with timing.timed(name):
+                freq = self._resolve_freq(mod, freq)
 
                 worked_distros = set(mod.distros)
                 worked_distros.update(
@@ -547,12 +623,56 @@ class Modules(object):
                 func_args = [name, self.cfg,
                              cc, config.LOG, args]
                 # Mark it as having started running
-                which_ran.append(name)
+                started = True
                 # This name will affect the semaphore name created
                 run_name = "config-%s" % (name)
                 cc.run(run_name, mod.handle, func_args, freq=freq)
-            except Exception as e:
-                util.logexc(LOG, "Running %s (%s) failed", name, mod)
+        except Exception as e:
+            util.logexc(LOG, "Running %s (%s) failed", name, mod)
+            return (started, e)
+        return (started, None)
+
+    def _run_concurrently(self, runs, mostly_mods):
+        # Each module waits on the earlier modules it conflicts with
+        # (so those keep their configured order) and runs alongside
+        # the rest...
+        depends_on = []
+        for (i, (mod, _name, _freq, _args)) in enumerate(mostly_mods):
+            deps = []
+            for j in range(0, i):
+                if config.conflicts(mostly_mods[j][0], mod):
+                    deps.append(j)
+            depends_on.append(deps)
+        max_workers = util.safe_int(self.cfg.get('modules_workers'))
+        if not max_workers or max_workers <= 0:
+            max_workers = DEF_MODULE_WORKERS
+        LOG.debug("Running %s modules using %s workers",
+                  len(mostly_mods), max_workers)
+        tasks = workers.run_dependent(runs, depends_on, max_workers)
+        return [t.result() for t in tasks]
+
+    def _run_modules(self, mostly_mods):
+        d_name = self.init.distro.name
+        cc = self.init.cloudify()
+        runs = []
+        for (mod, name, freq, args) in mostly_mods:
+            runs.append((self._run_module, (cc, d_name, mod, name,
+                                            freq, args)))
+        if (len(runs) > 1 and
+            util.get_cfg_option_bool(self.cfg, 'modules_parallel', False)):
+            results = self._run_concurrently(runs, mostly_mods)
+        else:
+            results = [functor(*args) for (functor, args) in runs]
+        # Return which ones ran
+        # and which ones failed + the exception of why it failed
+        # (in the order they were configured in)
+        failures = []
+        which_ran = []
+        for ((_mod, name, _freq, _args), (started, e)) in zip(mostly_mods,
+                                                             results):
+            if started:
+                which_ran.append(name)
+            if e is not None:
                 failures.append((name, e))
         return (which_ran, failures)
 
@@ -570,14 +690,54 @@ class Modules(object):
 
     def run_section(self, section_name):
         raw_mods = self._read_modules(section_name)
+        record = self.boot_record
+        if record is not None and record.matches(section_name):
+            # Nothing changed since a previous boot finished, so only the
+            # per-always modules whose inputs changed need to run again
+            inputs = fingerprint.Inputs(self.init.datasource,
+                                        self._cached_cfg)
+            changed = record.changed_modules(section_name, inputs)
+            LOG.debug("Boot fingerprint unchanged, running %s of the %s"
+                      " modules in %s", len(changed), len(raw_mods),
+                      section_name)
+            raw_mods = [m for m in raw_mods if m['mod'] in changed]
         mostly_mods = self._fixup_modules(raw_mods)
-        return self._run_modules(mostly_mods)
+        (which_ran, failures) = self._run_modules(mostly_mods)
+        if record is not None:
+            # What the modules depend on is looked at after they ran (as
+            # they may have changed it)
+            inputs = fingerprint.Inputs(self.init.datasource,
+                                        self._cached_cfg)
+            entries = []
+            for (mod, name, freq, _args) in mostly_mods:
+                if name not in which_ran:
+                    continue
+                if self._resolve_freq(mod, freq) != PER_ALWAYS:
+                    continue
+                entries.append((name, mod.inputs, inputs.digest(mod.inputs)))
+            record.record_section(section_name, entries, bool(failures))
+        return (which_ran, failures)
 
 
-def fetch_base_config():
+# Where parsed yaml is kept between the stages (in the data directory)
+YAML_CACHE_FN = 'yaml-cache.pkl'
+
+# Where the base config is cached between runs (in the data directory)
+BASE_CONFIG_CACHE_FN = 'base-config.pkl'
+
+# Bump this when the layout of the base config cache changes
+BASE_CONFIG_CACHE_VERSION = 1
+
+
+def _read_userdata_parts(ud_fn):
+    with open(ud_fn, 'rb') as fh:
+        for part in ud.read_parts(fh):
+            yield part
+
+
+def _read_base_config(kern_contents, cfgfile):
     base_cfgs = []
     default_cfg = util.get_builtin_cfg()
-    kern_contents = util.read_cc_from_cmdline()
 
     # Kernel/cmdline parameters override system config
     if kern_contents:
@@ -585,10 +745,147 @@ def fetch_base_config():
 
     # Anything in your conf.d location??
     # or the 'default' cloud.cfg location???
-    base_cfgs.append(util.read_conf_with_confd(CLOUD_CONFIG))
+    base_cfgs.append(util.read_conf_with_confd(cfgfile))
 
     # And finally the default gets to play
     if default_cfg:
         base_cfgs.append(default_cfg)
 
     return util.mergemanydict(base_cfgs)
+
+
+def _stat_sig(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def _base_config_inputs(cfgfile):
+    # The files (and directories) that contributed to the base config, any
+    # file added to (or removed from) the conf.d directory changes the
+    # signature of that directory so its contents need not be re-listed
+    # when checking if the cache is still valid.
+    inputs = [cfgfile]
+    try:
+        confd = util.get_conf_d(cfgfile, util.read_conf(cfgfile))
+    except Exception:
+        confd = None
+    if confd:
+        inputs.append(confd)
+        if os.path.isdir(confd):
+            inputs.extend(util.get_conf_d_files(confd))
+    return [(fn, _stat_sig(fn)) for fn in inputs]
+
+
+def _load_base_config_cache(cache_fn, kern_contents, follow=True):
+    try:
+        blob = util.load_file(cache_fn, quiet=True)
+    except Exception:
+        blob = None
+    if not blob:
+        return None
+    try:
+        cached = pickle.loads(blob)
+    except Exception:
+        LOG.debug("Ignoring unloadable base config cache %s", cache_fn)
+        return None
+    try:
+        if cached['version'] != BASE_CONFIG_CACHE_VERSION:
+            return None
+        if follow and cached.get('location'):
+            # Only says where the cache is (see fetch_base_config)
+            return _load_base_config_cache(cached['location'],
+                                           kern_contents, follow=False)
+        if cached['cloudinit'] != version.version_string():
+            return None
+        if cached['cmdline'] != kern_contents:
+            return None
+        if cached['builtin'] != CFG_BUILTIN:
+            return None
+        for (fn, sig) in cached['inputs']:
+            if _stat_sig(fn) != sig:
+                LOG.debug("Base config cache %s is stale (%s changed)",
+                          cache_fn, fn)
+                return None
+        return cached['cfg']
+    except (KeyError, TypeError, AttributeError, ValueError):
+        return None
+
+
+def _write_base_config_pointer(pointer_fn, cache_fn):
+    pointer = {
+        'version': BASE_CONFIG_CACHE_VERSION,
+        'location': cache_fn,
+    }
+    try:
+        util.ensure_dir(os.path.dirname(pointer_fn))
+        blob = pickle.dumps(pointer, pickle.HIGHEST_PROTOCOL)
+        util.write_file(pointer_fn, blob, mode=0600)
+    except Exception:
+        util.logexc(LOG, "Failed writing base config cache location to %s",
+                    pointer_fn)
+        return False
+    return True
+
+
+def _write_base_config_cache(cache_fn, kern_contents, inputs, cfg):
+    cached = {
+        'version': BASE_CONFIG_CACHE_VERSION,
+        'cloudinit': version.version_string(),
+        'cmdline': kern_contents,
+        'builtin': CFG_BUILTIN,
+        'inputs': inputs,
+        'cfg': cfg,
+    }
+    try:
+        blob = pickle.dumps(cached, pickle.HIGHEST_PROTOCOL)
+        util.write_file(cache_fn, blob, mode=0600)
+    except Exception:
+        util.logexc(LOG, "Failed writing base config cache to %s", cache_fn)
+        return False
+    return True
+
+
+def base_config_cache_fn(cfg):
+    # The cache in the data directory of the cloud directory the config sets
+    path_info = util.get_cfg_by_path(cfg, ('system_info', 'paths'), {})
+    if not isinstance(path_info, (dict)):
+        path_info = {}
+    paths = helpers.Paths(path_info)
+    return os.path.join(paths.get_cpath('data'), BASE_CONFIG_CACHE_FN)
+
+
+def fetch_base_config(cfgfile=CLOUD_CONFIG, cache_fn=None):
+    # Without a cache file (the paths are not known before the base config
+    # is) the cache is looked for in the default cloud directory and written
+    # to the cloud directory that the base config sets. When that is not
+    # the default one what is kept in the default one only says where the
+    # cache is, so that the next process (which also starts without the
+    # paths) finds it there.
+    kern_contents = util.read_cc_from_cmdline()
+    cfg = _load_base_config_cache(cache_fn or BASE_CONFIG_CACHE,
+                                  kern_contents)
+    if cfg is not None:
+        LOG.debug("Using cached base config from %s",
+                  cache_fn or BASE_CONFIG_CACHE)
+        return cfg
+
+    # The inputs are examined before reading them so that a file changed
+    # while being read is seen as changed on the next run.
+    inputs = _base_config_inputs(cfgfile)
+    cfg = _read_base_config(kern_contents, cfgfile)
+    pointer_fn = None
+    if not cache_fn:
+        cache_fn = base_config_cache_fn(cfg)
+        if cache_fn != BASE_CONFIG_CACHE:
+            pointer_fn = BASE_CONFIG_CACHE
+    # Only cache if the directory it goes in has been setup (it will be
+    # on all runs after the first 'init' stage has initialized things)
+    if os.path.isdir(os.path.dirname(cache_fn)):
+        written = _write_base_config_cache(cache_fn, kern_contents,
+                                           inputs, cfg)
+        if written and pointer_fn:
+            _write_base_config_pointer(pointer_fn, cache_fn)
+    return cfg
@@ -20,8 +20,6 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from Cheetah.Template import Template
-
 from cloudinit import util
 
 
@@ -35,6 +33,9 @@ def render_to_file(fn, outfn, params, mode=0644):
 
 
 def render_string(content, params):
+    # Cheetah is slow to import (and most runs render nothing)
+    from Cheetah.Template import Template
+
     if not params:
         params = {}
     return Template(content, searchList=[params]).respond()
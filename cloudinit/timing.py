@@ -0,0 +1,264 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2014 Amazon.com, Inc. or its affiliates.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+
+from cloudinit import log as logging
+from cloudinit import util
+
+LOG = logging.getLogger(__name__)
+
+# Where the kernel exposes a identifier that is unique per boot
+BOOT_ID_FN = '/proc/sys/kernel/random/boot_id'
+
+# Separates the names of nested timers
+SEP = '/'
+
+RESULT_SUCCESS = 'success'
+RESULT_FAIL = 'fail'
+RESULT_SKIPPED = 'skipped'
+
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+# Events that have not yet been written out (and where they will be)
+_PENDING = []
+_TARGET = {
+    'fn': None,
+}
+
+# What the main thread is currently timing
+_ROOT_STACK = []
+
+# Read once (it can not change while running)
+_BOOT_ID = []
+
+
+def get_boot_id():
+    if not _BOOT_ID:
+        boot_id = None
+        try:
+            boot_id = util.load_file(BOOT_ID_FN, quiet=True).strip() or None
+        except (IOError, OSError):
+            pass
+        _BOOT_ID.append(boot_id)
+    return _BOOT_ID[0]
+
+
+def _in_main_thread():
+    return threading.current_thread().name == 'MainThread'
+
+
+def _get_stack():
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack is None:
+        # Other threads start out nested in whatever the main thread is
+        # timing (so work farmed out to threads stays under its stage).
+        stack = list(_ROOT_STACK)
+        _LOCAL.stack = stack
+    return stack
+
+
+def current_name():
+    return SEP.join(_get_stack())
+
+
+def record(name, start, duration, result=RESULT_SUCCESS, **kwargs):
+    event = {
+        'name': name,
+        'stage': name.split(SEP, 1)[0],
+        'start': start,
+        'duration': duration,
+        'result': result,
+        'boot_id': get_boot_id(),
+        'pid': os.getpid(),
+    }
+    event.update(kwargs)
+    with _LOCK:
+        _PENDING.append(event)
+    return event
+
+
+class Timer(object):
+    """
+    Times the enclosed block and records a event for it (nested timers are
+    named after the timers they are nested in, ie 'init/fetch'). The result
+    may be adjusted (to say RESULT_SKIPPED) before the block exits, any
+    exception escaping the block marks it as RESULT_FAIL.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.result = RESULT_SUCCESS
+        self.full_name = None
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        stack = _get_stack()
+        stack.append(str(self.name))
+        if _in_main_thread():
+            _ROOT_STACK[:] = stack
+        self.full_name = SEP.join(stack)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excp_type, excp_value, excp_traceback):
+        self.duration = time.time() - self.start
+        if excp_type is not None:
+            self.result = RESULT_FAIL
+        stack = _get_stack()
+        if stack and stack[-1] == str(self.name):
+            stack.pop()
+        if _in_main_thread():
+            _ROOT_STACK[:] = stack
+        record(self.full_name, self.start, self.duration, self.result)
+        return False
+
+
+def timed(name):
+    return Timer(name)
+
+
+def set_target(paths):
+    fn = paths.get_cpath('boot_timing')
+    with _LOCK:
+        _TARGET['fn'] = fn
+    return fn
+
+
+def flush():
+    with _LOCK:
+        fn = _TARGET['fn']
+        if not fn or not _PENDING:
+            return 0
+        events = list(_PENDING)
+        del _PENDING[:]
+    lines = [json.dumps(e, sort_keys=True) for e in events]
+    try:
+        util.append_file(fn, "%s\n" % ("\n".join(lines)))
+    except (IOError, OSError):
+        util.logexc(LOG, "Failed writing %s timing events to %s",
+                    len(events), fn)
+        return 0
+    return len(events)
+
+
+def load_events(fn):
+    events = []
+    for line in util.load_file(fn).splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            LOG.debug("Skipping invalid timing event %r", line)
+    return events
+
+
+def split_boots(events):
+    """
+    Groups the events by boot (in the order the boots happened), events
+    written without a boot id are grouped by whatever boot came before.
+    """
+    boots = []
+    by_id = {}
+    for e in sorted(events, key=lambda e: e.get('start', 0)):
+        boot_id = e.get('boot_id')
+        if boot_id is None and boots:
+            boot_id = boots[-1][0]
+        if boot_id not in by_id:
+            by_id[boot_id] = []
+            boots.append((boot_id, by_id[boot_id]))
+        by_id[boot_id].append(e)
+    return boots
+
+
+def _fmt_secs(secs):
+    return "%.3fs" % (secs)
+
+
+def show(boot_events):
+    """Lists the events of one boot (in start order) as a indented tree."""
+    lines = []
+    if not boot_events:
+        return lines
+    first = min([e['start'] for e in boot_events])
+    for e in sorted(boot_events, key=lambda e: (e['start'],
+                                                 e['name'].count(SEP))):
+        depth = e['name'].count(SEP)
+        short_name = e['name'].rsplit(SEP, 1)[-1]
+        line = "%s+%s %s: %s (%s)" % ("  " * depth,
+                                      _fmt_secs(e['start'] - first),
+                                      short_name, _fmt_secs(e['duration']),
+                                      e['result'])
+        if e.get('stats'):
+            line += " [%s]" % (", ".join(["%s=%s" % (k, v) for (k, v)
+                                          in sorted(e['stats'].items())]))
+        lines.append(line)
+    return lines
+
+
+def blame(boot_events, stages_too=False):
+    """Lists the events of one boot from slowest to quickest."""
+    lines = []
+    events = list(boot_events)
+    if not stages_too:
+        events = [e for e in events if SEP in e['name']]
+    events.sort(key=lambda e: e['duration'], reverse=True)
+    for e in events:
+        lines.append("%10s %s" % (_fmt_secs(e['duration']), e['name']))
+    return lines
+
+
+def _total_by_name(boot_events):
+    totals = {}
+    for e in boot_events:
+        totals[e['name']] = totals.get(e['name'], 0) + e['duration']
+    return totals
+
+
+def diff(old_events, new_events):
+    """
+    Compares the time spent (by event name) between two boots and lists
+    the differences from the largest regression to the largest improvement.
+    """
+    old = _total_by_name(old_events)
+    new = _total_by_name(new_events)
+    deltas = []
+    for name in set(old.keys()) | set(new.keys()):
+        old_secs = old.get(name)
+        new_secs = new.get(name)
+        delta = (new_secs or 0) - (old_secs or 0)
+        deltas.append((delta, name, old_secs, new_secs))
+    deltas.sort(key=lambda d: d[0], reverse=True)
+    lines = []
+    for (delta, name, old_secs, new_secs) in deltas:
+        if old_secs is None:
+            old_secs = '-'
+        else:
+            old_secs = _fmt_secs(old_secs)
+        if new_secs is None:
+            new_secs = '-'
+        else:
+            new_secs = _fmt_secs(new_secs)
+        lines.append("%+10.3fs %10s -> %-10s %s" % (delta, old_secs,
+                                                    new_secs, name))
+    return lines
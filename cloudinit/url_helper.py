@@ -22,35 +22,281 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import cookielib
+import random
+import tempfile
+import threading
 import time
-import warnings
-
-import requests
-from requests import exceptions
 
+from Queue import (Empty, Queue)
+from StringIO import StringIO
 from urlparse import (urlparse, urlunparse)
 
 from cloudinit import log as logging
 from cloudinit import version
+from cloudinit import workers
 
 LOG = logging.getLogger(__name__)
 
-# Check if requests has ssl support (added in requests >= 0.8.8)
-SSL_ENABLED = False
-CONFIG_ENABLED = False  # This was added in 0.7 (but taken out in >=1.0)
-try:
-    from distutils.version import LooseVersion
-    with warning.catch_warnings():
-        warnings.simplefilter("ignore", UserWarning)
-        import pkg_resources
-    _REQ = pkg_resources.get_distribution('requests')
-    _REQ_VER = LooseVersion(_REQ.version)  # pylint: disable=E1103
-    if _REQ_VER >= LooseVersion('0.8.8'):
-        SSL_ENABLED = True
-    if _REQ_VER >= LooseVersion('0.7.0') and _REQ_VER < LooseVersion('1.0.0'):
-        CONFIG_ENABLED = True
-except:
-    pass
+# Requests (and what the installed version of it supports) is only looked
+# up when a url is first read, since importing it is fairly slow and most
+# runs of cloud-init (after the first boot) never read a url.
+_FEATURES = {}
+
+# Urls are read using keep-alive sessions that are shared by the whole
+# process, one for each scheme, host and ssl details (so reading many urls
+# from the same host, like the ec2 metadata, reuses a few connections).
+# At most this many sessions are kept (the least recently used session is
+# dropped to make room for a new one, and closed once nothing is using
+# it)...
+MAX_SESSIONS = 8
+
+# ...each keeping at most this many connections open
+MAX_POOL_SIZE = 10
+
+_SESSIONS = {}
+_SESSIONS_USED = []
+_SESSIONS_LOCK = threading.Lock()
+
+# Responses with these codes may say when to try again (with Retry-After)
+RETRY_AFTER_CODES = (429, 503)
+
+# When reading a url as a stream its body is read this much at a time and
+# kept in memory until it gets bigger than SPOOL_THRESHOLD (after which it
+# is spooled to a temporary file)
+READ_CHUNK_SIZE = 64 * 1024
+SPOOL_THRESHOLD = 1024 * 1024
+
+
+def _requests_features():
+    if not _FEATURES:
+        import requests
+        from distutils.version import LooseVersion
+        req_ver = LooseVersion(getattr(requests, '__version__', '0'))
+        _FEATURES.update({
+            # Check if requests has ssl support (added in requests >= 0.8.8)
+            'ssl': req_ver >= LooseVersion('0.8.8'),
+            # This was added in 0.7 (but taken out in >=1.0)
+            'config': (req_ver >= LooseVersion('0.7.0') and
+                       req_ver < LooseVersion('1.0.0')),
+            # Transport adapters (and their pool sizes) appeared in 1.0
+            'adapters': req_ver >= LooseVersion('1.0.0'),
+            # Sessions appeared in 0.6
+            'sessions': hasattr(requests, 'session'),
+        })
+    return _FEATURES
+
+
+def _close_session(session):
+    closer = getattr(session, 'close', None)
+    if closer is None:
+        return
+    try:
+        closer()
+    except Exception:
+        LOG.debug("Failed closing url session %s", session, exc_info=True)
+
+
+class _PooledSession(object):
+    # A shared session and how many reads are using it, once it is no
+    # longer pooled it is closed by whichever of those finishes last
+    def __init__(self, session):
+        self.session = session
+        self.users = 0
+        self.pooled = True
+
+
+def _make_session(scheme):
+    import requests
+    features = _requests_features()
+    if features['config']:
+        return requests.session(config={
+            'store_cookies': False,
+            'keep_alive': True,
+            'pool_maxsize': MAX_POOL_SIZE,
+        })
+    session = requests.session()
+    # Nothing read should influence what is read next (and the session is
+    # shared by reads that run at the same time) so no cookies are kept
+    session.cookies.set_policy(cookielib.DefaultCookiePolicy(
+        allowed_domains=[]))
+    if features['adapters']:
+        from requests import adapters
+        session.mount("%s://" % (scheme),
+                      adapters.HTTPAdapter(pool_connections=1,
+                                           pool_maxsize=MAX_POOL_SIZE))
+    return session
+
+
+def _unpool(pooled):
+    # Called with the lock held, returns the session if it can be closed now
+    pooled.pooled = False
+    if pooled.users == 0:
+        return pooled.session
+    return None
+
+
+def _acquire_session(url, req_args):
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc,  # pylint: disable=E1101
+           str(req_args.get('verify')), str(req_args.get('cert')))
+    to_close = []
+    with _SESSIONS_LOCK:
+        if key in _SESSIONS:
+            _SESSIONS_USED.remove(key)
+        else:
+            while len(_SESSIONS_USED) >= MAX_SESSIONS:
+                to_close.append(_unpool(_SESSIONS.pop(_SESSIONS_USED.pop(0))))
+            _SESSIONS[key] = _PooledSession(_make_session(key[0]))
+        _SESSIONS_USED.append(key)
+        pooled = _SESSIONS[key]
+        pooled.users += 1
+    for session in to_close:
+        if session is not None:
+            _close_session(session)
+    return pooled
+
+
+def _release_session(pooled):
+    with _SESSIONS_LOCK:
+        pooled.users -= 1
+        closeable = not pooled.pooled and pooled.users == 0
+    if closeable:
+        _close_session(pooled.session)
+
+
+def close_sessions():
+    """
+    Closes the shared url sessions (and their connections), sessions that
+    are being used are closed when the reads using them finish.
+    """
+    with _SESSIONS_LOCK:
+        sessions = [_unpool(pooled) for pooled in _SESSIONS.values()]
+        _SESSIONS.clear()
+        del _SESSIONS_USED[:]
+    for session in sessions:
+        if session is not None:
+            _close_session(session)
+
+
+class RetryPolicy(object):
+    """
+    How often (and for how long) something is tried: at most max_attempts
+    times and not past deadline seconds after the first try (either can be
+    None, for no limit). The delay before a retry grows exponentially from
+    base_delay up to max_delay and (with full jitter) a random delay of up
+    to that is used, so many instances that failed at the same time do not
+    all retry at the same time. A Retry-After given with a 429 or 503
+    response makes the delay at least that long (up to max_delay).
+    """
+
+    def __init__(self, max_attempts=None, deadline=None, base_delay=1.0,
+                 max_delay=30.0, jitter=True):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = max(0.0, float(base_delay))
+        self.max_delay = max(self.base_delay, float(max_delay))
+        self.jitter = jitter
+
+    def __str__(self):
+        return ("<%s max_attempts=%s deadline=%s delay=%s..%s jitter=%s>"
+                % (self.__class__.__name__, self.max_attempts, self.deadline,
+                   self.base_delay, self.max_delay, self.jitter))
+
+    def start(self):
+        return RetryState(self)
+
+
+class RetryState(object):
+    """The tries made so far using a retry policy."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.started = time.time()
+        self.attempts = 0
+
+    def attempted(self):
+        self.attempts += 1
+        return self.attempts
+
+    def remaining(self):
+        if self.policy.deadline is None:
+            return None
+        return self.policy.deadline - (time.time() - self.started)
+
+    def timeout(self, timeout):
+        # Requests are not to run past the deadline
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        remaining = max(remaining, 0.1)
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def next_delay(self, retry_after=None):
+        """
+        Returns how long to wait before trying again (or None when it is not
+        to be tried again).
+        """
+        policy = self.policy
+        if policy.max_attempts is not None and (self.attempts >=
+                                                policy.max_attempts):
+            return None
+        exp = max(self.attempts - 1, 0)
+        delay = min(policy.max_delay, policy.base_delay * (2 ** min(exp, 32)))
+        if policy.jitter:
+            delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, policy.max_delay))
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
+
+
+def retry_policy_from_config(cfg):
+    """
+    Makes a retry policy from a dictionary (like the 'retry_policy' of a
+    datasource config) with any of the keys 'max_attempts', 'deadline',
+    'base_delay', 'max_delay' and 'jitter', returns None if there is none.
+    """
+    if not cfg:
+        return None
+    if not isinstance(cfg, dict):
+        LOG.warn("Ignoring retry policy %r that is not a dictionary", cfg)
+        return None
+    kwargs = {}
+    try:
+        for (name, conv) in [('max_attempts', int), ('deadline', float),
+                             ('base_delay', float), ('max_delay', float)]:
+            if cfg.get(name) is not None:
+                kwargs[name] = conv(cfg[name])
+    except (TypeError, ValueError) as e:
+        LOG.warn("Ignoring invalid retry policy %r: %s", cfg, e)
+        return None
+    if 'jitter' in cfg:
+        kwargs['jitter'] = str(cfg['jitter']).lower() not in ('false', '0',
+                                                              'no', 'off')
+    return RetryPolicy(**kwargs)
+
+
+def _retry_after(code, headers):
+    # Seconds to wait (given as seconds or an http date), if said
+    if code not in RETRY_AFTER_CODES or not headers:
+        return None
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import (mktime_tz, parsedate_tz)
+    parsed = parsedate_tz(value)
+    if not parsed:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
 
 
 def _cleanurl(url):
@@ -64,12 +310,31 @@ def _cleanurl(url):
 
 
 class UrlResponse(object):
-    def __init__(self, response):
+    def __init__(self, response, body=None):
         self._response = response
+        # The spooled body (when the url was read as a stream)
+        self._body = body
 
     @property
     def contents(self):
-        return self._response.content
+        if self._body is None:
+            return self._response.content
+        self._body.seek(0)
+        return self._body.read()
+
+    @property
+    def size(self):
+        if self._body is None:
+            return len(self._response.content)
+        self._body.seek(0, 2)
+        return self._body.tell()
+
+    def open(self):
+        """A file object with the body (positioned at its start)."""
+        if self._body is None:
+            return StringIO(self._response.content)
+        self._body.seek(0)
+        return self._body
 
     @property
     def url(self):
@@ -106,16 +371,60 @@ class UrlError(IOError):
             self.headers = {}
 
 
+def _spool(url, response, max_bytes):
+    # Reads the body a chunk at a time (decoding any gzip content-encoding)
+    code = response.status_code
+    length = response.headers.get('Content-Length')
+    if (max_bytes is not None and length and length.isdigit()
+        and int(length) > max_bytes):
+        response.close()
+        raise UrlError(ValueError("%s is %s bytes, more than the %s bytes"
+                                  " allowed" % (url, length, max_bytes)),
+                       code=code, headers=response.headers)
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+    size = 0
+    try:
+        for chunk in response.iter_content(READ_CHUNK_SIZE):
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise UrlError(ValueError("%s returned more than the %s"
+                                          " bytes allowed" % (url,
+                                                              max_bytes)),
+                               code=code, headers=response.headers)
+            body.write(chunk)
+    except:
+        body.close()
+        raise
+    finally:
+        response.close()
+    body.seek(0)
+    return body
+
+
 def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
             headers=None, headers_cb=None, ssl_details=None,
-            check_status=True, allow_redirects=True):
+            check_status=True, allow_redirects=True, retry_policy=None,
+            stream=False, max_bytes=None):
+    """
+    Reads the url, retrying as often as retries says (sleeping sec_between
+    seconds before each retry) or as the given retry_policy says.
+
+    When stream is set (or max_bytes is given) the body is read a chunk
+    at a time and spooled to a temporary file once it gets big, more than
+    max_bytes of it (after any gzip content-encoding is decoded) fails the
+    read with a UrlError.
+    """
+    import requests
+    from requests import exceptions
+
+    features = _requests_features()
     url = _cleanurl(url)
     req_args = {
         'url': url,
     }
     scheme = urlparse(url).scheme  # pylint: disable=E1101
     if scheme == 'https' and ssl_details:
-        if not SSL_ENABLED:
+        if not features['ssl']:
             LOG.warn("SSL is not enabled, cert. verification can not occur!")
         else:
             if 'ca_certs' in ssl_details and ssl_details['ca_certs']:
@@ -130,6 +439,13 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
 
     req_args['allow_redirects'] = allow_redirects
     req_args['method'] = 'GET'
+    stream = stream or max_bytes is not None
+    if stream:
+        if features['adapters']:
+            req_args['stream'] = True
+        else:
+            # What stream was called before 1.0
+            req_args['prefetch'] = False
     if timeout is not None:
         req_args['timeout'] = max(float(timeout), 0)
     if data:
@@ -137,7 +453,7 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
     # It doesn't seem like config
     # was added in older library versions (or newer ones either), thus we
     # need to manually do the retries if it wasn't...
-    if CONFIG_ENABLED:
+    if features['config']:
         req_config = {
             'store_cookies': False,
         }
@@ -147,13 +463,21 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
         # if retries:
         #     req_config['max_retries'] = max(int(retries), 0)
         req_args['config'] = req_config
-    manual_tries = 1
-    if retries:
-        manual_tries = max(int(retries) + 1, 1)
-    if not headers:
-        headers = {
-            'User-Agent': 'Cloud-Init/%s' % (version.version_string()),
-        }
+    if retry_policy is None:
+        manual_tries = 1
+        if retries:
+            manual_tries = max(int(retries) + 1, 1)
+        if sec_between is None:
+            sec_between = 0
+        sec_between = max(0, sec_between)
+        retry_policy = RetryPolicy(max_attempts=manual_tries,
+                                   base_delay=sec_between,
+                                   max_delay=sec_between, jitter=False)
+    headers = dict(headers or {})
+    if 'User-Agent' not in headers:
+        headers['User-Agent'] = 'Cloud-Init/%s' % (version.version_string())
+    if 'Accept-Encoding' not in headers:
+        headers['Accept-Encoding'] = 'gzip'
     if not headers_cb:
         def _cb(url):
             return headers
@@ -162,14 +486,17 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
     if data:
         # Do this after the log (it might be large)
         req_args['data'] = data
-    if sec_between is None:
-        sec_between = -1
     excps = []
+    tries = retry_policy.start()
     # Handle retrying ourselves since the built-in support
     # doesn't handle sleeping between tries...
-    for i in range(0, manual_tries):
+    while True:
+        i = tries.attempted() - 1
+        retry_after = None
         try:
             req_args['headers'] = headers_cb(url)
+            if tries.remaining() is not None:
+                req_args['timeout'] = tries.timeout(req_args.get('timeout'))
             filtered_req_args = {}
             for (k, v) in req_args.items():
                 if k == 'data':
@@ -177,42 +504,128 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
                 filtered_req_args[k] = v
 
             LOG.debug("[%s/%s] open '%s' with %s configuration", i,
-                      manual_tries, url, filtered_req_args)
-
-            r = requests.request(**req_args)
-            if check_status:
-                r.raise_for_status()  # pylint: disable=E1103
-            LOG.debug("Read from %s (%s, %sb) after %s attempts", url,
-                      r.status_code, len(r.content),  # pylint: disable=E1103
-                      (i + 1))
-            # Doesn't seem like we can make it use a different
-            # subclass for responses, so add our own backward-compat
-            # attrs
-            return UrlResponse(r)
+                      retry_policy.max_attempts, url, filtered_req_args)
+
+            pooled = None
+            request = requests.request
+            if features['sessions']:
+                # The session is not closed until this read is done with it
+                # (which is after the body of a streamed read was read)
+                pooled = _acquire_session(url, req_args)
+                request = pooled.session.request
+            try:
+                r = request(**req_args)
+                if not check_status and r.status_code in RETRY_AFTER_CODES:
+                    delay = tries.next_delay(_retry_after(r.status_code,
+                                                          r.headers))
+                    if delay is not None:
+                        LOG.debug("Read from %s returned %s, trying again"
+                                  " in %.2f seconds", url, r.status_code,
+                                  delay)
+                        time.sleep(delay)
+                        continue
+                if check_status:
+                    r.raise_for_status()  # pylint: disable=E1103
+                body = None
+                if stream:
+                    body = _spool(url, r, max_bytes)
+                resp = UrlResponse(r, body)
+                LOG.debug("Read from %s (%s, %sb) after %s attempts", url,
+                          resp.code, resp.size, (i + 1))
+                # Doesn't seem like we can make it use a different
+                # subclass for responses, so add our own backward-compat
+                # attrs
+                return resp
+            finally:
+                if pooled is not None:
+                    _release_session(pooled)
         except exceptions.RequestException as e:
             if (isinstance(e, (exceptions.HTTPError))
                 and hasattr(e, 'response')  # This appeared in v 0.10.8
                 and hasattr(e.response, 'status_code')):
                 excps.append(UrlError(e, code=e.response.status_code,
                                       headers=e.response.headers))
+                retry_after = _retry_after(e.response.status_code,
+                                           e.response.headers)
             else:
                 excps.append(UrlError(e))
-                if SSL_ENABLED and isinstance(e, exceptions.SSLError):
+                if features['ssl'] and isinstance(e, exceptions.SSLError):
                     # ssl exceptions are not going to get fixed by waiting a
                     # few seconds
                     break
-            if i + 1 < manual_tries and sec_between > 0:
-                LOG.debug("Please wait %s seconds while we wait to try again",
-                          sec_between)
-                time.sleep(sec_between)
+            delay = tries.next_delay(retry_after)
+            if delay is None:
+                break
+            if delay > 0:
+                LOG.debug("Please wait %.2f seconds while we wait to try"
+                          " again", delay)
+                time.sleep(delay)
     if excps:
         raise excps[-1]
     return None  # Should throw before this...
 
 
+def _probe_url(url, headers_cb, timeout):
+    # Returns why the url is not usable (or None when it is)
+    try:
+        if headers_cb is not None:
+            headers = headers_cb(url)
+        else:
+            headers = {}
+        response = readurl(url, headers=headers, timeout=timeout,
+                           check_status=False)
+        if not response.contents:
+            reason = "empty response [%s]" % (response.code)
+            return (reason, UrlError(ValueError(reason), code=response.code,
+                                     headers=response.headers))
+        elif not response.ok():
+            reason = "bad status code [%s]" % (response.code)
+            return (reason, UrlError(ValueError(reason), code=response.code,
+                                     headers=response.headers))
+        return (None, None)
+    except UrlError as e:
+        return ("request error [%s]" % e, e)
+    except Exception as e:
+        return ("unexpected error [%s]" % e, e)
+
+
+def _race_urls(urls, headers_cb, timeout):
+    """
+    Probes all the urls at the same time, yielding (url, reason, exception)
+    for each url as its probe finishes (probes that finish together are
+    yielded in the order the urls are listed in). Probes still running once
+    the caller stops iterating are abandoned.
+    """
+    finished = Queue()
+
+    def probe(i, url):
+        finished.put((i, _probe_url(url, headers_cb, timeout)))
+
+    pool = workers.Pool(len(urls), name='url-race')
+    try:
+        for (i, url) in enumerate(urls):
+            pool.submit(probe, i, url)
+        remaining = len(urls)
+        while remaining:
+            try:
+                done = [finished.get(True, 1)]
+            except Empty:
+                continue
+            while True:
+                try:
+                    done.append(finished.get_nowait())
+                except Empty:
+                    break
+            remaining -= len(done)
+            for (i, (reason, e)) in sorted(done, key=lambda d: d[0]):
+                yield (urls[i], reason, e)
+    finally:
+        pool.shutdown(wait=False, cancel_pending=True)
+
+
 def wait_for_url(urls, max_wait=None, timeout=None,
                  status_cb=None, headers_cb=None, sleep_time=1,
-                 exception_cb=None):
+                 exception_cb=None, race=False, retry_policy=None):
     """
     urls:      a list of urls to try
     max_wait:  roughly the maximum time to wait before giving up
@@ -224,6 +637,15 @@ def wait_for_url(urls, max_wait=None, timeout=None,
                 for request.
     exception_cb: call method with 2 arguments 'msg' (per status_cb) and
                   'exception', the exception that occurred.
+    race:      try all the urls at the same time (instead of one after the
+               other) each round, the first url found to be usable is
+               returned (the first listed of those found at the same time)
+               and the rest are abandoned. So a url that does not respond
+               does not hold up trying the others (and the max time is
+               *actually* about timeout for each round).
+    retry_policy: decides how long to sleep between rounds (instead of
+                  sleeping a second more every 5 rounds) and when to give
+                  up (as well as max_wait).
 
     the idea of this routine is to wait for the EC2 metdata service to
     come up.  On both Eucalyptus and EC2 we have seen the case where
@@ -252,10 +674,34 @@ def wait_for_url(urls, max_wait=None, timeout=None,
         return ((max_wait <= 0 or max_wait is None) or
                 (time.time() - start_time > max_wait))
 
+    retry_after = []
+
+    def report(url, reason, e):
+        if isinstance(e, UrlError):
+            retry_after.append(_retry_after(e.code, e.headers))
+        time_taken = int(time.time() - start_time)
+        status_msg = "Calling '%s' failed [%s/%ss]: %s" % (url,
+                                                           time_taken,
+                                                           max_wait,
+                                                           reason)
+        status_cb(status_msg)
+        if exception_cb:
+            # This can be used to alter the headers that will be sent
+            # in the future, for example this is what the MAAS datasource
+            # does.
+            exception_cb(msg=status_msg, exception=e)
+
+    tries = None
+    if retry_policy is not None:
+        tries = retry_policy.start()
+
     loop_n = 0
     while True:
         sleep_time = int(loop_n / 5) + 1
-        for url in urls:
+        del retry_after[:]
+        if tries is not None:
+            tries.attempted()
+        if race and urls:
             now = time.time()
             if loop_n != 0:
                 if timeup(max_wait, start_time):
@@ -263,46 +709,32 @@ def wait_for_url(urls, max_wait=None, timeout=None,
                 if timeout and (now + timeout > (start_time + max_wait)):
                     # shorten timeout to not run way over max_time
                     timeout = int((start_time + max_wait) - now)
-
-            reason = ""
-            e = None
-            try:
-                if headers_cb is not None:
-                    headers = headers_cb(url)
-                else:
-                    headers = {}
-
-                response = readurl(url, headers=headers, timeout=timeout,
-                                   check_status=False)
-                if not response.contents:
-                    reason = "empty response [%s]" % (response.code)
-                    e = UrlError(ValueError(reason),
-                                 code=response.code, headers=response.headers)
-                elif not response.ok():
-                    reason = "bad status code [%s]" % (response.code)
-                    e = UrlError(ValueError(reason),
-                                 code=response.code, headers=response.headers)
-                else:
+            for (url, reason, e) in _race_urls(urls, headers_cb, timeout):
+                if reason is None:
+                    return url
+                report(url, reason, e)
+        else:
+            for url in urls:
+                now = time.time()
+                if loop_n != 0:
+                    if timeup(max_wait, start_time):
+                        break
+                    if timeout and (now + timeout > (start_time + max_wait)):
+                        # shorten timeout to not run way over max_time
+                        timeout = int((start_time + max_wait) - now)
+
+                (reason, e) = _probe_url(url, headers_cb, timeout)
+                if reason is None:
                     return url
-            except UrlError as e:
-                reason = "request error [%s]" % e
-            except Exception as e:
-                reason = "unexpected error [%s]" % e
-
-            time_taken = int(time.time() - start_time)
-            status_msg = "Calling '%s' failed [%s/%ss]: %s" % (url,
-                                                               time_taken,
-                                                               max_wait,
-                                                               reason)
-            status_cb(status_msg)
-            if exception_cb:
-                # This can be used to alter the headers that will be sent
-                # in the future, for example this is what the MAAS datasource
-                # does.
-                exception_cb(msg=status_msg, exception=e)
+                report(url, reason, e)
 
         if timeup(max_wait, start_time):
             break
+        if tries is not None:
+            sleep_time = tries.next_delay(max([0] + [r for r in retry_after
+                                                     if r is not None]))
+            if sleep_time is None:
+                break
 
         loop_n = loop_n + 1
         LOG.debug("Please wait %s seconds while we wait to try again",
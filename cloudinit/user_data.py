@@ -22,17 +22,18 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import os
-
-import email
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import re
+import threading
+import time
 
 from cloudinit import handlers
 from cloudinit import log as logging
+from cloudinit import timing
 from cloudinit import util
-from cloudinit.url_helper import UrlError
+from cloudinit import workers
+from cloudinit.url_helper import (RetryPolicy, UrlError)
 
 LOG = logging.getLogger(__name__)
 
@@ -58,18 +59,285 @@ ATTACHMENT_FIELD = 'Number-Attachments'
 # in there payload, evey other content type can still provide a header
 EXAMINE_FOR_LAUNCH_INDEX = ["text/cloud-config"]
 
+# The urls of an include part are fetched at the same time (at most this
+# many at once) and then processed in the order they were listed in
+MAX_INCLUDE_WORKERS = 8
+
+# What all the includes (nested or not) of a user-data blob may add up to,
+# includes past any of these are skipped
+MAX_INCLUDES = 64
+MAX_INCLUDE_BYTES = 16 * 1024 * 1024
+MAX_INCLUDE_SECONDS = 300
+
+# How often an include url is tried (within the time left)
+INCLUDE_ATTEMPTS = 11
+
+# What the include urls kept (to be asked for conditionally on later
+# boots) may add up to, the least recently used ones are dropped past it
+MAX_INCLUDE_CACHE_BYTES = 8 * 1024 * 1024
+INCLUDE_CACHE_INDEX = 'index.json'
+
+# Payloads of parts written by write_parts that are not just these
+# characters are base64 encoded
+PLAIN_PAYLOAD = re.compile(r'^[\t\n\x20-\x7e]*$')
+# Headers of a part that write_parts sets itself
+PART_SKIP_HEADERS = ['content-type', 'content-transfer-encoding',
+                     'mime-version']
+
+
+class IncludeBudget(object):
+    """What the includes of one user-data blob may still fetch."""
+
+    def __init__(self, max_count=MAX_INCLUDES, max_bytes=MAX_INCLUDE_BYTES,
+                 max_seconds=MAX_INCLUDE_SECONDS):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.started = time.time()
+        self.count = 0
+        self.size = 0
+
+    def time_left(self):
+        return self.max_seconds - (time.time() - self.started)
+
+    def bytes_left(self):
+        return max(0, self.max_bytes - self.size)
+
+    def take(self, url):
+        if self.count >= self.max_count:
+            LOG.warn("Not including %s, already included %s urls",
+                     url, self.count)
+            return False
+        if self.time_left() <= 0:
+            LOG.warn("Not including %s, includes already took more than %s"
+                     " seconds", url, self.max_seconds)
+            return False
+        self.count += 1
+        return True
+
+    def take_bytes(self, url, size):
+        if self.size + size > self.max_bytes:
+            LOG.warn("Not including %s (%s bytes), includes would add up to"
+                     " more than %s bytes", url, size, self.max_bytes)
+            return False
+        self.size += size
+        return True
+
+
+class IncludeCache(object):
+    """
+    Keeps what include urls returned along with the validators (the ETag
+    and Last-Modified headers) they were returned with, so that they can
+    be asked for conditionally later on (a 304 means what was kept can be
+    used). The least recently used urls are dropped once what is kept adds
+    up to more than max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=MAX_INCLUDE_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._index = None
+        self._dirty = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {
+                'hits': 0,
+                'misses': 0,
+                'evicted': 0,
+            }
+
+    def _index_fn(self):
+        return os.path.join(self.cache_dir, INCLUDE_CACHE_INDEX)
+
+    def _entry_fn(self, url):
+        return os.path.join(self.cache_dir, util.hash_blob(url, 'sha1'))
+
+    def _load(self):
+        if self._index is not None:
+            return self._index
+        index = {}
+        try:
+            index = json.loads(util.load_file(self._index_fn(), quiet=True)
+                               or '{}')
+        except (IOError, OSError, ValueError):
+            LOG.warn("Ignoring the invalid include cache index %s",
+                     self._index_fn())
+        if not isinstance(index, dict):
+            index = {}
+        self._index = index
+        return self._index
+
+    def _drop(self, url):
+        self._load().pop(url, None)
+        util.del_file(self._entry_fn(url))
+        self._dirty = True
+
+    def _evict(self):
+        index = self._load()
+        total = sum([e.get('size', 0) for e in index.values()])
+        by_use = sorted(index.items(), key=lambda e: e[1].get('used', 0))
+        for (url, entry) in by_use:
+            if total <= self.max_bytes:
+                break
+            LOG.debug("Dropping %s (%s bytes) from the include cache", url,
+                      entry.get('size', 0))
+            total -= entry.get('size', 0)
+            self._drop(url)
+            self.stats['evicted'] += 1
+
+    def validators(self, url):
+        """The headers to ask for url with (only if it was modified)."""
+        headers = {}
+        with self._lock:
+            entry = self._load().get(url)
+        if not entry:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get(self, url):
+        """
+        A file object with what was kept for url (None if nothing usable
+        was), which the caller closes.
+        """
+        with self._lock:
+            if url not in self._load():
+                return None
+            try:
+                body = open(self._entry_fn(url), 'rb')
+            except (IOError, OSError):
+                self._drop(url)
+                return None
+            self._index[url]['used'] = time.time()
+            self._dirty = True
+            self.stats['hits'] += 1
+            return body
+
+    def put(self, url, body, headers):
+        """
+        Keeps what url returned (the seekable file object body has) if it
+        can be validated later.
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        size = util.stream_size(body)
+        with self._lock:
+            self.stats['misses'] += 1
+            if url in self._load():
+                self._drop(url)
+            if not (etag or last_modified) or size > self.max_bytes:
+                return False
+            try:
+                util.write_stream(self._entry_fn(url), body, mode=0600)
+            except (IOError, OSError):
+                util.logexc(LOG, "Failed keeping %s in the include cache",
+                            url)
+                return False
+            self._index[url] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'size': size,
+                'used': time.time(),
+            }
+            self._dirty = True
+            self._evict()
+            return True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return False
+            try:
+                util.write_file(self._index_fn(),
+                                json.dumps(self._index, sort_keys=True),
+                                mode=0600)
+            except (IOError, OSError):
+                util.logexc(LOG, "Failed writing the include cache index %s",
+                            self._index_fn())
+                return False
+            self._dirty = False
+            return True
+
 
 class UserDataProcessor(object):
-    def __init__(self, paths):
+    def __init__(self, paths, include_limits=None):
         self.paths = paths
         self.ssl_details = util.fetch_ssl_details(paths)
+        # Keyword arguments of the include budget of each processed blob
+        self.include_limits = include_limits or {}
+        self._budget = None
+        self._include_cache = None
+
+    def __getstate__(self):
+        # The include cache has a lock (which can't be pickled)
+        state = dict(self.__dict__)
+        state['_include_cache'] = None
+        return state
+
+    @property
+    def include_cache(self):
+        cache = getattr(self, '_include_cache', None)
+        if cache is None and self.paths is not None:
+            cache = IncludeCache(os.path.join(self.paths.get_cpath('data'),
+                                              'include-cache'))
+            self._include_cache = cache
+        return cache
 
     def process(self, blob):
+        from email.mime.multipart import MIMEMultipart
+
         accumulating_msg = MIMEMultipart()
-        self._process_msg(convert_string(blob), accumulating_msg)
+        for (count, msg) in enumerate(self._iter_messages(blob)):
+            accumulating_msg.attach(msg)
+            self._multi_part_count(accumulating_msg, count + 1)
         return accumulating_msg
 
-    def _process_msg(self, base_msg, append_msg):
+    def iter_parts(self, blob):
+        """
+        Yields the parts of blob (through its includes and archives) one
+        at a time as handlers.Part objects, the same parts process()
+        would attach, so that only the part being handled (and not all
+        of them) needs to be kept.
+        """
+        for (count, msg) in enumerate(self._iter_messages(blob)):
+            yield handlers.Part.from_message(msg, count)
+
+    def _iter_messages(self, blob):
+        self._budget = IncludeBudget(**self.include_limits)
+        cache = self.include_cache
+        if cache is not None:
+            cache.reset_stats()
+        start = time.time()
+        try:
+            count = 0
+            for msg in self._process_msg(convert_string(blob)):
+                count += 1
+                self._process_before_attach(msg, count)
+                yield msg
+        finally:
+            self._budget = None
+            if cache is not None:
+                cache.save()
+                self._record_cache_stats(cache, start)
+
+    def _record_cache_stats(self, cache, start):
+        stats = dict(cache.stats)
+        if not any(stats.values()):
+            return
+        name = 'include-cache'
+        if timing.current_name():
+            name = timing.SEP.join([timing.current_name(), name])
+        timing.record(name, start, time.time() - start, stats=stats)
+
+    def _process_msg(self, base_msg):
+        # Yields the parts to attach (in order) as they are found
         for part in base_msg.walk():
             if is_skippable(part):
                 continue
@@ -94,11 +362,13 @@ class UserDataProcessor(object):
                     part[CONTENT_TYPE] = ctype
 
             if ctype in INCLUDE_TYPES:
-                self._do_include(payload, append_msg)
+                for msg in self._do_include(payload):
+                    yield msg
                 continue
 
             if ctype in ARCHIVE_TYPES:
-                self._explode_archive(payload, append_msg)
+                for msg in self._explode_archive(payload):
+                    yield msg
                 continue
 
             # Should this be happening, shouldn't
@@ -108,7 +378,7 @@ class UserDataProcessor(object):
             else:
                 base_msg[CONTENT_TYPE] = ctype
 
-            self._attach_part(append_msg, part)
+            yield part
 
     def _attach_launch_index(self, msg):
         header_idx = msg.get('Launch-Index', None)
@@ -145,11 +415,75 @@ class UserDataProcessor(object):
                            'attachment', filename=PART_FN_TPL % (attached_id))
         self._attach_launch_index(msg)
 
-    def _do_include(self, content, append_msg):
+    def _fetch_include(self, include_url, include_once_on, budget):
+        # Returns a (seekable) file object with what the url has
+        include_once_fn = None
+        body = None
+        if include_once_on:
+            include_once_fn = self._get_include_once_filename(include_url)
+        if include_once_on and os.path.isfile(include_once_fn):
+            body = open(include_once_fn, 'rb')
+        elif budget.time_left() <= 0:
+            LOG.warn("Not including %s, includes already took more than %s"
+                     " seconds", include_url, budget.max_seconds)
+        else:
+            try:
+                policy = RetryPolicy(max_attempts=INCLUDE_ATTEMPTS,
+                                     deadline=budget.time_left(),
+                                     base_delay=1, max_delay=1,
+                                     jitter=False)
+                body = self._read_include(include_url, policy,
+                                          budget.bytes_left())
+                if include_once_on:
+                    util.write_stream(include_once_fn, body, mode=0600)
+            except UrlError as urle:
+                if urle.code is None or urle.code < 300:
+                    LOG.warn("Fetching from %s failed: %s", include_url,
+                             urle)
+                else:
+                    LOG.warn(("Fetching from %s resulted in"
+                              " a invalid http code of %s"),
+                             include_url, urle.code)
+            except IOError as ioe:
+                LOG.warn(("Fetching from %s resulted in an IOError: %s"),
+                         include_url, ioe.strerror)
+        return body
+
+    def _read_include(self, include_url, policy, max_bytes):
+        cache = self.include_cache
+        cached = (cache is not None and
+                  include_url.lower().startswith(('http://', 'https://')))
+        headers = None
+        if cached:
+            headers = cache.validators(include_url)
+        resp = util.read_file_or_url(include_url, headers=headers,
+                                     ssl_details=self.ssl_details,
+                                     retry_policy=policy,
+                                     max_bytes=max_bytes)
+        if cached and headers and resp.code == 304:
+            body = cache.get(include_url)
+            if body is not None:
+                return body
+            # What was kept is gone, so ask for all of it again
+            resp = util.read_file_or_url(include_url,
+                                         ssl_details=self.ssl_details,
+                                         retry_policy=policy,
+                                         max_bytes=max_bytes)
+        if not resp.ok():
+            raise UrlError(None, resp.code)
+        body = resp.open()
+        if cached:
+            cache.put(include_url, body, resp.headers)
+        return body
+
+    def _do_include(self, content):
         # Include a list of urls, one per line
         # also support '#include <url here>'
         # or #include-once '<url here>'
+        if self._budget is None:
+            self._budget = IncludeBudget(**self.include_limits)
         include_once_on = False
+        includes = []
         for line in content.splitlines():
             lc_line = line.lower()
             if lc_line.startswith("#include-once"):
@@ -168,37 +502,41 @@ class UserDataProcessor(object):
             include_url = line.strip()
             if not include_url:
                 continue
-
-            include_once_fn = None
-            content = None
-            if include_once_on:
-                include_once_fn = self._get_include_once_filename(include_url)
-            if include_once_on and os.path.isfile(include_once_fn):
-                content = util.load_file(include_once_fn)
-            else:
+            if self._budget.take(include_url):
+                includes.append((include_url, include_once_on))
+
+        if not includes:
+            return
+        # Fetched at the same time, but processed (which is where any nested
+        # includes are fetched) in the order listed
+        pool = workers.Pool(min(len(includes), MAX_INCLUDE_WORKERS),
+                            name='include')
+        try:
+            fetches = []
+            for (include_url, include_once_on) in includes:
+                fetches.append(pool.submit(self._fetch_include, include_url,
+                                           include_once_on, self._budget))
+            for ((include_url, _once), fetch) in zip(includes, fetches):
                 try:
-                    resp = util.read_file_or_url(include_url,
-                                                 ssl_details=self.ssl_details)
-
-                    if include_once_on and resp.ok():
-                        util.write_file(include_once_fn, str(resp), mode=0600)
-                    if resp.ok():
-                        content = str(resp)
-                    else:
-                        raise UrlError(None, resp.code)
-                except UrlError as urle:
-                    LOG.warn(("Fetching from %s resulted in"
-                              " a invalid http code of %s"),
-                             include_url, urle.code)
-                except IOError as ioe:
-                    LOG.warn(("Fetching from %s resulted in an IOError: %s"),
-                             include_url, ioe.strerror)
-
-            if content is not None:
-                new_msg = convert_string(content)
-                self._process_msg(new_msg, append_msg)
-
-    def _explode_archive(self, archive, append_msg):
+                    body = fetch.result()
+                except Exception:
+                    util.logexc(LOG, "Fetching from %s failed", include_url)
+                    continue
+                if body is None:
+                    continue
+                try:
+                    if not self._budget.take_bytes(include_url,
+                                                   util.stream_size(body)):
+                        continue
+                    new_msg = convert_string(body)
+                finally:
+                    body.close()
+                for msg in self._process_msg(new_msg):
+                    yield msg
+        finally:
+            pool.shutdown(wait=False, cancel_pending=True)
+
+    def _explode_archive(self, archive):
         entries = util.load_yaml(archive, default=[], allowed=(list, set))
         for ent in entries:
             # ent can be one of:
@@ -221,8 +559,10 @@ class UserDataProcessor(object):
 
             maintype, subtype = mtype.split('/', 1)
             if maintype == "text":
+                from email.mime.text import MIMEText
                 msg = MIMEText(content, _subtype=subtype)
             else:
+                from email.mime.base import MIMEBase
                 msg = MIMEBase(maintype, subtype)
                 msg.set_payload(content)
 
@@ -237,7 +577,7 @@ class UserDataProcessor(object):
                     continue
                 msg.add_header(header, ent[header])
 
-            self._attach_part(append_msg, msg)
+            yield msg
 
     def _multi_part_count(self, outer_msg, new_count=None):
         """
@@ -257,16 +597,6 @@ class UserDataProcessor(object):
             outer_msg.replace_header(ATTACHMENT_FIELD, str(fetched_count))
         return fetched_count
 
-    def _attach_part(self, outer_msg, part):
-        """
-        Attach a message to an outer message. outermsg must be a MIMEMultipart.
-        Modifies a header in the outer message to keep track of number of attachments.
-        """
-        part_count = self._multi_part_count(outer_msg)
-        self._process_before_attach(part, part_count + 1)
-        outer_msg.attach(part)
-        self._multi_part_count(outer_msg, part_count + 1)
-
 
 def is_skippable(part):
     # multipart/* are just containers
@@ -276,17 +606,23 @@ def is_skippable(part):
     return False
 
 
-# Coverts a raw string into a mime message
+# Coverts a raw string into a mime message (the email package is only
+# imported by what needs it since importing it is not cheap)
 def convert_string(raw_data, headers=None):
-    if not raw_data:
-        raw_data = ''
+    # The raw data may also be a (seekable) file object, which is then
+    # decoded a chunk at a time
     if not headers:
         headers = {}
-    # Some tools and users will base64 encode their data before handing it to
-    # an API like boto, which will base64 encode it again, so we try to decode.
-    data = util.decode_base64(raw_data)
-    data = util.decomp_gzip(data)
+    if hasattr(raw_data, 'read'):
+        data = util.decode_stream(raw_data)
+    else:
+        # Some tools and users will base64 encode their data before handing
+        # it to an API like boto, which will base64 encode it again, so we
+        # try to decode.
+        data = util.decode_base64(raw_data or '')
+        data = util.decomp_gzip(data)
     if "mime-version:" in data[0:4096].lower():
+        import email
         msg = email.message_from_string(data)
         for (key, val) in headers.iteritems():
             if key in msg:
@@ -296,6 +632,98 @@ def convert_string(raw_data, headers=None):
     else:
         mtype = headers.get(CONTENT_TYPE, NOT_MULTIPART_TYPE)
         maintype, subtype = mtype.split("/", 1)
+        from email.mime.base import MIMEBase
         msg = MIMEBase(maintype, subtype, *headers)
         msg.set_payload(data)
     return msg
+
+
+def _part_message(part, boundary):
+    from email import encoders
+    from email.mime.base import MIMEBase
+
+    try:
+        (maintype, subtype) = part.ctype.split('/', 1)
+    except (AttributeError, ValueError):
+        (maintype, subtype) = OCTET_TYPE.split('/', 1)
+    msg = MIMEBase(maintype, subtype)
+    for (key, val) in part.headers.items():
+        if key.lower() not in PART_SKIP_HEADERS:
+            msg[key] = val
+    payload = part.payload or ''
+    msg.set_payload(payload)
+    if not PLAIN_PAYLOAD.match(payload) or boundary in payload:
+        encoders.encode_base64(msg)
+    return msg
+
+
+def write_parts(parts, out_fh):
+    """
+    Writes the parts (handlers.Part objects) to out_fh as a multipart
+    message a part at a time (as they are yielded), returning how many
+    parts were written.
+    """
+    from email.generator import Generator
+
+    boundary = "===============%s==" % (util.rand_str(20))
+    out_fh.write('Content-Type: multipart/mixed; boundary="%s"\n'
+                 'MIME-Version: 1.0\n\n' % (boundary))
+    gen = Generator(out_fh, mangle_from_=False)
+    count = 0
+    for part in parts:
+        out_fh.write("--%s\n" % (boundary))
+        gen.flatten(_part_message(part, boundary))
+        # The line break before a boundary belongs to the boundary
+        out_fh.write("\n")
+        count += 1
+    out_fh.write("--%s--\n" % (boundary))
+    return count
+
+
+def read_parts(in_fh):
+    """
+    Yields the parts (as handlers.Part objects) of a multipart message
+    (like those write_parts writes) one at a time, reading in_fh a line
+    at a time.
+    """
+    import email
+    from email.parser import HeaderParser
+
+    head = []
+    for line in in_fh:
+        if not line.strip("\r\n"):
+            break
+        head.append(line)
+    boundary = HeaderParser().parsestr("".join(head)).get_boundary()
+    if not boundary:
+        # Not multipart, so there is just the one part
+        msg = email.message_from_string("".join(head) + "\n" +
+                                        in_fh.read())
+        for part in handlers.message_parts(msg):
+            yield part
+        return
+
+    delimiter = "--%s" % (boundary)
+    lines = None
+    partnum = 0
+    for line in in_fh:
+        stripped = line.rstrip()
+        if stripped not in (delimiter, delimiter + "--"):
+            if lines is not None:
+                lines.append(line)
+            continue
+        if lines is not None:
+            text = "".join(lines)
+            lines = None
+            if text.endswith("\r\n"):
+                text = text[:-2]
+            elif text.endswith("\n"):
+                text = text[:-1]
+            msg = email.message_from_string(text)
+            text = None
+            for part in handlers.message_parts(msg, partnum):
+                partnum += 1
+                yield part
+        if stripped != delimiter:
+            break
+        lines = []
@@ -27,6 +27,7 @@
 from StringIO import StringIO
 
 import base64
+import cPickle as pickle
 import contextlib
 import copy as obj_copy
 import errno
@@ -34,6 +35,8 @@ import glob
 import grp
 import gzip
 import hashlib
+import httplib
+import json
 import os
 import platform
 import pwd
@@ -46,25 +49,39 @@ import string  # pylint: disable=W0402
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urlparse
 
-import yaml
-
 from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import mergers
-from cloudinit import safeyaml
 from cloudinit import type_utils
 from cloudinit import url_helper
 from cloudinit import version
+from cloudinit import workers
 
 from cloudinit.settings import (CFG_BUILTIN)
 
 
 _DNS_REDIRECT_IP = None
+_DNS_REDIRECT_LOCK = threading.Lock()
 LOG = logging.getLogger(__name__)
 
+# How mirrors can be probed when searching for one (and for how long)
+MIRROR_PROBE_RESOLVE = 'resolve'
+MIRROR_PROBE_CONNECT = 'connect'
+MIRROR_PROBE_HEAD = 'head'
+MIRROR_PROBES = (MIRROR_PROBE_RESOLVE, MIRROR_PROBE_CONNECT, MIRROR_PROBE_HEAD)
+MIRROR_SEARCH_DEADLINE = 5
+MIRROR_SEARCH_WORKERS = 8
+
+# Parsed yaml is kept for at most this many blobs (which add up to at most
+# this many bytes of yaml), the least recently used are dropped past it
+YAML_CACHE_MAX_ENTRIES = 256
+YAML_CACHE_MAX_BYTES = 4 * 1024 * 1024
+YAML_CACHE_VERSION = 1
+
 # Helps cleanup filenames to ensure they aren't FS incompatible
 FN_REPLACEMENTS = {
     os.sep: '_',
@@ -77,6 +94,14 @@ CONTAINER_TESTS = ['running-in-container', 'lxc-is-container']
 # An imperfect, but close enough regex to detect Base64 encoding
 BASE64 = re.compile('^[A-Za-z0-9+/\-_\n]+=?=?$')
 
+# What each chunk of a base64 stream can have (padding only at its end)
+BASE64_CHUNK = re.compile('^[A-Za-z0-9+/\-_]*=?=?$')
+
+# Streams are decoded this much at a time (and what they decode to is
+# spooled to a temporary file once it gets bigger than SPOOL_THRESHOLD)
+DECODE_CHUNK_SIZE = 64 * 1024
+SPOOL_THRESHOLD = 1024 * 1024
+
 # Made to have same accessors as UrlResponse so that the
 # read_file_or_url can return this or that object and the
 # 'user' of those objects will not need to know the difference.
@@ -92,6 +117,13 @@ class StringResponse(object):
             return False
         return True
 
+    @property
+    def size(self):
+        return len(self.contents)
+
+    def open(self):
+        return StringIO(self.contents)
+
     def __str__(self):
         return self.contents
 
@@ -190,6 +222,128 @@ class SeLinuxGuard(object):
                 self.selinux.restorecon(path, recursive=self.recursive)
 
 
+class YamlCache(object):
+    """
+    Keeps what yaml blobs parsed into (by the sha1 of the blob) so that
+    the same blob is only parsed once within a process and, when a file
+    is set, between processes (so the later stages can reuse what the
+    earlier ones parsed). What is kept is never handed out, only copies
+    of it are (so callers are free to alter what they are given).
+    """
+
+    def __init__(self, max_entries=YAML_CACHE_MAX_ENTRIES,
+                 max_bytes=YAML_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.fn = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._loaded = True
+        self._dirty = False
+
+    def set_file(self, fn):
+        with self._lock:
+            self.fn = fn
+            self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.fn or not os.path.isfile(self.fn):
+            return
+        try:
+            with open(self.fn, 'rb') as fh:
+                cached = pickle.load(fh)
+            if cached['version'] != YAML_CACHE_VERSION:
+                return
+            for (key, entry) in cached['entries'].iteritems():
+                self._entries.setdefault(key, entry)
+        except Exception as e:
+            LOG.debug("Ignoring the yaml cache %s: %s", self.fn, e)
+            return
+        self._evict()
+
+    def _evict(self):
+        total = sum([e['size'] for e in self._entries.values()])
+        by_use = sorted(self._entries.items(), key=lambda e: e[1]['used'])
+        for (key, entry) in by_use:
+            if (len(self._entries) <= self.max_entries and
+                total <= self.max_bytes):
+                break
+            total -= entry['size']
+            del self._entries[key]
+            self._dirty = True
+
+    def load(self, blob, loader):
+        """
+        Returns a copy of what blob parsed into (parsing it with loader
+        only if it has not been parsed already).
+        """
+        key = hash_blob(blob, 'sha1')
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.stats['hits'] += 1
+                entry['used'] = time.time()
+                self._dirty = True
+        if entry is None:
+            entry = {
+                'obj': loader(blob),
+                'size': len(blob),
+                'used': time.time(),
+            }
+            with self._lock:
+                self.stats['misses'] += 1
+                if entry['size'] <= self.max_bytes:
+                    self._entries[key] = entry
+                    self._dirty = True
+                    self._evict()
+        return obj_copy.deepcopy(entry['obj'])
+
+    def save(self):
+        with self._lock:
+            if not self.fn or not self._dirty:
+                return False
+            self._load()
+            contents = {
+                'version': YAML_CACHE_VERSION,
+                'entries': self._entries,
+            }
+            try:
+                write_file(self.fn, pickle.dumps(contents,
+                                                 pickle.HIGHEST_PROTOCOL),
+                           mode=0600)
+            except Exception:
+                logexc(LOG, "Failed writing the yaml cache %s", self.fn)
+                return False
+            self._dirty = False
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._dirty = False
+
+
+_YAML_CACHE = YamlCache()
+
+
+def set_yaml_cache_file(fn):
+    # Where parsed yaml is kept between processes (None to only keep it
+    # for this process)
+    _YAML_CACHE.set_file(fn)
+
+
+def save_yaml_cache():
+    return _YAML_CACHE.save()
+
+
 class MountFailedError(Exception):
     pass
 
@@ -353,6 +507,96 @@ def decomp_gzip(data, quiet=True):
             raise DecompressionError(str(e))
 
 
+def decode_base64_stream(in_fh, out_fh, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Base64 decodes what in_fh has into out_fh a chunk at a time, raising a
+    DecodingError (with some of it possibly written) if it is not base64.
+    """
+    left = ''
+    written = 0
+    while True:
+        data = in_fh.read(chunk_size)
+        if not data:
+            break
+        data = left + data.replace("\n", "")
+        if not data:
+            continue
+        if not BASE64_CHUNK.match(data):
+            raise DecodingError("Not base64 encoded")
+        # Whole groups of 4 (before any padding) decode the same on their
+        # own as they do as part of the whole
+        usable = data.find("=")
+        if usable == -1:
+            usable = len(data)
+        usable -= usable % 4
+        try:
+            decoded = base64.urlsafe_b64decode(data[0:usable])
+        except Exception as e:
+            raise DecodingError(str(e))
+        left = data[usable:]
+        out_fh.write(decoded)
+        written += len(decoded)
+    if left:
+        # Decoded like the whole string would be (leniently)
+        try:
+            decoded = base64.urlsafe_b64decode(left)
+        except Exception as e:
+            raise DecodingError(str(e))
+        out_fh.write(decoded)
+        written += len(decoded)
+    if not written:
+        raise DecodingError("Not base64 encoded")
+    return written
+
+
+def decomp_gzip_stream(in_fh, out_fh, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Decompresses what in_fh has into out_fh a chunk at a time, raising a
+    DecompressionError (with some of it possibly written) if it is not
+    gzip compressed.
+    """
+    written = 0
+    try:
+        with contextlib.closing(gzip.GzipFile(None, "rb", 1, in_fh)) as gh:
+            while True:
+                data = gh.read(chunk_size)
+                if not data:
+                    break
+                out_fh.write(data)
+                written += len(data)
+    except Exception as e:
+        raise DecompressionError(str(e))
+    return written
+
+
+def decode_stream(in_fh):
+    """
+    Reads what the (seekable) in_fh has, undoing any base64 encoding and
+    then any gzip compression of it a chunk at a time (so that only what
+    it decodes to is held in memory), like decode_base64 and decomp_gzip
+    do for strings.
+    """
+    fh = in_fh
+    for (decoder, errors) in [(decode_base64_stream, DecodingError),
+                              (decomp_gzip_stream, DecompressionError)]:
+        fh.seek(0)
+        out_fh = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        try:
+            decoder(fh, out_fh)
+        except errors:
+            out_fh.close()
+            continue
+        if fh is not in_fh:
+            fh.close()
+        fh = out_fh
+    try:
+        fh.seek(0)
+        return fh.read()
+    finally:
+        if fh is not in_fh:
+            fh.close()
+
+
 def extract_usergroup(ug_pair):
     if not ug_pair:
         return (None, None)
@@ -569,6 +813,9 @@ def mergemanydict(srcs, reverse=False):
     if reverse:
         srcs = reversed(srcs)
     merged_cfg = {}
+    # What is merged into is only ours until it is returned, so the parts
+    # of it that a merge copied are changed in place by the merges after it
+    session = mergers.MergeSession()
     for cfg in srcs:
         if cfg:
             # Figure out which mergers to apply...
@@ -576,7 +823,7 @@ def mergemanydict(srcs, reverse=False):
             if not mergers_to_apply:
                 mergers_to_apply = mergers.default_mergers()
             merger = mergers.construct(mergers_to_apply)
-            merged_cfg = merger.merge(merged_cfg, cfg)
+            merged_cfg = session.merge(merger, merged_cfg, cfg)
     return merged_cfg
 
 
@@ -694,7 +941,8 @@ def fetch_ssl_details(paths=None):
 
 def read_file_or_url(url, timeout=5, retries=10,
                      headers=None, data=None, sec_between=1, ssl_details=None,
-                     headers_cb=None):
+                     headers_cb=None, retry_policy=None, stream=False,
+                     max_bytes=None):
     url = url.lstrip()
     if url.startswith("/"):
         url = "file://%s" % url
@@ -702,6 +950,9 @@ def read_file_or_url(url, timeout=5, retries=10,
         if data:
             LOG.warn("Unable to post data to file resource %s", url)
         file_path = url[len("file://"):]
+        if max_bytes is not None and os.path.getsize(file_path) > max_bytes:
+            raise IOError(errno.EFBIG, "More than the %s bytes allowed"
+                          % (max_bytes), file_path)
         return FileResponse(file_path, contents=load_file(file_path))
     else:
         return url_helper.readurl(url,
@@ -711,17 +962,24 @@ def read_file_or_url(url, timeout=5, retries=10,
                                   headers_cb=headers_cb,
                                   data=data,
                                   sec_between=sec_between,
-                                  ssl_details=ssl_details)
+                                  ssl_details=ssl_details,
+                                  retry_policy=retry_policy,
+                                  stream=stream,
+                                  max_bytes=max_bytes)
 
 
 def load_yaml(blob, default=None, allowed=(dict,)):
+    # Yaml is only imported when first needed (it is slow to import)
+    import yaml
+    from cloudinit import safeyaml
+
     loaded = default
     try:
         blob = str(blob)
         LOG.debug(("Attempting to load yaml from string "
                  "of length %s with allowed root types %s"),
                  len(blob), allowed)
-        converted = safeyaml.load(blob)
+        converted = _YAML_CACHE.load(blob, safeyaml.load)
         if not isinstance(converted, allowed):
             # Yes this will just be caught, but thats ok for now...
             raise TypeError(("Yaml load allows %s root types,"
@@ -766,7 +1024,7 @@ def read_seeded(base="", ext="", timeout=5, retries=10, file_retries=0):
     return (md, ud)
 
 
-def read_conf_d(confd):
+def get_conf_d_files(confd):
     # Get reverse sorted list (later trumps newer)
     confs = sorted(os.listdir(confd), reverse=True)
 
@@ -777,18 +1035,22 @@ def read_conf_d(confd):
     confs = [f for f in confs
              if os.path.isfile(os.path.join(confd, f))]
 
+    return [os.path.join(confd, f) for f in confs]
+
+
+def read_conf_d(confd):
     # Load them all so that they can be merged
     cfgs = []
-    for fn in confs:
-        cfgs.append(read_conf(os.path.join(confd, fn)))
+    for fn in get_conf_d_files(confd):
+        cfgs.append(read_conf(fn))
 
     return mergemanydict(cfgs)
 
 
-def read_conf_with_confd(cfgfile):
-    cfg = read_conf(cfgfile)
-
-    confd = False
+def get_conf_d(cfgfile, cfg):
+    # Returns the conf.d directory that the already loaded
+    # configuration (from cfgfile) says should be used (if any)
+    confd = None
     if "conf_d" in cfg:
         confd = cfg['conf_d']
         if confd:
@@ -798,9 +1060,15 @@ def read_conf_with_confd(cfgfile):
                                  (cfgfile, type_utils.obj_name(confd)))
             else:
                 confd = str(confd).strip()
-    elif os.path.isdir("%s.d" % cfgfile):
+    else:
         confd = "%s.d" % cfgfile
+    return confd or None
+
 
+def read_conf_with_confd(cfgfile):
+    cfg = read_conf(cfgfile)
+
+    confd = get_conf_d(cfgfile, cfg)
     if not confd or not os.path.isdir(confd):
         return cfg
 
@@ -948,24 +1216,28 @@ def is_resolvable(name):
     the search list.
     """
     global _DNS_REDIRECT_IP  # pylint: disable=W0603
-    if _DNS_REDIRECT_IP is None:
-        badips = set()
-        badnames = ("does-not-exist.example.com.", "example.invalid.",
-                    rand_str())
-        badresults = {}
-        for iname in badnames:
-            try:
-                result = socket.getaddrinfo(iname, None, 0, 0,
-                    socket.SOCK_STREAM, socket.AI_CANONNAME)
-                badresults[iname] = []
-                for (_fam, _stype, _proto, cname, sockaddr) in result:
-                    badresults[iname].append("%s: %s" % (cname, sockaddr[0]))
-                    badips.add(sockaddr[0])
-            except (socket.gaierror, socket.error):
-                pass
-        _DNS_REDIRECT_IP = badips
-        if badresults:
-            LOG.debug("detected dns redirection: %s" % badresults)
+    # Mirrors are resolved at the same time, only detect the redirection
+    # once (and not while another thread is detecting it)
+    with _DNS_REDIRECT_LOCK:
+        if _DNS_REDIRECT_IP is None:
+            badips = set()
+            badnames = ("does-not-exist.example.com.", "example.invalid.",
+                        rand_str())
+            badresults = {}
+            for iname in badnames:
+                try:
+                    result = socket.getaddrinfo(iname, None, 0, 0,
+                        socket.SOCK_STREAM, socket.AI_CANONNAME)
+                    badresults[iname] = []
+                    for (_fam, _stype, _proto, cname, sockaddr) in result:
+                        badresults[iname].append("%s: %s" % (cname,
+                                                             sockaddr[0]))
+                        badips.add(sockaddr[0])
+                except (socket.gaierror, socket.error):
+                    pass
+            _DNS_REDIRECT_IP = badips
+            if badresults:
+                LOG.debug("detected dns redirection: %s" % badresults)
 
     try:
         result = socket.getaddrinfo(name, None)
@@ -988,19 +1260,157 @@ def is_resolvable_url(url):
     return (is_resolvable(urlparse.urlparse(url).hostname))
 
 
-def search_for_mirror(candidates):
+def _probe_mirror(cand, probe, timeout):
+    # Returns how long the probe of the mirror took (or None if the
+    # mirror is not usable)
+    start = time.time()
+    # Allow either a proper URL or a bare hostname / IP
+    if is_resolvable_url(cand):
+        pieces = urlparse.urlparse(cand)
+        host = pieces.hostname
+    elif is_resolvable(cand):
+        pieces = urlparse.urlparse("http://%s/" % (cand))
+        host = cand
+    else:
+        return None
+    if probe == MIRROR_PROBE_RESOLVE:
+        return time.time() - start
+    timeout = max(0.1, timeout - (time.time() - start))
+    default_port = 80
+    if pieces.scheme == 'https':
+        default_port = 443
+    port = pieces.port or default_port
+    if probe == MIRROR_PROBE_CONNECT:
+        sock = socket.create_connection((host, port), timeout)
+        sock.close()
+        return time.time() - start
+    if pieces.scheme == 'https':
+        conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+    else:
+        conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('HEAD', pieces.path or '/')
+        status = conn.getresponse().status
+    finally:
+        conn.close()
+    # Redirects are fine (mirrors often redirect to the directory)
+    if status >= 400:
+        LOG.debug("Mirror %s answered the probe with %s", cand, status)
+        return None
+    return time.time() - start
+
+
+def _probe_mirrors(candidates, probe, deadline):
+    # Probes all the candidates at the same time (until the deadline),
+    # returning the probe time (or None) of each candidate
+    def safe_probe(cand, timeout):
+        try:
+            return _probe_mirror(cand, probe, timeout)
+        except Exception as e:
+            LOG.debug("Probing mirror %s failed: %s", cand, e)
+            return None
+
+    end = time.time() + deadline
+    pool = workers.Pool(min(len(candidates), MIRROR_SEARCH_WORKERS),
+                        name='mirror-search')
+    try:
+        tasks = [pool.submit(safe_probe, cand, deadline)
+                 for cand in candidates]
+        latencies = []
+        for task in tasks:
+            if not task.wait(max(0, end - time.time())):
+                latencies.append(None)
+                continue
+            latencies.append(task.result())
+            # The first resolvable candidate (in the order given) wins
+            # when only resolving, no need to wait for the later ones
+            if probe == MIRROR_PROBE_RESOLVE and latencies[-1] is not None:
+                break
+        latencies.extend([None] * (len(candidates) - len(latencies)))
+        return latencies
+    finally:
+        # Lookups and connects still running are abandoned
+        pool.shutdown(wait=False, cancel_pending=True)
+
+
+def _load_mirror_cache(cache_fn):
+    if not cache_fn:
+        return {}
+    try:
+        cache = json.loads(load_file(cache_fn, quiet=True) or '{}')
+        if isinstance(cache, dict):
+            return cache
+    except (IOError, ValueError):
+        pass
+    return {}
+
+
+def _save_mirror_cache(cache_fn, cache):
+    # Only kept for the current instance (so if there is none
+    # yet, nothing is kept)
+    if not cache_fn or not os.path.isdir(os.path.dirname(cache_fn)):
+        return
+    try:
+        write_file(cache_fn, json.dumps(cache, sort_keys=True), mode=0644)
+    except (IOError, OSError) as e:
+        LOG.debug("Failed to save the mirror search to %s: %s", cache_fn, e)
+
+
+def search_for_mirror(candidates, probe=None, deadline=None, cache_fn=None):
     """
     Search through a list of mirror urls for one that works
     This needs to return quickly.
+
+    All of the candidates are probed at the same time (for at most
+    deadline seconds). With the 'resolve' probe (the default) the first
+    candidate (in the order given) that resolves is returned, with the
+    'connect' (tcp connect) or 'head' (http HEAD request) probes the
+    candidate that answered quickest is. When a cache file is given a
+    found mirror is kept in it (and reused) for the same candidates and
+    probe, when none was found the next search probes them again.
     """
-    for cand in candidates:
-        try:
-            # Allow either a proper URL or a bare hostname / IP
-            if is_resolvable_url(cand) or is_resolvable(cand):
-                return cand
-        except Exception:
-            pass
-    return None
+    if not candidates:
+        return None
+    candidates = [str(c) for c in candidates]
+    if probe is None:
+        probe = MIRROR_PROBE_RESOLVE
+    if probe not in MIRROR_PROBES:
+        LOG.warn("Unknown mirror probe %r, using %r instead",
+                 probe, MIRROR_PROBE_RESOLVE)
+        probe = MIRROR_PROBE_RESOLVE
+    if deadline is None:
+        deadline = MIRROR_SEARCH_DEADLINE
+
+    key = json.dumps([probe] + candidates)
+    cache = _load_mirror_cache(cache_fn)
+    if key in cache:
+        found = cache[key].get('mirror')
+        LOG.debug("Using the earlier mirror search: %s", found)
+        return found
+
+    latencies = _probe_mirrors(candidates, probe, deadline)
+    found = None
+    if probe == MIRROR_PROBE_RESOLVE:
+        for (cand, latency) in zip(candidates, latencies):
+            if latency is not None:
+                found = cand
+                break
+    else:
+        # Quickest first, ties go to the one listed first
+        usable = [(latency, i) for (i, latency) in enumerate(latencies)
+                  if latency is not None]
+        if usable:
+            found = candidates[min(usable)[1]]
+    LOG.debug("Mirror search (%s) of %s found %s (probe times %s)",
+              probe, candidates, found, latencies)
+
+    if cache_fn and found is not None:
+        cache[key] = {
+            'mirror': found,
+            'latencies': dict(zip(candidates, latencies)),
+        }
+        _save_mirror_cache(cache_fn, cache)
+    return found
 
 
 def close_stdin():
@@ -1277,13 +1687,8 @@ def read_write_cmdline_url(target_fn):
 
 
 def yaml_dumps(obj):
-    formatted = yaml.dump(obj,
-                    line_break="\n",
-                    indent=4,
-                    explicit_start=True,
-                    explicit_end=True,
-                    default_flow_style=False)
-    return formatted
+    from cloudinit import safeyaml
+    return safeyaml.dumps(obj)
 
 
 def ensure_dir(path, mode=None):
@@ -1464,6 +1869,30 @@ def write_file(filename, content, mode=0644, omode="wb"):
     chmod(filename, mode)
 
 
+def write_stream(filename, in_fh, mode=0644):
+    """
+    Writes what the (seekable) in_fh has to a file, like write_file does
+    for strings, leaving in_fh positioned at its start.
+    """
+    ensure_dir(os.path.dirname(filename))
+    in_fh.seek(0)
+    with SeLinuxGuard(path=filename):
+        with open(filename, "wb") as fh:
+            size = pipe_in_out(in_fh, fh, chunk_size=DECODE_CHUNK_SIZE)
+    LOG.debug("Wrote to %s - wb: [%o] %s bytes", filename, mode, size)
+    chmod(filename, mode)
+    in_fh.seek(0)
+    return size
+
+
+def stream_size(fh):
+    """How big the (seekable) fh is, leaving it positioned at its start."""
+    fh.seek(0, 2)
+    size = fh.tell()
+    fh.seek(0)
+    return size
+
+
 def delete_dir_contents(dirname):
     """
     Deletes all contents of a directory without deleting the directory itself.
@@ -0,0 +1,243 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2014 Amazon.com, Inc. or its affiliates.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+
+from Queue import Queue
+
+from cloudinit import log as logging
+from cloudinit import type_utils
+
+LOG = logging.getLogger(__name__)
+
+# Used to tell a worker thread that it should exit
+_STOP = object()
+
+
+class CancelledError(Exception):
+    pass
+
+
+# A unit of work that was handed to a pool, its result (or the
+# exception that it raised) can be fetched once it has finished.
+#
+# Note: python threads can not be interrupted, so 'cancelling' a
+# task only stops it from being started, a task that is already
+# running will be left to finish (and its result ignored).
+class Task(object):
+    def __init__(self, functor, args, kwargs):
+        self.functor = functor
+        self.args = args
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = False
+        self._cancelled = False
+        self._result = None
+        self._exc_info = None
+
+    def __str__(self):
+        return "<%s calling %s>" % (type_utils.obj_name(self),
+                                    type_utils.obj_name(self.functor))
+
+    def cancel(self):
+        with self._lock:
+            if self._started:
+                return False
+            self._cancelled = True
+        self._done.set()
+        return True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise RuntimeError("Task %s did not finish within %s seconds"
+                               % (self, timeout))
+        if self._cancelled:
+            raise CancelledError("Task %s was cancelled" % (self))
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            return None
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def run(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._started = True
+        try:
+            self._result = self.functor(*self.args, **self.kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+
+# A bounded set of daemon worker threads that run submitted tasks in
+# the order they were submitted. Since the threads are daemonic any
+# work that is abandoned (by shutting down without waiting) will not
+# stop the process from exiting.
+class Pool(object):
+    def __init__(self, max_workers, name='cloudinit-worker'):
+        self.max_workers = max(1, int(max_workers))
+        self.name = name
+        self._queue = Queue()
+        self._threads = []
+        self._pending = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excp_type, excp_value, excp_traceback):
+        self.shutdown(wait=True)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is _STOP:
+                break
+            task.run()
+
+    def _adjust_threads(self):
+        if len(self._threads) >= self.max_workers:
+            return
+        t_name = "%s-%s" % (self.name, len(self._threads))
+        t = threading.Thread(target=self._work, name=t_name)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def submit(self, functor, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Can not submit to a shutdown pool")
+            task = Task(functor, args, kwargs)
+            self._pending.append(task)
+            self._queue.put(task)
+            self._adjust_threads()
+        return task
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            if cancel_pending:
+                for task in self._pending:
+                    task.cancel()
+            for _t in self._threads:
+                self._queue.put(_STOP)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+def run_ordered(functors, max_workers, accept=None):
+    """
+    Runs the given (functor, args) pairs concurrently on a bounded pool
+    and returns the (index, result) of the first one (in the order given)
+    that succeeded and whose result was accepted. Any work that has not
+    started by then is cancelled and any work still running is abandoned.
+
+    Returns (None, None) if nothing succeeded.
+    """
+    if accept is None:
+        accept = bool
+    pool = Pool(max_workers)
+    try:
+        tasks = []
+        for (functor, args) in functors:
+            tasks.append(pool.submit(functor, *args))
+        for (i, task) in enumerate(tasks):
+            try:
+                result = task.result()
+            except CancelledError:
+                continue
+            except Exception:
+                LOG.debug("Task %s failed", task, exc_info=True)
+                continue
+            if accept(result):
+                return (i, result)
+        return (None, None)
+    finally:
+        pool.shutdown(wait=False, cancel_pending=True)
+
+
+def run_dependent(functors, depends_on, max_workers):
+    """
+    Runs the given (functor, args) pairs on a bounded pool, each one is only
+    started once all of those it depends on (the indexes of earlier pairs
+    given in depends_on[index]) have finished, otherwise they are started in
+    the order given.
+
+    Returns the finished tasks (in the order given).
+    """
+    waiting_on = []
+    for (i, deps) in enumerate(depends_on):
+        deps = set(deps)
+        for j in deps:
+            if j < 0 or j >= i:
+                raise ValueError("Item %s can only depend on earlier"
+                                 " items (not %s)" % (i, j))
+        waiting_on.append(deps)
+    finished = Queue()
+    tasks = [None] * len(functors)
+
+    def start(i):
+        (functor, args) = functors[i]
+
+        def run_and_notify():
+            try:
+                return functor(*args)
+            finally:
+                finished.put(i)
+
+        tasks[i] = pool.submit(run_and_notify)
+
+    pool = Pool(max_workers)
+    try:
+        for i in range(0, len(functors)):
+            if not waiting_on[i]:
+                start(i)
+        for _count in range(0, len(functors)):
+            done = finished.get()
+            for i in range(done + 1, len(functors)):
+                if tasks[i] is None and done in waiting_on[i]:
+                    waiting_on[i].discard(done)
+                    if not waiting_on[i]:
+                        start(i)
+    finally:
+        pool.shutdown(wait=True)
+    return tasks
@@ -25,12 +25,15 @@ from glob import glob
 import os
 
 import setuptools
+from setuptools.command.build_py import build_py
 from setuptools.command.install import install
 
 from distutils.errors import DistutilsArgError
 
 import subprocess
 
+from cloudinit import registry
+
 
 def is_f(p):
     return os.path.isfile(p)
@@ -108,6 +111,17 @@ class InitsysInstallData(install):
             self.distribution.reinitialize_command('install_data', True)
 
 
+class RegistryBuildPy(build_py):
+    # Generates the module registry (so that the modules shipped
+    # can be found without searching for them) into the built package
+    def run(self):
+        build_py.run(self)
+        if not self.dry_run:
+            target = os.path.join(self.build_lib, 'cloudinit',
+                                  registry.REGISTRY_FN)
+            registry.write(target, 'cloudinit')
+
+
 setuptools.setup(name='cloud-init',
       version=get_version(),
       description='EC2 initialisation magic',
@@ -125,6 +139,7 @@ setuptools.setup(name='cloud-init',
                   ('/usr/share/cloud-init', []),
                   ('/usr/libexec/cloud-init',
                     ['tools/uncloud-init',
+                     'tools/build-registry',
                      'tools/write-ssh-key-fingerprints']),
                   ('/usr/share/doc/cloud-init',
                    [f for f in glob('doc/*') if is_f(f)]),
@@ -138,5 +153,6 @@ setuptools.setup(name='cloud-init',
           # Use a subclass for install that handles
           # adding on the right init system configuration files
           'install': InitsysInstallData,
+          'build_py': RegistryBuildPy,
       },
       )
@@ -1,5 +1,8 @@
+import BaseHTTPServer
+import SocketServer
 import os
 import sys
+import threading
 import unittest
 
 from contextlib import contextmanager
@@ -8,6 +11,7 @@ from mocker import Mocker
 from mocker import MockerTestCase
 
 from cloudinit import helpers as ch
+from cloudinit import url_helper
 from cloudinit import util
 
 import shutil
@@ -185,6 +189,61 @@ class FilesystemMockingTestCase(ResourceUsingTestCase):
                 self.patched_funcs.append((mod, f, func))
 
 
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.url = "http://127.0.0.1:%s" % (self.server_port)
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._flight_lock = threading.Lock()
+
+    @contextmanager
+    def answering(self):
+        # Handlers answer in here so that tests can check how many
+        # requests were being answered at the same time
+        with self._flight_lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            with self._flight_lock:
+                self.in_flight -= 1
+
+
+class HTTPServerTestCase(MockerTestCase):
+    # When set setUp starts self.server answering with this handler
+    handler = None
+
+    def setUp(self):
+        MockerTestCase.setUp(self)
+        self.servers = []
+        self.server = None
+        if self.handler:
+            self.server = self.startServer(self.handler)
+
+    def startServer(self, handler):
+        server = HTTPServer(handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.servers.append(server)
+        return server
+
+    def stopServer(self, server):
+        self.servers.remove(server)
+        server.shutdown()
+        server.server_close()
+
+    def tearDown(self):
+        url_helper.close_sessions()
+        for server in list(self.servers):
+            self.stopServer(server)
+        MockerTestCase.tearDown(self)
+
+
 def populate_dir(path, files):
     os.makedirs(path)
     for (name, content) in files.iteritems():
@@ -0,0 +1,147 @@
+import os
+
+from mocker import MockerTestCase
+
+from cloudinit import settings
+from cloudinit import stages
+from cloudinit import util
+
+
+class TestBaseConfigCache(MockerTestCase):
+
+    def setUp(self):
+        super(TestBaseConfigCache, self).setUp()
+        self.tmp = self.makeDir()
+        self.cfgfile = os.path.join(self.tmp, 'cloud.cfg')
+        self.confd = "%s.d" % (self.cfgfile)
+        self.cache_fn = os.path.join(self.tmp, 'data', 'base-config.pkl')
+        os.makedirs(self.confd)
+        os.makedirs(os.path.dirname(self.cache_fn))
+        util.write_file(self.cfgfile, 'a: 1\nb: 1\n')
+        util.write_file(os.path.join(self.confd, '10_b.cfg'), 'b: 2\n')
+        self.old_cmdline = os.environ.get('DEBUG_PROC_CMDLINE')
+        os.environ['DEBUG_PROC_CMDLINE'] = 'ro root=/dev/sda1'
+        # Where a cache (of another cloud directory) is found from
+        self.default_fn = os.path.join(self.tmp, 'default', 'data',
+                                       'base-config.pkl')
+        self.orig_default = stages.BASE_CONFIG_CACHE
+        stages.BASE_CONFIG_CACHE = self.default_fn
+        self.reads = 0
+        self.orig_read_conf = util.read_conf
+
+        def counting_read_conf(fname):
+            self.reads += 1
+            return self.orig_read_conf(fname)
+
+        util.read_conf = counting_read_conf
+
+    def tearDown(self):
+        util.read_conf = self.orig_read_conf
+        stages.BASE_CONFIG_CACHE = self.orig_default
+        if self.old_cmdline is None:
+            os.environ.pop('DEBUG_PROC_CMDLINE', None)
+        else:
+            os.environ['DEBUG_PROC_CMDLINE'] = self.old_cmdline
+        super(TestBaseConfigCache, self).tearDown()
+
+    def _fetch(self):
+        self.reads = 0
+        return stages.fetch_base_config(self.cfgfile, self.cache_fn)
+
+    def test_hit_skips_reading(self):
+        cfg = self._fetch()
+        self.assertEquals((cfg['a'], cfg['b']), (1, 2))
+        self.assertTrue(self.reads > 0)
+        self.assertTrue(os.path.isfile(self.cache_fn))
+        self.assertEquals(self._fetch(), cfg)
+        self.assertEquals(self.reads, 0)
+
+    def test_changed_file_invalidates(self):
+        self._fetch()
+        util.write_file(os.path.join(self.confd, '10_b.cfg'), 'b: 30\n')
+        self.assertEquals(self._fetch()['b'], 30)
+        self.assertTrue(self.reads > 0)
+
+    def test_new_confd_file_invalidates(self):
+        self._fetch()
+        util.write_file(os.path.join(self.confd, '20_c.cfg'), 'c: 3\n')
+        self.assertEquals(self._fetch()['c'], 3)
+        self.assertTrue(self.reads > 0)
+
+    def test_cmdline_invalidates(self):
+        self._fetch()
+        os.environ['DEBUG_PROC_CMDLINE'] = 'ro cc: a: 5 end_cc'
+        self.assertEquals(self._fetch()['a'], 5)
+        self.assertTrue(self.reads > 0)
+
+    def test_corrupt_cache_ignored(self):
+        util.write_file(self.cache_fn, 'not a pickle')
+        self.assertEquals(self._fetch()['b'], 2)
+        self.assertEquals(self._fetch()['b'], 2)
+        self.assertEquals(self.reads, 0)
+
+    def test_no_cache_dir(self):
+        cache_fn = os.path.join(self.tmp, 'missing', 'base-config.pkl')
+        cfg = stages.fetch_base_config(self.cfgfile, cache_fn)
+        self.assertEquals(cfg['b'], 2)
+        self.assertFalse(os.path.exists(cache_fn))
+
+    def test_cloud_dir_from_config(self):
+        cloud_dir = os.path.join(self.tmp, 'cloud')
+        os.makedirs(os.path.join(cloud_dir, 'data'))
+        util.write_file(os.path.join(self.confd, '20_paths.cfg'),
+                        'system_info:\n  paths:\n    cloud_dir: %s\n'
+                        % (cloud_dir))
+        cache_fn = os.path.join(cloud_dir, 'data', 'base-config.pkl')
+        cfg = stages.fetch_base_config(self.cfgfile)
+        self.assertEquals(cache_fn, stages.base_config_cache_fn(cfg))
+        self.assertTrue(os.path.isfile(cache_fn))
+        self.assertFalse(os.path.exists(self.cache_fn))
+        self.reads = 0
+        self.assertEquals(cfg, stages.fetch_base_config(self.cfgfile,
+                                                        cache_fn))
+        self.assertEquals(self.reads, 0)
+
+    def test_cloud_dir_found_by_new_process(self):
+        # Neither fetch knows the paths (as in each new process)
+        cloud_dir = os.path.join(self.tmp, 'cloud')
+        os.makedirs(os.path.join(cloud_dir, 'data'))
+        util.write_file(os.path.join(self.confd, '20_paths.cfg'),
+                        'system_info:\n  paths:\n    cloud_dir: %s\n'
+                        % (cloud_dir))
+        cfg = stages.fetch_base_config(self.cfgfile)
+        self.assertTrue(self.reads > 0)
+        self.assertTrue(os.path.isfile(self.default_fn))
+        self.reads = 0
+        self.assertEquals(cfg, stages.fetch_base_config(self.cfgfile))
+        self.assertEquals(self.reads, 0)
+        # Still rebuilt when an input changes
+        util.write_file(os.path.join(self.confd, '10_b.cfg'), 'b: 3\n')
+        self.assertEquals(stages.fetch_base_config(self.cfgfile)['b'], 3)
+        self.assertTrue(self.reads > 0)
+        self.assertTrue(os.path.isfile(os.path.join(cloud_dir, 'data',
+                                                    'base-config.pkl')))
+
+    def test_default_cloud_dir(self):
+        self.assertEquals(settings.BASE_CONFIG_CACHE,
+                          stages.base_config_cache_fn({}))
+
+    def test_init_uses_known_paths(self):
+        cloud_dir = os.path.join(self.tmp, 'cloud')
+        fetched = []
+        orig_fetch = stages.fetch_base_config
+
+        def fetch_base_config(cache_fn=None):
+            fetched.append(cache_fn)
+            return {'system_info': {'paths': {'cloud_dir': cloud_dir}}}
+
+        stages.fetch_base_config = fetch_base_config
+        try:
+            init = stages.Init(ds_deps=[])
+            init.read_cfg()
+            init._reset()  # pylint: disable=W0212
+            init.read_cfg()
+        finally:
+            stages.fetch_base_config = orig_fetch
+        self.assertEquals([None, os.path.join(cloud_dir, 'data',
+                                              'base-config.pkl')], fetched)
@@ -0,0 +1,80 @@
+import copy
+import cPickle as pickle
+
+from unittest import TestCase
+
+from cloudinit import helpers
+from cloudinit import util
+
+
+class TestConfigView(TestCase):
+
+    def setUp(self):
+        self.master = {
+            'a': {'b': [1, 2, {'c': 'd'}]},
+            'runcmd': ['ls', ['echo', 'hi']],
+            'str': 'blah',
+            'num': 1,
+        }
+        self.orig = copy.deepcopy(self.master)
+
+    def test_reads(self):
+        view = helpers.ConfigView(self.master)
+        self.assertEquals(view, self.master)
+        self.assertEquals(view['a'], self.master['a'])
+        self.assertEquals(view.get('missing', 2), 2)
+        self.assertEquals(sorted(view.keys()), sorted(self.master.keys()))
+        self.assertTrue(isinstance(view, dict))
+
+    def test_mutations_do_not_leak(self):
+        view = helpers.ConfigView(self.master)
+        view['a']['b'][2]['c'] = 'e'
+        view.get('runcmd').append('more')
+        view.setdefault('new', []).append(1)
+        view.pop('str')
+        del view['num']
+        for (_k, v) in view.items():
+            if isinstance(v, dict):
+                v['x'] = 'y'
+        self.assertEquals(self.master, self.orig)
+        self.assertEquals(view['a']['b'][2]['c'], 'e')
+        self.assertEquals(view['a']['x'], 'y')
+        self.assertEquals(view['new'], [1])
+
+    def test_lazy_copy(self):
+        view = helpers.ConfigView(self.master)
+        # Untouched branches are still shared with the master
+        self.assertTrue(dict.__getitem__(view, 'runcmd') is
+                        self.master['runcmd'])
+        self.assertFalse(view['a'] is self.master['a'])
+        # ... and only copied once
+        self.assertTrue(view['a'] is view['a'])
+
+    def test_views_are_independent(self):
+        view = helpers.ConfigView(self.master)
+        view['a']['b'] = []
+        other = helpers.ConfigView(self.master)
+        self.assertEquals(other['a']['b'], self.orig['a']['b'])
+        copied = view.copy()
+        copied['a']['b'].append(1)
+        self.assertEquals(view['a']['b'], [])
+
+    def test_deepcopy_and_pickle(self):
+        view = helpers.ConfigView(self.master)
+        dcopy = copy.deepcopy(view)
+        self.assertEquals(type(dcopy), dict)
+        self.assertEquals(dcopy, self.master)
+        unpickled = pickle.loads(pickle.dumps(view))
+        self.assertEquals(type(unpickled), dict)
+        self.assertEquals(unpickled, self.master)
+
+    def test_yaml_dumps(self):
+        view = helpers.ConfigView(self.master)
+        self.assertEquals(util.yaml_dumps(view), util.yaml_dumps(self.master))
+        self.assertEquals(util.load_yaml(util.yaml_dumps(view)), self.master)
+
+    def test_merging(self):
+        view = helpers.ConfigView(self.master)
+        merged = util.mergemanydict([{'str': 'other'}, view])
+        self.assertEquals(merged['str'], 'other')
+        self.assertEquals(merged['a'], self.master['a'])
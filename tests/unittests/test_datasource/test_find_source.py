@@ -0,0 +1,118 @@
+import threading
+import time
+
+from cloudinit import helpers
+from cloudinit import sources
+
+from mocker import MockerTestCase
+
+
+def _make_source(name, found, delay=0, started=None, meet=None):
+
+    class FakeSource(sources.DataSource):
+        def get_data(self):
+            if started is not None:
+                started.append(name)
+            if meet is not None:
+                meet(name)
+            if delay:
+                time.sleep(delay)
+            return found
+
+    FakeSource.__name__ = name
+    return FakeSource
+
+
+class TestFindSource(MockerTestCase):
+
+    def setUp(self):
+        super(TestFindSource, self).setUp()
+        self.paths = helpers.Paths({'cloud_dir': self.makeDir()})
+        self.ds_list = []
+        self.orig_list_sources = sources.list_sources
+        sources.list_sources = self._list_sources
+
+    def tearDown(self):
+        sources.list_sources = self.orig_list_sources
+        super(TestFindSource, self).tearDown()
+
+    def _list_sources(self, _cfg_list, _depends, _pkg_list):
+        return list(self.ds_list)
+
+    def _find(self, sys_cfg):
+        return sources.find_source(sys_cfg, None, self.paths,
+                                   [], [], [])
+
+    def test_serial_first_found(self):
+        self.ds_list = [
+            _make_source('DataSourceA', False),
+            _make_source('DataSourceB', True),
+            _make_source('DataSourceC', True),
+        ]
+        (ds, dsname) = self._find({})
+        self.assertEquals(dsname, 'DataSourceB')
+        self.assertEquals(str(ds), 'DataSourceB')
+
+    def test_serial_none_found(self):
+        self.ds_list = [_make_source('DataSourceA', False)]
+        self.assertRaises(sources.DataSourceNotFoundException,
+                          self._find, {})
+
+    def test_parallel_keeps_list_order(self):
+        # The slow (but higher priority) source must still win
+        self.ds_list = [
+            _make_source('DataSourceSlow', True, delay=0.2),
+            _make_source('DataSourceFast', True),
+        ]
+        sys_cfg = {'datasource_parallel_probe': True}
+        (_ds, dsname) = self._find(sys_cfg)
+        self.assertEquals(dsname, 'DataSourceSlow')
+
+    def test_parallel_skips_failures(self):
+        class Broken(sources.DataSource):
+            def get_data(self):
+                raise IOError("broken")
+
+        self.ds_list = [
+            Broken,
+            _make_source('DataSourceA', False),
+            _make_source('DataSourceB', True),
+        ]
+        sys_cfg = {'datasource_parallel_probe': True}
+        (_ds, dsname) = self._find(sys_cfg)
+        self.assertEquals(dsname, 'DataSourceB')
+
+    def test_parallel_probes_concurrently(self):
+        # Each probe waits (for a while) for the other one to start
+        probing = {
+            'DataSourceA': threading.Event(),
+            'DataSourceB': threading.Event(),
+        }
+        met = []
+
+        def meet(name):
+            probing[name].set()
+            for (other, event) in probing.items():
+                if other != name and event.wait(5):
+                    met.append(name)
+
+        self.ds_list = [
+            _make_source('DataSourceA', False, meet=meet),
+            _make_source('DataSourceB', True, meet=meet),
+        ]
+        sys_cfg = {
+            'datasource_parallel_probe': True,
+            'datasource_probe_workers': 2,
+        }
+        (_ds, dsname) = self._find(sys_cfg)
+        self.assertEquals(dsname, 'DataSourceB')
+        self.assertEquals(['DataSourceA', 'DataSourceB'], sorted(met))
+
+    def test_parallel_none_found(self):
+        self.ds_list = [
+            _make_source('DataSourceA', False),
+            _make_source('DataSourceB', False),
+        ]
+        sys_cfg = {'datasource_parallel_probe': True}
+        self.assertRaises(sources.DataSourceNotFoundException,
+                          self._find, sys_cfg)
@@ -0,0 +1,183 @@
+import BaseHTTPServer
+import re
+
+from cloudinit import ec2_utils
+from cloudinit import url_helper
+
+from tests.unittests import helpers
+
+PAGES = {
+    '/latest/user-data': '#cloud-config\nhostname: me\n',
+    '/latest/meta-data/': "\n".join(['ami-id', 'block-device-mapping/',
+                                     'instance-id', 'missing', 'network/',
+                                     'placement/', 'public-keys/',
+                                     'security-groups']),
+    '/latest/meta-data/ami-id': 'ami-1',
+    '/latest/meta-data/block-device-mapping/': 'ami\nephemeral0\nroot',
+    '/latest/meta-data/block-device-mapping/ami': 'sda1',
+    '/latest/meta-data/block-device-mapping/ephemeral0': 'sdb',
+    '/latest/meta-data/block-device-mapping/root': '/dev/sda1',
+    '/latest/meta-data/instance-id': 'i-1',
+    '/latest/meta-data/network/': 'interfaces/',
+    '/latest/meta-data/network/interfaces/': 'macs/',
+    '/latest/meta-data/network/interfaces/macs/': '0a:00/',
+    '/latest/meta-data/network/interfaces/macs/0a:00/': 'device-number',
+    '/latest/meta-data/network/interfaces/macs/0a:00/device-number': '0',
+    '/latest/meta-data/placement/': 'availability-zone',
+    '/latest/meta-data/placement/availability-zone': 'us-east-1a',
+    '/latest/meta-data/public-keys/': '0=first\n1=second',
+    '/latest/meta-data/public-keys/0/openssh-key': 'ssh-rsa AAAA first',
+    '/latest/meta-data/public-keys/1/openssh-key': 'ssh-rsa BBBB second',
+    '/latest/meta-data/security-groups': 'default\nweb',
+    '/latest/dynamic/instance-identity/': 'document\npkcs7',
+    '/latest/dynamic/instance-identity/document':
+        '{"instanceId": "i-1", "region": "us-east-1"}',
+    '/latest/dynamic/instance-identity/pkcs7': 'MIAG\nCSqG',
+}
+
+EXPECTED = {
+    'user-data': '#cloud-config\nhostname: me\n',
+    'meta-data': {
+        'ami-id': 'ami-1',
+        'block-device-mapping': {
+            'ami': 'sda1',
+            'ephemeral0': 'sdb',
+            'root': '/dev/sda1',
+        },
+        'instance-id': 'i-1',
+        'missing': '',
+        'network': {
+            'interfaces': {
+                'macs': {
+                    '0a:00': {
+                        'device-number': '0',
+                    },
+                },
+            },
+        },
+        'placement': {
+            'availability-zone': 'us-east-1a',
+        },
+        'public-keys': {
+            'first': 'ssh-rsa AAAA first',
+            'second': 'ssh-rsa BBBB second',
+        },
+        'security-groups': ['default', 'web'],
+    },
+    'identity': {
+        'document': {
+            'instanceId': 'i-1',
+            'region': 'us-east-1',
+        },
+        'pkcs7': 'MIAG\nCSqG',
+    },
+}
+
+
+class MetadataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = re.sub("/+", "/", self.path)
+        self.server.requested.append(path)
+        if path in self.server.broken:
+            body = 'broken'
+            self.send_response(500)
+        elif path in PAGES or path.rstrip("/") in PAGES:
+            body = PAGES.get(path, PAGES.get(path.rstrip("/")))
+            self.send_response(200)
+        else:
+            body = 'not found'
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):
+        pass
+
+
+class TestMetadataCrawler(helpers.HTTPServerTestCase):
+    handler = MetadataHandler
+
+    def setUp(self):
+        super(TestMetadataCrawler, self).setUp()
+        self.server.requested = []
+        self.server.broken = []
+        self.url = self.server.url
+
+    def test_crawl(self):
+        self.assertEquals(EXPECTED, ec2_utils.get_instance_data('latest',
+                                                                self.url))
+        self.assertEquals(EXPECTED, ec2_utils.get_instance_data(
+            'latest', self.url, max_workers=1))
+
+    def test_breadth_first(self):
+        ec2_utils.get_instance_data('latest', self.url, max_workers=1)
+        listings = [p for p in self.server.requested if p.endswith("/")]
+        self.assertEquals(['/latest/meta-data/',
+                           '/latest/dynamic/instance-identity/',
+                           '/latest/meta-data/block-device-mapping/',
+                           '/latest/meta-data/network/',
+                           '/latest/meta-data/placement/',
+                           '/latest/meta-data/public-keys/',
+                           '/latest/meta-data/network/interfaces/',
+                           '/latest/meta-data/network/interfaces/macs/',
+                           '/latest/meta-data/network/interfaces/macs/'
+                           '0a:00/'], listings)
+
+    def test_parts(self):
+        self.assertEquals(EXPECTED['user-data'],
+                          ec2_utils.get_instance_userdata('latest',
+                                                          self.url))
+        self.assertEquals(EXPECTED['meta-data'],
+                          ec2_utils.get_instance_metadata('latest',
+                                                          self.url))
+        self.assertEquals(EXPECTED['identity'],
+                          ec2_utils.get_instance_identity('latest',
+                                                          self.url))
+        # No user-data is empty user-data
+        self.assertEquals('', ec2_utils.get_instance_userdata('2009-04-04',
+                                                              self.url))
+
+    def test_errors(self):
+        # Only what the rest is found through fails the crawl
+        crawler = ec2_utils.MetadataCrawler('latest', self.url, retries=0)
+        for path in ['/latest/meta-data/', '/latest/user-data']:
+            self.server.broken = [path]
+            self.assertRaises(url_helper.UrlError, crawler.crawl)
+
+    def test_broken_leaf(self):
+        self.server.broken = [
+            '/latest/meta-data/ami-id',
+            '/latest/meta-data/placement/',
+            '/latest/dynamic/instance-identity/pkcs7',
+        ]
+        crawler = ec2_utils.MetadataCrawler('latest', self.url, retries=0)
+        crawled = crawler.crawl()
+        self.assertEquals('', crawled['meta-data']['ami-id'])
+        self.assertEquals({}, crawled['meta-data']['placement'])
+        self.assertEquals('', crawled['identity']['pkcs7'])
+        self.assertEquals(EXPECTED['identity']['document'],
+                          crawled['identity']['document'])
+        self.assertEquals('i-1', crawled['meta-data']['instance-id'])
+        self.assertEquals(EXPECTED['user-data'], crawled['user-data'])
+
+    def test_same_as_boto(self):
+        try:
+            import boto.utils
+        except ImportError:
+            self.skipTest("boto is not installed")
+
+        def unlazy(mp):
+            if not isinstance(mp, dict):
+                return mp
+            return dict([(k, unlazy(mp[k])) for k in mp.keys()])
+
+        metadata = boto.utils.get_instance_metadata('latest', self.url,
+                                                    num_retries=1)
+        self.assertEquals(EXPECTED['meta-data'], unlazy(metadata))
+        self.assertEquals(EXPECTED['identity'],
+                          boto.utils.get_instance_identity('latest',
+                                                           self.url,
+                                                           num_retries=1))
@@ -0,0 +1,198 @@
+import os
+import types
+
+from mocker import MockerTestCase
+
+from cloudinit import config
+from cloudinit import fingerprint
+from cloudinit import helpers
+from cloudinit import stages
+
+from cloudinit.settings import (INPUT_BOOT, INPUT_CONFIG, INPUT_METADATA,
+                                PER_ALWAYS, PER_INSTANCE)
+
+
+class FakeDataSource(object):
+    def __init__(self, iid='i-1', userdata_raw='#cloud-config\n',
+                 metadata=None):
+        self.iid = iid
+        self.userdata_raw = userdata_raw
+        self.metadata = metadata or {'hostname': 'host'}
+
+    def get_instance_id(self):
+        return self.iid
+
+    def get_userdata_raw(self):
+        return self.userdata_raw
+
+
+class TestFingerprint(MockerTestCase):
+
+    def test_compute(self):
+        ds = FakeDataSource()
+        cfg = {'a': [1, 2]}
+        boot_fp = fingerprint.compute(ds, cfg)
+        self.assertEquals(boot_fp, fingerprint.compute(FakeDataSource(),
+                                                       {'a': [1, 2]}))
+        self.assertNotEquals(boot_fp,
+                             fingerprint.compute(FakeDataSource('i-2'), cfg))
+        self.assertNotEquals(boot_fp,
+                             fingerprint.compute(FakeDataSource(
+                                 userdata_raw='#!/bin/sh\n'), cfg))
+        self.assertNotEquals(boot_fp, fingerprint.compute(ds, {'a': [2]}))
+        # The metadata is not part of it
+        self.assertEquals(boot_fp,
+                          fingerprint.compute(FakeDataSource(
+                              metadata={'hostname': 'other'}), cfg))
+
+    def test_inputs(self):
+        fn = os.path.join(self.makeDir(), 'hosts')
+        inputs = fingerprint.Inputs(FakeDataSource(), {'a': 1})
+        self.assertTrue(inputs.changes_every_boot([INPUT_CONFIG,
+                                                   INPUT_BOOT]))
+        self.assertTrue(inputs.changes_every_boot(['unknown']))
+        # Files that do not exist are like unknown inputs
+        self.assertTrue(inputs.changes_every_boot([fn]))
+        self.assertEquals(None, inputs.digest([INPUT_BOOT]))
+        open(fn, 'wb').write("127.0.0.1 localhost\n")
+        inputs = fingerprint.Inputs(FakeDataSource(), {'a': 1})
+        digest = inputs.digest([INPUT_CONFIG, INPUT_METADATA, fn])
+        self.assertNotEquals(None, digest)
+        self.assertEquals(digest, inputs.digest([fn, INPUT_METADATA,
+                                                 INPUT_CONFIG]))
+        other = fingerprint.Inputs(FakeDataSource(metadata={'h': 'x'}),
+                                   {'a': 1})
+        self.assertNotEquals(digest, other.digest([INPUT_CONFIG,
+                                                   INPUT_METADATA, fn]))
+        self.assertEquals(inputs.digest([INPUT_CONFIG]),
+                          other.digest([INPUT_CONFIG]))
+
+    def test_record_lifecycle(self):
+        fn = os.path.join(self.makeDir(), 'boot-fingerprint.json')
+        inputs = fingerprint.Inputs(FakeDataSource(), {})
+        record = fingerprint.load(fn, 'abc')
+        self.assertFalse(record.matches())
+        record.record_section('init', [('a', [INPUT_CONFIG],
+                                        inputs.digest([INPUT_CONFIG]))],
+                              False)
+        record.record_section('final', [('b', [INPUT_BOOT], None)], False)
+        # Not finished, so not matching
+        self.assertFalse(fingerprint.load(fn, 'abc').matches())
+        self.assertTrue(record.finish())
+
+        record = fingerprint.load(fn, 'abc')
+        self.assertTrue(record.matches())
+        self.assertTrue(record.matches('init'))
+        self.assertFalse(record.matches('config'))
+        self.assertEquals([], record.changed_modules('init', inputs))
+        self.assertEquals(['b'], record.changed_modules('final', inputs))
+        changed = fingerprint.Inputs(FakeDataSource(), {'x': 1})
+        self.assertEquals(['a'], record.changed_modules('init', changed))
+
+        # A different fingerprint starts over
+        self.assertFalse(fingerprint.load(fn, 'def').matches())
+
+        # And failures stop it from matching
+        record.record_section('final', [], True)
+        self.assertFalse(record.finish())
+        self.assertFalse(fingerprint.load(fn, 'abc').matches())
+
+    def test_unusable_record(self):
+        fn = os.path.join(self.makeDir(), 'boot-fingerprint.json')
+        open(fn, 'wb').write('{"version": 1, "fingerprint": "abc"}')
+        self.assertFalse(fingerprint.load(fn, 'abc').matches())
+        open(fn, 'wb').write('not json')
+        self.assertFalse(fingerprint.load(fn, 'abc').matches())
+
+
+class FakeCloud(object):
+    def run(self, _name, functor, args, freq=None):
+        return functor(*args)
+
+
+class FakeDistro(object):
+    name = 'ubuntu'
+
+
+class FakeInit(object):
+    def __init__(self, paths, datasource):
+        self.paths = paths
+        self.datasource = datasource
+        self.distro = FakeDistro()
+
+    def cloudify(self):
+        return FakeCloud()
+
+
+class TestModulesFastPath(MockerTestCase):
+
+    def setUp(self):
+        super(TestModulesFastPath, self).setUp()
+        self.paths = helpers.Paths({'cloud_dir': self.makeDir()})
+        self.ran = []
+        self.mods = {}
+        for (name, freq, inputs) in [('once', PER_INSTANCE, None),
+                                     ('boot', PER_ALWAYS, None),
+                                     ('hosts', PER_ALWAYS,
+                                      [INPUT_CONFIG, INPUT_METADATA])]:
+            mod = types.ModuleType(name)
+            mod.handle = self._handler(name)
+            mod.frequency = freq
+            if inputs is not None:
+                mod.inputs = inputs
+            self.mods[name] = config.fixup_module(mod)
+
+    def _handler(self, name):
+
+        def handle(*_args):
+            self.ran.append(name)
+
+        return handle
+
+    def _modules(self, datasource, enabled=True):
+        mods = stages.Modules(FakeInit(self.paths, datasource))
+        mods._cached_cfg = {
+            'boot_fingerprint': enabled,
+            'cloud_final_modules': ['once', 'boot', 'hosts'],
+        }
+
+        def fixup(raw_mods):
+            return [[self.mods[r['mod']], r['mod'], None, []]
+                    for r in raw_mods]
+
+        mods._fixup_modules = fixup
+        return mods
+
+    def _boot(self, datasource, enabled=True):
+        del self.ran[:]
+        mods = self._modules(datasource, enabled)
+        (which_ran, failures) = mods.run_section('cloud_final_modules')
+        self.assertEquals([], failures)
+        mods.finish_boot()
+        return which_ran
+
+    def test_fast_path(self):
+        self.assertEquals(['once', 'boot', 'hosts'],
+                          self._boot(FakeDataSource()))
+        self.assertEquals(['once', 'boot', 'hosts'], self.ran)
+        # Nothing changed, only what depends on the boot runs
+        self.assertTrue(self._modules(FakeDataSource()).boot_unchanged())
+        self.assertEquals(['boot'], self._boot(FakeDataSource()))
+        # The metadata changed
+        ds = FakeDataSource(metadata={'hostname': 'other'})
+        self.assertEquals(['boot', 'hosts'], self._boot(ds))
+        self.assertEquals(['boot'], self._boot(ds))
+        # A different instance runs everything
+        self.assertFalse(self._modules(FakeDataSource('i-2')).
+                         boot_unchanged())
+        self.assertEquals(['once', 'boot', 'hosts'],
+                          self._boot(FakeDataSource('i-2')))
+
+    def test_disabled(self):
+        self.assertEquals(None, self._modules(FakeDataSource(),
+                                              False).boot_record)
+        self._boot(FakeDataSource(), False)
+        self.assertEquals(['once', 'boot', 'hosts'],
+                          self._boot(FakeDataSource(), False))
+        self.assertFalse(os.path.exists(
+            self.paths.get_cpath('boot_fingerprint')))
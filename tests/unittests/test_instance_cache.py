@@ -0,0 +1,147 @@
+import cPickle as pickle
+
+import json
+import os
+
+from mocker import MockerTestCase
+
+from cloudinit import helpers
+from cloudinit import instance_cache
+from cloudinit import util
+
+from cloudinit.sources import DataSourceEc2
+from cloudinit.sources import DataSourceNone
+
+
+class TestInstanceCache(MockerTestCase):
+
+    def setUp(self):
+        super(TestInstanceCache, self).setUp()
+        self.tmp = self.makeDir()
+        self.cache_dir = os.path.join(self.tmp, 'obj.d')
+        self.paths = helpers.Paths({'cloud_dir': self.tmp})
+
+    def _make_ds(self):
+        ds = DataSourceEc2.DataSourceEc2({}, None, self.paths)
+        ds.metadata = {'instance-id': 'i-abcdef', 'local-hostname': 'me'}
+        ds.userdata_raw = '#cloud-config\nruncmd: [ls]\n'
+        ds.metadata_address = 'http://169.254.169.254'
+        ds.identity = {}
+        return ds
+
+    def test_header(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        header = instance_cache.read_header(self.cache_dir)
+        self.assertEquals(header['schema'], instance_cache.SCHEMA_VERSION)
+        self.assertEquals(header['instance_id'], 'i-abcdef')
+        self.assertEquals(header['datasource'],
+                          'cloudinit.sources.DataSourceEc2.DataSourceEc2')
+        self.assertEquals(sorted(header['blobs'].keys()),
+                          ['metadata', 'state', 'userdata_raw'])
+
+    def test_restore_is_lazy(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        ds = instance_cache.restore(self.cache_dir, {}, None, self.paths)
+        self.assertTrue(isinstance(ds, DataSourceEc2.DataSourceEc2))
+        self.assertEquals(ds.metadata_address, 'http://169.254.169.254')
+        self.assertFalse('metadata' in ds.__dict__)
+        self.assertFalse('userdata_raw' in ds.__dict__)
+
+        # The instance id comes from the header
+        paths = helpers.Paths({'cloud_dir': self.tmp}, ds)
+        self.assertEquals(paths.get_ipath(),
+                          os.path.join(self.tmp, 'instances', 'i-abcdef'))
+        self.assertFalse('metadata' in ds.__dict__)
+
+        self.assertEquals(ds.get_instance_id(), 'i-abcdef')
+        self.assertTrue('metadata' in ds.__dict__)
+        self.assertEquals(ds.get_userdata_raw(),
+                          '#cloud-config\nruncmd: [ls]\n')
+        self.assertEquals(ds.userdata, None)
+
+    def test_new_metadata_resets_instance_id(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        ds = instance_cache.restore(self.cache_dir, {}, None, self.paths)
+        self.assertEquals(ds.cached_instance_id, 'i-abcdef')
+        ds.metadata = {'instance-id': 'i-123'}
+        self.assertEquals(ds.cached_instance_id, None)
+        paths = helpers.Paths({'cloud_dir': self.tmp}, ds)
+        self.assertTrue(paths.get_ipath().endswith('i-123'))
+
+    def test_restored_can_be_pickled(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        ds = instance_cache.restore(self.cache_dir, {}, None, self.paths)
+        ds = pickle.loads(pickle.dumps(ds))
+        self.assertEquals(ds.metadata['local-hostname'], 'me')
+
+    def _rewrite_header(self, **kwargs):
+        header_fn = os.path.join(self.cache_dir, instance_cache.HEADER_FN)
+        header = json.loads(util.load_file(header_fn))
+        header.update(kwargs)
+        util.write_file(header_fn, json.dumps(header))
+
+    def test_other_schema_ignored(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        self._rewrite_header(schema=instance_cache.SCHEMA_VERSION + 1)
+        self.assertEquals(instance_cache.read_header(self.cache_dir), None)
+        self.assertEquals(instance_cache.restore(self.cache_dir, {}, None,
+                                                 self.paths), None)
+
+    def test_invalid_headers_ignored(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        self._rewrite_header(instance_id=5)
+        self.assertEquals(instance_cache.read_header(self.cache_dir), None)
+        self._rewrite_header(instance_id='i-abcdef',
+                             blobs={'state': '../state.pkl'})
+        self.assertEquals(instance_cache.read_header(self.cache_dir), None)
+        util.write_file(os.path.join(self.cache_dir,
+                                     instance_cache.HEADER_FN), '[1, 2')
+        self.assertEquals(instance_cache.read_header(self.cache_dir), None)
+
+    def test_not_a_datasource(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        self._rewrite_header(datasource='cloudinit.util.load_file')
+        self.assertEquals(instance_cache.restore(self.cache_dir, {}, None,
+                                                 self.paths), None)
+
+    def test_broken_datasource(self):
+
+        class BrokenSource(DataSourceEc2.DataSourceEc2):
+            def __init__(self, sys_cfg, distro, paths):
+                raise ValueError("broken")
+
+        instance_cache.write(self.cache_dir, self._make_ds())
+        find_class = self.mocker.replace(instance_cache._find_class,
+                                         passthrough=False)
+        find_class('cloudinit.sources.DataSourceEc2.DataSourceEc2')
+        self.mocker.result(BrokenSource)
+        self.mocker.replay()
+        self.assertEquals(instance_cache.restore(self.cache_dir, {}, None,
+                                                 self.paths), None)
+
+    def test_missing_blob(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        os.unlink(os.path.join(self.cache_dir, 'metadata.pkl'))
+        self.assertEquals(instance_cache.read_header(self.cache_dir), None)
+
+    def test_rewrite_drops_old_blobs(self):
+        instance_cache.write(self.cache_dir, self._make_ds())
+        ds = DataSourceNone.DataSourceNone({}, None, self.paths)
+        header = instance_cache.write(self.cache_dir, ds)
+        self.assertEquals(header['instance_id'], 'iid-datasource-none')
+        ds = instance_cache.restore(self.cache_dir, {}, None, self.paths)
+        self.assertTrue(isinstance(ds, DataSourceNone.DataSourceNone))
+        self.assertEquals(ds.metadata, {})
+        self.assertEquals(ds.get_userdata_raw(), '')
+
+    def test_legacy(self):
+        pickle_fn = os.path.join(self.tmp, 'obj.pkl')
+        util.write_file(pickle_fn, pickle.dumps(self._make_ds()))
+        ds = instance_cache.load_legacy(pickle_fn)
+        self.assertEquals(ds.get_instance_id(), 'i-abcdef')
+        util.write_file(pickle_fn, pickle.dumps({'metadata': {}}))
+        self.assertEquals(instance_cache.load_legacy(pickle_fn), None)
+        util.write_file(pickle_fn, 'garbage')
+        self.assertEquals(instance_cache.load_legacy(pickle_fn), None)
+        os.unlink(pickle_fn)
+        self.assertEquals(instance_cache.load_legacy(pickle_fn), None)
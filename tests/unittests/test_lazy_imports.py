@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+from unittest import TestCase
+
+TOP_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir, os.pardir))
+
+# Third party modules that are only to be imported when used
+HEAVY_MODULES = ['Cheetah', 'boto', 'configobj', 'email', 'oauth',
+                 'prettytable', 'requests', 'yaml']
+
+
+def _imported_by(code):
+    code = "\n".join([
+        code,
+        "import sys",
+        "print('\\n'.join([n for n in sys.modules if sys.modules[n]]))",
+    ])
+    env = dict(os.environ)
+    env['PYTHONPATH'] = TOP_DIR
+    proc = subprocess.Popen([sys.executable, '-c', code], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = proc.communicate()
+    if proc.returncode != 0:
+        raise AssertionError("Running %r failed: %s" % (code, err))
+    return out.split()
+
+
+class TestLazyImports(TestCase):
+    def _assertNotHeavy(self, loaded):
+        heavy = [m for m in HEAVY_MODULES if m in loaded]
+        self.assertEquals([], heavy)
+
+    def test_stages_import(self):
+        self._assertNotHeavy(_imported_by("from cloudinit import stages"))
+
+    def test_datasource_imports(self):
+        self._assertNotHeavy(_imported_by("\n".join([
+            "from cloudinit import templater",
+            "from cloudinit.sources import DataSourceEc2",
+            "from cloudinit.sources import DataSourceMAAS",
+        ])))
+
+    def test_yaml_on_use(self):
+        loaded = _imported_by("\n".join([
+            "from cloudinit import util",
+            "util.load_yaml('a: 1')",
+        ]))
+        self.assertIn('yaml', loaded)
+        self.assertNotIn('requests', loaded)
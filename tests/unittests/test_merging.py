@@ -1,9 +1,15 @@
 from tests.unittests import helpers
 
+from mocker import MockerTestCase
+
 from cloudinit.handlers import cloud_config
 from cloudinit.handlers import (CONTENT_START, CONTENT_END)
 
 from cloudinit import helpers as c_helpers
+from cloudinit import mergers
+from cloudinit.mergers import m_list
+from cloudinit.mergers import m_str
+from cloudinit import registry
 from cloudinit import util
 
 import collections
@@ -253,3 +259,325 @@ class TestSimpleRun(helpers.ResourceUsingTestCase):
         c = _old_mergedict(a, b)
         d = util.mergemanydict([a, b])
         self.assertEquals(c, d)
+
+
+class TestConstruct(MockerTestCase):
+    def setUp(self):
+        super(TestConstruct, self).setUp()
+        mergers.clear_constructed()
+        self.addCleanup(mergers.clear_constructed)
+
+    def test_same_spec_same_merger(self):
+        a = mergers.construct(mergers.string_extract_mergers(
+            "list(append)+dict(recurse_array)+str()"))
+        b = mergers.construct(mergers.string_extract_mergers(
+            " M_List( append )+dict(recurse_array,)+m_str()"))
+        c = mergers.construct(mergers.dict_extract_mergers({
+            'merge_how': [{'name': 'list', 'settings': ['append']},
+                          ['dict', 'recurse_array'], ['str']],
+        }))
+        self.assertTrue(a is b)
+        self.assertTrue(a is c)
+        d = mergers.construct(mergers.string_extract_mergers(
+            "list(prepend)+dict(recurse_array)+str()"))
+        self.assertFalse(a is d)
+        self.assertEquals({'a': [1, 2]}, a.merge({'a': [1]}, {'a': [2]}))
+        self.assertEquals({'a': [2, 1]}, d.merge({'a': [1]}, {'a': [2]}))
+
+    def test_found_once(self):
+        calls = []
+        find_module = registry.find_module
+
+        def counting_find_module(*args, **kwargs):
+            calls.append(args)
+            return find_module(*args, **kwargs)
+
+        registry.find_module = counting_find_module
+        try:
+            for _i in range(0, 10):
+                util.mergemanydict([{'a': 1}, {'b': [1]}, {'a': 'x'}])
+        finally:
+            registry.find_module = find_module
+        self.assertEquals(3, len(calls))
+
+    def test_unhashable_options(self):
+        parsed = [('dict', {'replace': True})]
+        a = mergers.construct(parsed)
+        self.assertFalse(a is mergers.construct(parsed))
+        self.assertEquals({'a': 2}, a.merge({'a': 1}, {'a': 2}))
+
+    def test_type_dispatch(self):
+        merger = mergers.construct(mergers.default_mergers())
+        view = c_helpers.ConfigView({'a': 1})
+        for _i in range(0, 2):
+            self.assertEquals({'a': 1, 'b': 2},
+                              merger.merge({'a': 1}, {'a': 3, 'b': 2}))
+            self.assertEquals([2, 3], merger.merge([1, 3], [2]))
+            self.assertEquals((2, 3), merger.merge((1, 3), [2]))
+            self.assertEquals(u'b', merger.merge(u'a', 'b'))
+            self.assertEquals(5, merger.merge(5, 6))
+            self.assertTrue(view is merger.merge(view, {'a': 2}))
+            self.assertEquals({'a': 1}, merger.merge({'a': 1}, None))
+
+    def test_lookups_added_later(self):
+        lookups = []
+        merger = mergers.LookupMerger(lookups)
+        self.assertEquals([1], merger.merge([1], [2]))
+        lookups.append(m_list.Merger(merger, ['append']))
+        self.assertEquals([1, 2], merger.merge([1], [2]))
+
+
+# The dict and list mergers as they were before they shared what they do
+# not change (copying every dict and list they merge into), which the
+# current ones are checked against
+class _OldDictMerger(object):
+    def __init__(self, merger, opts):
+        self._merger = merger
+        self._method = 'no_replace'
+        for m in ('replace', 'no_replace'):
+            if m in opts:
+                self._method = m
+                break
+        self._recurse_str = 'recurse_str' in opts
+        self._recurse_array = ('recurse_array' in opts or
+                               'recurse_list' in opts)
+        self._allow_delete = 'allow_delete' in opts
+        self._recurse_dict = True
+
+    def _do_dict_replace(self, value, merge_with, do_replace):
+
+        def merge_same_key(old_v, new_v):
+            if do_replace:
+                return new_v
+            if isinstance(new_v, (list, tuple)) and self._recurse_array:
+                return self._merger.merge(old_v, new_v)
+            if isinstance(new_v, (basestring)) and self._recurse_str:
+                return self._merger.merge(old_v, new_v)
+            if isinstance(new_v, (dict)) and self._recurse_dict:
+                return self._merger.merge(old_v, new_v)
+            return old_v
+
+        for (k, v) in merge_with.items():
+            if k in value:
+                if v is None and self._allow_delete:
+                    value.pop(k)
+                else:
+                    value[k] = merge_same_key(value[k], v)
+            else:
+                value[k] = v
+        return value
+
+    def _on_dict(self, value, merge_with):
+        if not isinstance(merge_with, (dict)):
+            return value
+        return self._do_dict_replace(dict(value), merge_with,
+                                     self._method == 'replace')
+
+
+class _OldListMerger(object):
+    def __init__(self, merger, opts):
+        self._merger = merger
+        self._method = 'replace'
+        for m in ('append', 'prepend', 'replace', 'no_replace'):
+            if m in opts:
+                self._method = m
+                break
+        self._recurse_str = 'recurse_str' in opts
+        self._recurse_dict = 'recurse_dict' in opts
+        self._recurse_array = ('recurse_array' in opts or
+                               'recurse_list' in opts)
+
+    def _on_tuple(self, value, merge_with):
+        return tuple(self._on_list(list(value), merge_with))
+
+    def _on_list(self, value, merge_with):
+        if (self._method == 'replace' and
+            not isinstance(merge_with, (tuple, list))):
+            return merge_with
+        merged_list = []
+        if self._method == 'prepend':
+            merged_list.extend(merge_with)
+            merged_list.extend(value)
+            return merged_list
+        elif self._method == 'append':
+            merged_list.extend(value)
+            merged_list.extend(merge_with)
+            return merged_list
+
+        def merge_same_index(old_v, new_v):
+            if self._method == 'no_replace':
+                return old_v
+            if isinstance(new_v, (list, tuple)) and self._recurse_array:
+                return self._merger.merge(old_v, new_v)
+            if isinstance(new_v, (str, basestring)) and self._recurse_str:
+                return self._merger.merge(old_v, new_v)
+            if isinstance(new_v, (dict)) and self._recurse_dict:
+                return self._merger.merge(old_v, new_v)
+            return new_v
+
+        merged_list.extend(value)
+        common_len = min(len(merged_list), len(merge_with))
+        for i in xrange(0, common_len):
+            merged_list[i] = merge_same_index(merged_list[i], merge_with[i])
+        return merged_list
+
+
+def _old_construct(parsed_mergers):
+    classes = {
+        'dict': _OldDictMerger,
+        'list': _OldListMerger,
+        'str': m_str.Merger,
+    }
+    lookups = []
+    root = mergers.LookupMerger(lookups)
+    for (m_name, m_ops) in parsed_mergers:
+        lookups.append(classes[m_name](root, m_ops))
+    return root
+
+
+MERGER_OPTS = {
+    'dict': [['replace', 'no_replace', None], 'recurse_str', 'recurse_array',
+             'allow_delete'],
+    'list': [['append', 'prepend', 'replace', 'no_replace', None],
+             'recurse_str', 'recurse_dict', 'recurse_array'],
+    'str': ['append'],
+}
+
+
+def _random_spec(rand):
+    spec = []
+    for name in sorted(MERGER_OPTS):
+        opts = []
+        for opt in MERGER_OPTS[name]:
+            if isinstance(opt, list):
+                opt = rand.choice(opt)
+            elif rand.random() < 0.5:
+                opt = None
+            if opt:
+                opts.append(opt)
+        spec.append((name, opts))
+    rand.shuffle(spec)
+    return spec
+
+
+def _random_tree(rand, depth, seen):
+    # Small trees (with few keys, so that what is merged overlaps) that
+    # sometimes reuse parts of earlier trees (like yaml aliases would)
+    if seen and rand.random() < 0.1:
+        return rand.choice(seen)
+    kinds = ['str', 'unicode', 'int', 'none']
+    if depth > 0:
+        kinds.extend(['dict', 'dict', 'list', 'tuple'])
+    kind = rand.choice(kinds)
+    if kind == 'str':
+        return rand.choice(['a', 'b', 'cc'])
+    if kind == 'unicode':
+        return rand.choice([u'a', u'dd'])
+    if kind == 'int':
+        return rand.randint(0, 3)
+    if kind == 'none':
+        return None
+    if kind == 'dict':
+        tree = {}
+        for k in rand.sample('abcde', rand.randint(0, 4)):
+            tree[k] = _random_tree(rand, depth - 1, seen)
+    else:
+        tree = [_random_tree(rand, depth - 1, seen)
+                for _i in range(0, rand.randint(0, 4))]
+        if kind == 'tuple':
+            tree = tuple(tree)
+    seen.append(tree)
+    return tree
+
+
+def _typed(obj):
+    if isinstance(obj, dict):
+        return (type(obj), sorted([(k, _typed(v)) for (k, v) in obj.items()]))
+    if isinstance(obj, (list, tuple)):
+        return (type(obj), [_typed(v) for v in obj])
+    return (type(obj), obj)
+
+
+def _merge_all(merge, sources):
+    merged = {}
+    for (spec, cfg) in sources:
+        merged = merge(spec, merged, cfg)
+    return merged
+
+
+class TestSharing(MockerTestCase):
+    def test_same_as_copying(self):
+        rand = random.Random(42)
+        for _i in range(0, 2000):
+            seen = []
+            sources = []
+            for _j in range(0, rand.randint(1, 6)):
+                cfg = {}
+                for k in rand.sample('abcde', rand.randint(1, 5)):
+                    cfg[k] = _random_tree(rand, 3, seen)
+                sources.append((_random_spec(rand), cfg))
+            before = _typed(sources)
+            try:
+                expected = _merge_all(
+                    lambda spec, a, b: _old_construct(spec).merge(a, b),
+                    sources)
+            except Exception as e:
+                expected = e
+            self.assertEquals(before, _typed(sources))
+            session = mergers.MergeSession()
+            merges = [
+                lambda spec, a, b: mergers.construct(spec).merge(a, b),
+                lambda spec, a, b: session.merge(mergers.construct(spec),
+                                                 a, b),
+            ]
+            for merge in merges:
+                if isinstance(expected, Exception):
+                    self.assertRaises(type(expected), _merge_all, merge,
+                                      sources)
+                else:
+                    self.assertEquals(_typed(expected),
+                                      _typed(_merge_all(merge, sources)),
+                                      "Merging %s" % (sources))
+                # What was merged was not changed
+                self.assertEquals(before, _typed(sources))
+
+    def test_shares_unchanged(self):
+        merger = mergers.construct(mergers.default_mergers())
+        a = {'a': {'b': [1, 2]}, 'c': {'d': 'e'}}
+        self.assertTrue(a is merger.merge(a, {'a': {'b': 3}}))
+        self.assertTrue(a is merger.merge(a, {'a': {}}))
+        merged = merger.merge(a, {'c': {'f': 'g'}, 'h': [1]})
+        self.assertEquals({'a': {'b': [1, 2]}, 'c': {'d': 'e', 'f': 'g'},
+                           'h': [1]}, merged)
+        self.assertEquals({'a': {'b': [1, 2]}, 'c': {'d': 'e'}}, a)
+        self.assertTrue(merged['a'] is a['a'])
+        self.assertFalse(merged['c'] is a['c'])
+
+        merger = mergers.construct(mergers.string_extract_mergers(
+            "list(replace,recurse_dict)+dict()"))
+        b = [{'a': 1}, 'x']
+        self.assertTrue(b is merger.merge(b, [{'a': 2}, 'x']))
+        merged = merger.merge(b, [{'b': 2}, 'y', 'z'])
+        self.assertEquals([{'a': 1, 'b': 2}, 'y'], merged)
+        self.assertEquals([{'a': 1}, 'x'], b)
+
+    def test_session_owns_copies(self):
+        merger = mergers.construct(mergers.string_extract_mergers(
+            "dict(recurse_array)+list(append)"))
+        a = {'a': {'b': [1]}}
+        b = {'a': {'b': [2]}}
+        merged = merger.merge(a, b)
+        self.assertFalse(merged['a']['b'] is merger.merge(merged, b)['a']['b'])
+        session = mergers.MergeSession()
+        first = session.merge(merger, {}, a)
+        second = session.merge(merger, first, b)
+        self.assertTrue(first is second)
+        third = session.merge(merger, second, {'a': {'b': [3]}})
+        self.assertTrue(third is second)
+        self.assertEquals({'a': {'b': [1, 2, 3]}}, third)
+        self.assertEquals({'a': {'b': [1]}}, a)
+        self.assertEquals({'a': {'b': [2]}}, b)
+        # Outside of (another) session what it made is copied again
+        self.assertFalse(third is merger.merge(third, b))
+        self.assertFalse(third is mergers.MergeSession().merge(merger,
+                                                                 third, b))
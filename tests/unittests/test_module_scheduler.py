@@ -0,0 +1,143 @@
+import threading
+import types
+
+from mocker import MockerTestCase
+
+from cloudinit import config
+from cloudinit import helpers
+from cloudinit import stages
+
+from cloudinit.settings import (PER_ALWAYS, RES_ALL, RES_PACKAGES,
+                                RES_USERS)
+
+
+def _make_module(name, handle, **kwargs):
+    mod = types.ModuleType(name)
+    mod.handle = handle
+    mod.frequency = PER_ALWAYS
+    for (k, v) in kwargs.items():
+        setattr(mod, k, v)
+    return config.fixup_module(mod)
+
+
+class TestConflicts(MockerTestCase):
+
+    def test_undeclared_conflicts_with_all(self):
+        a = _make_module('a', None)
+        b = _make_module('b', None, writes=['locale'])
+        self.assertEquals(a.writes, [RES_ALL])
+        self.assertEquals(a.reads, [])
+        self.assertTrue(config.conflicts(a, b))
+        self.assertTrue(config.conflicts(b, a))
+
+    def test_declared(self):
+        locale = _make_module('locale', None, writes=['locale'])
+        tz = _make_module('tz', None, writes=['timezone'])
+        pkgs = _make_module('pkgs', None, writes=[RES_PACKAGES])
+        users = _make_module('users', None, reads=[RES_USERS])
+        more_users = _make_module('more_users', None, reads=[RES_USERS])
+        passwd = _make_module('passwd', None, writes=[RES_USERS])
+        self.assertEquals(locale.reads, [])
+        self.assertFalse(config.conflicts(locale, tz))
+        self.assertFalse(config.conflicts(users, more_users))
+        self.assertFalse(config.conflicts(pkgs, users))
+        self.assertTrue(config.conflicts(users, passwd))
+        self.assertTrue(config.conflicts(passwd, users))
+        self.assertTrue(config.conflicts(pkgs, pkgs))
+
+
+class FakeDistro(object):
+    name = 'ubuntu'
+
+
+class FakeCloud(object):
+    def run(self, _name, functor, args, freq=None):
+        return functor(*args)
+
+
+class FakeInit(object):
+    def __init__(self, paths, cfg):
+        self.paths = paths
+        self.cfg = cfg
+        self.datasource = None
+        self.distro = FakeDistro()
+
+    def cloudify(self):
+        return FakeCloud()
+
+
+class TestScheduler(MockerTestCase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.paths = helpers.Paths({'cloud_dir': self.makeDir()})
+        self.events = []
+        self.lock = threading.Lock()
+
+    def _run(self, mods, cfg):
+        mostly_mods = []
+        for mod in mods:
+            mostly_mods.append([mod, mod.__name__, None, []])
+        modules = stages.Modules(FakeInit(self.paths, cfg))
+        return modules._run_modules(mostly_mods)
+
+    def _recorder(self, name, fail=False, wait_for=None, started=None):
+
+        def handle(_name, _cfg, _cloud, _log, _args):
+            if started:
+                started.set()
+            if wait_for:
+                wait_for.wait(0.5)
+            with self.lock:
+                self.events.append(name)
+            if fail:
+                raise RuntimeError("%s failed" % (name))
+
+        return handle
+
+    def _mods(self):
+        locale_started = threading.Event()
+        mods = [
+            # Blocks until timezone starts (which only
+            # happens when they are ran concurrently)
+            _make_module('locale',
+                         self._recorder('locale', wait_for=locale_started),
+                         writes=['locale']),
+            _make_module('timezone',
+                         self._recorder('timezone', started=locale_started),
+                         writes=['timezone']),
+            _make_module('apt', self._recorder('apt', fail=True),
+                         writes=[RES_PACKAGES]),
+            _make_module('landscape', self._recorder('landscape'),
+                         writes=[RES_PACKAGES, 'landscape']),
+            _make_module('runcmd', self._recorder('runcmd')),
+            _make_module('final', self._recorder('final', fail=True),
+                         writes=['console']),
+        ]
+        return mods
+
+    def test_same_accounting(self):
+        (which_ran, failures) = self._run(self._mods(), {})
+        serial_events = list(self.events)
+        self.events = []
+        (p_which_ran, p_failures) = self._run(self._mods(),
+                                              {'modules_parallel': True})
+        self.assertEquals(which_ran, p_which_ran)
+        self.assertEquals([f[0] for f in failures],
+                          [f[0] for f in p_failures])
+        self.assertEquals(which_ran, ['locale', 'timezone', 'apt',
+                                      'landscape', 'runcmd', 'final'])
+        self.assertEquals([f[0] for f in failures], ['apt', 'final'])
+
+        # Serially locale waited (and gave up) on timezone, concurrently
+        # timezone got to run first...
+        self.assertEquals(serial_events, ['locale', 'timezone', 'apt',
+                                          'landscape', 'runcmd', 'final'])
+        self.assertTrue(self.events.index('timezone') <
+                        self.events.index('locale'))
+
+        # But conflicting modules kept their order
+        for (before, after) in [('apt', 'landscape'), ('landscape', 'runcmd'),
+                                ('locale', 'runcmd'), ('runcmd', 'final')]:
+            self.assertTrue(self.events.index(before) <
+                            self.events.index(after))
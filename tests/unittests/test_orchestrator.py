@@ -0,0 +1,168 @@
+import os
+import socket
+import threading
+
+from mocker import MockerTestCase
+
+from cloudinit import orchestrator
+from cloudinit import util
+
+
+class TestOrchestrator(MockerTestCase):
+    def setUp(self):
+        super(TestOrchestrator, self).setUp()
+        self.sock_fn = os.path.join(self.makeDir(), "run", "boot.sock")
+        self.asked = []
+        self.results = {}
+
+    def _run_stage(self, stage, argv):
+        self.asked.append((stage, argv))
+        result = self.results.get(stage, 0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def _start(self, idle_timeout=5):
+        orch = orchestrator.Orchestrator(self._run_stage,
+                                         sock_fn=self.sock_fn,
+                                         idle_timeout=idle_timeout)
+        orch.listen()
+        served = []
+        t = threading.Thread(target=lambda: served.append(orch.serve()))
+        t.daemon = True
+        t.start()
+        return (t, served)
+
+    def test_not_listening(self):
+        self.assertEquals(None, orchestrator.delegate('init', [],
+                                                      sock_fn=self.sock_fn))
+
+    def test_stale_socket(self):
+        os.makedirs(os.path.dirname(self.sock_fn))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.sock_fn)
+        sock.close()
+        self.assertEquals(None, orchestrator.delegate('init', [],
+                                                      sock_fn=self.sock_fn))
+
+    def test_runs_stages(self):
+        self.results['modules-config'] = 3
+        (t, served) = self._start()
+        for stage in ['init-local', 'init', 'modules-config']:
+            argv = ['modules', '--mode', stage]
+            result = orchestrator.delegate(stage, argv, sock_fn=self.sock_fn)
+            self.assertEquals(self.results.get(stage, 0), result)
+        self.assertTrue(t.is_alive())
+        self.assertEquals(0, orchestrator.delegate('modules-final', [],
+                                                   sock_fn=self.sock_fn))
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEquals(['init-local', 'init', 'modules-config',
+                           'modules-final'], [s for (s, _a) in self.asked])
+        self.assertEquals(['modules', '--mode', 'init-local'],
+                          self.asked[0][1])
+        self.assertEquals([('init-local', 0), ('init', 0),
+                           ('modules-config', 3), ('modules-final', 0)],
+                          served[0])
+        self.assertFalse(os.path.exists(self.sock_fn))
+
+    def test_refuses_out_of_order(self):
+        (t, _served) = self._start()
+        self.assertEquals(0, orchestrator.delegate('modules-config', [],
+                                                   sock_fn=self.sock_fn))
+        self.assertEquals(None, orchestrator.delegate('init', [],
+                                                      sock_fn=self.sock_fn))
+        self.assertEquals(None, orchestrator.delegate('modules-config', [],
+                                                      sock_fn=self.sock_fn))
+        self.assertEquals(None, orchestrator.delegate('single', [],
+                                                      sock_fn=self.sock_fn))
+        self.assertEquals(['modules-config'], [s for (s, _a) in self.asked])
+        orchestrator.delegate('modules-final', [], sock_fn=self.sock_fn)
+        t.join(5)
+
+    def test_stage_failures(self):
+        self.results['init'] = RuntimeError("broken")
+        self.results['modules-config'] = SystemExit(2)
+        (t, _served) = self._start()
+        self.assertEquals(1, orchestrator.delegate('init', [],
+                                                   sock_fn=self.sock_fn))
+        self.assertEquals(2, orchestrator.delegate('modules-config', [],
+                                                   sock_fn=self.sock_fn))
+        orchestrator.delegate('modules-final', [], sock_fn=self.sock_fn)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+    def test_idle_timeout(self):
+        (t, served) = self._start(idle_timeout=0.1)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEquals([], served[0])
+        self.assertFalse(os.path.exists(self.sock_fn))
+
+
+class TestNotify(MockerTestCase):
+    def test_no_systemd(self):
+        old_addr = os.environ.pop('NOTIFY_SOCKET', None)
+        try:
+            self.assertFalse(orchestrator.notify("READY=1"))
+        finally:
+            if old_addr is not None:
+                os.environ['NOTIFY_SOCKET'] = old_addr
+
+    def test_notify(self):
+        notify_fn = os.path.join(self.makeDir(), "notify")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(notify_fn)
+        try:
+            os.environ['NOTIFY_SOCKET'] = notify_fn
+            try:
+                self.assertTrue(orchestrator.notify("READY=1"))
+            finally:
+                del os.environ['NOTIFY_SOCKET']
+            self.assertEquals("READY=1", sock.recv(1024))
+        finally:
+            sock.close()
+
+
+class TestSharedState(MockerTestCase):
+    def test_reusable(self):
+        shared = orchestrator.SharedState()
+        self.assertFalse(shared.reusable([]))
+        shared.keep('init', 'mods', ['/etc/extra.cfg'])
+        self.assertTrue(shared.reusable(['/etc/extra.cfg']))
+        self.assertFalse(shared.reusable([]))
+
+    def test_output_redirected_once(self):
+        tee = '| tee -a /var/log/cloud-init-output.log'
+        cfg = {'output': {'all': tee}}
+        close_stdin = self.mocker.replace(util.close_stdin,
+                                          passthrough=False)
+        close_stdin()
+        self.mocker.count(1)
+        fixup_output = self.mocker.replace(util.fixup_output,
+                                           passthrough=False)
+        fixup_output(cfg, 'init')
+        self.mocker.result([tee, tee])
+        self.mocker.count(1)
+        self.mocker.replay()
+        shared = orchestrator.SharedState()
+        for name in ['init', 'config', 'final']:
+            self.assertEquals((tee, tee), shared.setup_output(cfg, name))
+
+    def test_output_redirected_when_configured(self):
+        tee = '| tee -a /var/log/cloud-init-output.log'
+        fixup_output = self.mocker.replace(util.fixup_output,
+                                           passthrough=False)
+        close_stdin = self.mocker.replace(util.close_stdin,
+                                          passthrough=False)
+        close_stdin()
+        fixup_output({}, 'init')
+        self.mocker.result([None, None])
+        fixup_output({'output': {'all': tee}}, 'config')
+        self.mocker.result([tee, tee])
+        self.mocker.replay()
+        shared = orchestrator.SharedState()
+        self.assertEquals((None, None), shared.setup_output({}, 'init'))
+        for name in ['config', 'final']:
+            self.assertEquals((tee, tee), shared.setup_output(
+                {'output': {'all': tee}}, name))
@@ -0,0 +1,106 @@
+import os
+
+from mocker import MockerTestCase
+
+import cloudinit
+
+from cloudinit import config
+from cloudinit import importer
+from cloudinit import registry
+
+from cloudinit.settings import PER_ALWAYS
+
+PKG_DIR = os.path.dirname(os.path.abspath(cloudinit.__file__))
+
+
+class TestBuild(MockerTestCase):
+
+    def test_build(self):
+        built = registry.build(PKG_DIR)
+        self.assertEquals(sorted(built.keys()),
+                          ['config', 'distros', 'mergers', 'sources'])
+        self.assertEquals(built['config']['cc_bootcmd'], {
+            'path': 'cloudinit.config.cc_bootcmd',
+            'attrs': ['handle'],
+            'frequency': PER_ALWAYS,
+        })
+        self.assertEquals(built['config']['cc_byobu']['distros'],
+                          ['ubuntu', 'debian'])
+        self.assertEquals(built['mergers']['m_dict']['path'],
+                          'cloudinit.mergers.m_dict')
+        self.assertEquals(built['sources']['DataSourceEc2']['attrs'],
+                          ['get_datasource_list'])
+        self.assertEquals(built['distros']['ubuntu']['path'],
+                          'cloudinit.distros.ubuntu')
+        self.assertFalse('__init__' in built['distros'])
+
+    def test_write(self):
+        fn = os.path.join(self.makeDir(), registry.REGISTRY_FN)
+        built = registry.write(fn, PKG_DIR)
+        env = {}
+        execfile(fn, env)
+        self.assertEquals(env['REGISTRY'], built)
+
+    def test_scan_module(self):
+        fn = os.path.join(self.makeDir(), 'cc_thing.py')
+        with open(fn, 'w') as fh:
+            fh.write("from cloudinit.settings import PER_ALWAYS\n"
+                     "import os.path\n"
+                     "frequency = PER_ALWAYS\n"
+                     "distros = ['fedora']\n"
+                     "osfamilies = make_them()\n"
+                     "def handle(*args):\n"
+                     "    pass\n")
+        (names, values) = registry.scan_module(fn)
+        for n in ['PER_ALWAYS', 'os', 'frequency', 'distros', 'handle']:
+            self.assertTrue(n in names)
+        self.assertEquals(values, {'frequency': PER_ALWAYS,
+                                   'distros': ['fedora']})
+
+
+class TestFindModule(MockerTestCase):
+
+    def setUp(self):
+        super(TestFindModule, self).setUp()
+        self.orig_registry = list(registry._REGISTRY)
+        self.orig_find_module = importer.find_module
+        self.searched = []
+
+        def find_module(base_name, search_paths, required_attrs=None):
+            self.searched.append(base_name)
+            return self.orig_find_module(base_name, search_paths,
+                                         required_attrs)
+
+        importer.find_module = find_module
+        registry._REGISTRY[:] = [registry.build(PKG_DIR)]
+
+    def tearDown(self):
+        importer.find_module = self.orig_find_module
+        registry._REGISTRY[:] = self.orig_registry
+        super(TestFindModule, self).tearDown()
+
+    def test_registered(self):
+        self.assertEquals(config.find_module('cc_runcmd'),
+                          ['cloudinit.config.cc_runcmd'])
+        self.assertEquals(self.searched, [])
+
+    def test_unregistered_searched(self):
+        self.assertEquals(config.find_module('cc_not_a_module'), [])
+        self.assertEquals(self.searched, ['cc_not_a_module'])
+
+    def test_stale_entry_searched(self):
+        registry._REGISTRY[0]['config']['cc_gone'] = {
+            'path': 'cloudinit.config.cc_gone',
+            'attrs': ['handle'],
+        }
+        registry._REGISTRY[0]['config']['cc_runcmd']['attrs'] = []
+        self.assertEquals(config.find_module('cc_gone'), [])
+        self.assertEquals(config.find_module('cc_runcmd'),
+                          ['cloudinit.config.cc_runcmd'])
+        self.assertEquals(self.searched, ['cc_gone', 'cc_runcmd'])
+
+    def test_missing_attrs_searched(self):
+        self.assertEquals(registry.find_module('mergers', 'm_dict',
+                                               ['cloudinit.mergers'],
+                                               ['Merger', 'NotThere']), [])
+        self.assertEquals(self.searched, ['m_dict'])
@@ -0,0 +1,147 @@
+"""Tests that the libyaml loader and dumper agree with the python ones."""
+
+import datetime
+import glob
+import os
+import random
+import yaml
+
+from unittest import TestCase
+
+from cloudinit import helpers
+from cloudinit import safeyaml
+
+from tests import yaml_corpus
+
+TOP_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir, os.pardir))
+
+SAMPLES = [
+    "",
+    "# just a comment\n",
+    "a: 1\nb: [1, 2.5, -3, 0x10, 0o17, .inf, -.nan, ~, null, true, no]\n",
+    "when: 2014-01-02\nstamp: 2014-01-02T03:04:05Z\n",
+    "text: |\n  line one\n   line two\n\n  after blank\nfolded: >\n  a\n"
+    "  b\n\n  c\n",
+    "quoted: ['single ''x''', \"double \\\"y\\\" \\t\\u00e9\", plain]\n",
+    "uni: !!python/unicode 'caf\\xe9'\nascii: !!python/unicode 'abc'\n",
+    "base: &base {a: 1, b: [x, y]}\nderived:\n  <<: *base\n  b: z\n"
+    "again: *base\n",
+    "set: !!set {a, b}\nbin: !!binary aGVsbG8=\nomap: !!omap [{a: 1}]\n",
+    "--- \n- a\n- - b\n  - {c: d, e: [f, {g: h}]}\n...\n",
+    "key with spaces: value: with colon\n'1': one\n? complex\n: key\n",
+    "runcmd:\n - [ls, -l, /]\n - 'echo \"$HOME\"'\n - |\n   #!/bin/sh\n"
+    "   echo hi\n",
+    u"unicode: \u00fcber \u2603\nemoji: \"\\U0001F600\"\n".encode('utf-8'),
+    "long: %s\n" % (" ".join(["word"] * 60)),
+    "tabs:\t'value'\nnested:\n  - \"a\\tb\"\n",
+]
+
+
+def _corpus():
+    rand = random.Random(42)
+    blobs = list(SAMPLES)
+    blobs.append(yaml_corpus.write_files_config(rand, 256 * 1024))
+    blobs.append(yaml_corpus.ca_certs_config(rand, 50, style='|'))
+    fns = glob.glob(os.path.join(TOP_DIR, 'doc', 'examples', '*.txt'))
+    fns.append(os.path.join(TOP_DIR, 'config', 'cloud.cfg'))
+    fns.extend(glob.glob(os.path.join(TOP_DIR, 'config', 'cloud.cfg.d',
+                                      '*.cfg')))
+    for fn in sorted(fns):
+        with open(fn, 'rb') as fh:
+            blobs.append(fh.read())
+    return blobs
+
+
+def _typed(obj):
+    # What was loaded along with the types of all of it (so that a str
+    # and a unicode that compare equal still count as different)
+    if isinstance(obj, dict):
+        return (type(obj), sorted([(_typed(k), _typed(v))
+                                   for (k, v) in obj.items()]))
+    if isinstance(obj, (list, tuple)):
+        return (type(obj), [_typed(v) for v in obj])
+    if isinstance(obj, float) and obj != obj:
+        return (float, 'nan')
+    return (type(obj), obj)
+
+
+def _py_load(blob):
+    return yaml.load(blob, Loader=safeyaml._CustomSafeLoader)
+
+
+class TestConformance(TestCase):
+    def setUp(self):
+        if not safeyaml.HAS_LIBYAML:
+            self.skipTest("PyYAML was built without libyaml")
+
+    def test_load(self):
+        loaded = 0
+        for blob in _corpus():
+            try:
+                expected = _py_load(blob)
+            except yaml.YAMLError:
+                continue
+            self.assertEquals(
+                _typed(expected),
+                _typed(yaml.load(blob, Loader=safeyaml._CustomCSafeLoader)),
+                "Loading differs for %r" % (blob[0:60]))
+            self.assertEquals(_typed(expected), _typed(safeyaml.load(blob)))
+            loaded += 1
+        self.assertTrue(loaded > len(SAMPLES))
+
+    def test_dump(self):
+        objs = [{
+            'str': 'abc',
+            'unicode': u'caf\xe9',
+            'unicode-ascii': u'abc',
+            'unicode-tagged': [u'', u'a b', u'123', u'- x', u'l1\nl2'],
+            'long': [long(5), 2 ** 70],
+            'type': object,
+            'tuple': (1, 2),
+            'multi': "line one\nline two\n",
+            'words': " ".join(["word"] * 60),
+            'specials': ['', 'null', 'yes', '1.0', '- a', 'a: b', '#c',
+                         "it's", '"q"', ' lead', 'trail ', '\t'],
+            'numbers': [0, -1, 1.5, float('inf')],
+            'date': datetime.date(2014, 1, 2),
+            'nested': [[], {}, [{'a': [1, {'b': None}]}]],
+            'view': helpers.ConfigView({'a': {'b': 1}}),
+        }]
+        for blob in _corpus():
+            try:
+                objs.append(_py_load(blob))
+            except yaml.YAMLError:
+                pass
+        for obj in objs:
+            expected = yaml.dump(obj, Dumper=yaml.Dumper, line_break="\n",
+                                 indent=4, explicit_start=True,
+                                 explicit_end=True, default_flow_style=False)
+            self.assertEquals(expected, safeyaml.dumps(obj))
+        # And what was dumped loads back the same
+        self.assertEquals(
+            {'a': {'b': 1}},
+            safeyaml.load(safeyaml.dumps(helpers.ConfigView({'a': {'b': 1}}))))
+
+
+class BrokenLoader(object):
+    def __init__(self, _stream):
+        raise yaml.YAMLError("libyaml said no")
+
+
+class TestFallback(TestCase):
+    def setUp(self):
+        self.c_loader = safeyaml._CustomCSafeLoader
+
+    def tearDown(self):
+        safeyaml._CustomCSafeLoader = self.c_loader
+
+    def test_without_libyaml(self):
+        safeyaml._CustomCSafeLoader = None
+        self.assertEquals({'a': [u'caf\xe9']},
+                          safeyaml.load('a: [!!python/unicode "caf\\xe9"]'))
+
+    def test_rejected_by_libyaml(self):
+        safeyaml._CustomCSafeLoader = BrokenLoader
+        self.assertEquals({'a': 1}, safeyaml.load("a: 1"))
+        self.assertRaises(yaml.YAMLError, safeyaml.load, "1\n 2:")
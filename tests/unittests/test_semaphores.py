@@ -0,0 +1,162 @@
+import os
+
+from mocker import MockerTestCase
+
+from cloudinit import distros
+from cloudinit import helpers
+from cloudinit import stages
+
+from cloudinit.settings import (PER_INSTANCE, PER_ONCE)
+
+
+class TestJournalSemaphores(MockerTestCase):
+    def setUp(self):
+        super(TestJournalSemaphores, self).setUp()
+        self.sem_path = os.path.join(self.makeDir(), "sem")
+        self.journal_fn = "%s.journal" % (self.sem_path)
+
+    def _fresh(self):
+        # As if another process (that has not read the journal) used it
+        helpers._get_sem_journal(self.sem_path).forget()
+        return helpers.JournalSemaphores(self.sem_path)
+
+    def test_lock(self):
+        sems = helpers.JournalSemaphores(self.sem_path)
+        self.assertFalse(sems.has_run('config-a', PER_INSTANCE))
+        with sems.lock('config-a', PER_INSTANCE) as lk:
+            self.assertTrue(lk)
+        with sems.lock('config-a', PER_ONCE) as lk:
+            self.assertTrue(lk)
+        with sems.lock('config_a', PER_INSTANCE) as lk:
+            self.assertEquals(None, lk)
+        sems = self._fresh()
+        self.assertTrue(sems.has_run('config-a', PER_INSTANCE))
+        self.assertTrue(sems.has_run('config_a', PER_ONCE))
+        # Nothing but the journal is written
+        self.assertFalse(os.path.exists(self.sem_path))
+        self.assertEquals(['+ config_a', '+ config_a.once'],
+                          [" ".join(l.split()[0:2]) for l in
+                           open(self.journal_fn).read().splitlines()])
+
+    def test_clear(self):
+        sems = helpers.JournalSemaphores(self.sem_path)
+        try:
+            with sems.lock('config-a', PER_INSTANCE, True):
+                raise RuntimeError("broken")
+        except RuntimeError:
+            pass
+        self.assertFalse(sems.has_run('config-a', PER_INSTANCE))
+        self.assertFalse(self._fresh().has_run('config-a', PER_INSTANCE))
+        with sems.lock('config-a', PER_INSTANCE):
+            pass
+        sems.clear_all()
+        self.assertFalse(os.path.exists(self.journal_fn))
+        self.assertFalse(sems.has_run('config-a', PER_INSTANCE))
+
+    def test_sees_other_processes(self):
+        sems = helpers.JournalSemaphores(self.sem_path)
+        self.assertFalse(sems.has_run('config-a', PER_INSTANCE))
+        open(self.journal_fn, 'ab').write("+ config_a 1 0.0\n+ config_b")
+        # Only read again when acquiring (under the lock)
+        with sems.lock('config-a', PER_INSTANCE) as lk:
+            self.assertEquals(None, lk)
+        # And the partial record is not appended to
+        with sems.lock('config-c', PER_INSTANCE) as lk:
+            self.assertTrue(lk)
+        sems = self._fresh()
+        self.assertTrue(sems.has_run('config-c', PER_INSTANCE))
+        self.assertFalse(sems.has_run('config-b', PER_INSTANCE))
+
+    def test_one_process_wins(self):
+        helpers.JournalSemaphores(self.sem_path).has_run('a', PER_INSTANCE)
+        pids = []
+        for _i in range(0, 4):
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    with self._fresh().lock('a', PER_INSTANCE) as lk:
+                        if lk:
+                            code = 0
+                finally:
+                    os._exit(code)
+            pids.append(pid)
+        codes = [os.WEXITSTATUS(os.waitpid(p, 0)[1]) for p in pids]
+        self.assertEquals([0, 1, 1, 1], sorted(codes))
+
+    def test_semaphore_files(self):
+        os.makedirs(self.sem_path)
+        for name in ['config_a', 'config-b', 'config_c.once']:
+            open(os.path.join(self.sem_path, name), 'wb').write("1: 0.0\n")
+        sems = self._fresh()
+        self.assertTrue(sems.has_run('config-a', PER_INSTANCE))
+        self.assertTrue(sems.has_run('config-b', PER_INSTANCE))
+        self.assertTrue(sems.has_run('config-c', PER_ONCE))
+        sems.clear('config-a', PER_INSTANCE)
+        # Clearing in the journal wins over the file
+        self.assertFalse(self._fresh().has_run('config-a', PER_INSTANCE))
+        self.assertEquals(['config-b', 'config_c.once'],
+                          sorted(sems.import_files()))
+        self.assertEquals([], sems.import_files())
+        os.unlink(os.path.join(self.sem_path, 'config_c.once'))
+        self.assertTrue(self._fresh().has_run('config-c', PER_ONCE))
+
+    def test_runners(self):
+        paths = helpers.Paths({'cloud_dir': self.makeDir()})
+        runners = helpers.Runners(paths, helpers.SEM_BACKEND_JOURNAL)
+        ran = []
+        self.assertEquals((True, None),
+                          runners.run('a', ran.append, [1], PER_ONCE))
+        self.assertEquals((False, None),
+                          runners.run('a', ran.append, [2], PER_ONCE))
+        self.assertEquals([1], ran)
+        self.assertTrue(os.path.isfile("%s.journal"
+                                       % (paths.get_cpath('sem'))))
+        helpers.sync_semaphores()
+
+
+def _concrete(distro_cls):
+    # The distros do not implement all that they should (yet)
+    return type(distro_cls.__name__, (distro_cls,),
+                {'upgrade_packages': lambda *_args: None})
+
+
+class TestDistroRunner(MockerTestCase):
+    def setUp(self):
+        super(TestDistroRunner, self).setUp()
+        self.cloud_dir = self.makeDir()
+        self.paths = helpers.Paths({'cloud_dir': self.cloud_dir})
+
+    def test_distros(self):
+        for name in ['debian', 'rhel']:
+            cls = _concrete(distros.fetch(name))
+            distro = cls(name, {'semaphore_backend': 'journal'}, self.paths)
+            self.assertTrue(isinstance(
+                distro._runner._get_sem(PER_ONCE),  # pylint: disable=W0212
+                helpers.JournalSemaphores))
+            distro = cls(name, {}, self.paths)
+            self.assertTrue(isinstance(
+                distro._runner._get_sem(PER_ONCE),  # pylint: disable=W0212
+                helpers.FileSemaphores))
+
+    def test_handed_down(self):
+        base_cfg = {
+            'semaphore_backend': 'journal',
+            'system_info': {
+                'distro': 'debian',
+                'paths': {'cloud_dir': self.cloud_dir},
+            },
+        }
+        orig_fetch = stages.fetch_base_config
+        stages.fetch_base_config = lambda cache_fn=None: base_cfg
+        fetch = self.mocker.replace(distros.fetch, passthrough=False)
+        fetch('debian')
+        self.mocker.result(_concrete(distros.fetch('debian')))
+        self.mocker.replay()
+        try:
+            init = stages.Init(ds_deps=[])
+            runner = init.distro._runner  # pylint: disable=W0212
+        finally:
+            stages.fetch_base_config = orig_fetch
+        self.assertTrue(isinstance(runner._get_sem(PER_ONCE),
+                                   helpers.JournalSemaphores))
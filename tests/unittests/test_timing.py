@@ -0,0 +1,144 @@
+import json
+import os
+
+from mocker import MockerTestCase
+
+from cloudinit import helpers
+from cloudinit import timing
+from cloudinit import workers
+
+
+class TestTiming(MockerTestCase):
+
+    def setUp(self):
+        super(TestTiming, self).setUp()
+        del timing._PENDING[:]
+        timing._TARGET['fn'] = None
+        self.tmp = self.makeDir()
+
+    def tearDown(self):
+        del timing._PENDING[:]
+        timing._TARGET['fn'] = None
+        super(TestTiming, self).tearDown()
+
+    def _names(self):
+        return [e['name'] for e in timing._PENDING]
+
+    def test_nested_names(self):
+        with timing.timed('init'):
+            with timing.timed('fetch'):
+                pass
+            with timing.timed('config-ssh'):
+                pass
+        self.assertEquals(self._names(),
+                          ['init/fetch', 'init/config-ssh', 'init'])
+        for e in timing._PENDING:
+            self.assertEquals(e['stage'], 'init')
+            self.assertEquals(e['result'], timing.RESULT_SUCCESS)
+
+    def test_failure_and_skip(self):
+        try:
+            with timing.timed('boom'):
+                raise ValueError("boom")
+        except ValueError:
+            pass
+        with timing.timed('done-before') as t:
+            t.result = timing.RESULT_SKIPPED
+        results = [e['result'] for e in timing._PENDING]
+        self.assertEquals(results, [timing.RESULT_FAIL,
+                                    timing.RESULT_SKIPPED])
+
+    def test_threads_nest_under_stage(self):
+
+        def probe():
+            with timing.timed('probe'):
+                pass
+
+        with timing.timed('init'):
+            with workers.Pool(2) as pool:
+                pool.submit(probe).result()
+        self.assertEquals(self._names(), ['init/probe', 'init'])
+
+    def test_flush_appends(self):
+        paths = helpers.Paths({'cloud_dir': self.tmp})
+        fn = timing.set_target(paths)
+        self.assertEquals(fn, os.path.join(self.tmp, 'boot-timing.jsonl'))
+        with timing.timed('init'):
+            pass
+        self.assertEquals(timing.flush(), 1)
+        with timing.timed('modules-final'):
+            pass
+        self.assertEquals(timing.flush(), 1)
+        self.assertEquals(timing.flush(), 0)
+        events = timing.load_events(fn)
+        self.assertEquals([e['name'] for e in events],
+                          ['init', 'modules-final'])
+
+    def test_flush_without_target(self):
+        with timing.timed('init'):
+            pass
+        self.assertEquals(timing.flush(), 0)
+        self.assertEquals(len(timing._PENDING), 1)
+
+    def test_load_skips_garbage(self):
+        fn = os.path.join(self.tmp, 'events')
+        with open(fn, 'w') as fh:
+            fh.write(json.dumps({'name': 'init'}) + "\n")
+            fh.write("{not json\n\n")
+        self.assertEquals(timing.load_events(fn), [{'name': 'init'}])
+
+
+def _event(name, start, duration, boot_id='a'):
+    return {
+        'name': name,
+        'stage': name.split('/')[0],
+        'start': start,
+        'duration': duration,
+        'result': timing.RESULT_SUCCESS,
+        'boot_id': boot_id,
+    }
+
+
+class TestReports(MockerTestCase):
+
+    def test_split_boots(self):
+        events = [
+            _event('init', 10, 1, 'b'),
+            _event('init', 0, 1, 'a'),
+            _event('modules-final', 20, 1, None),
+        ]
+        boots = timing.split_boots(events)
+        self.assertEquals([b[0] for b in boots], ['a', 'b'])
+        self.assertEquals([e['name'] for e in boots[1][1]],
+                          ['init', 'modules-final'])
+
+    def test_show(self):
+        events = [
+            _event('init/fetch', 1, 2),
+            _event('init', 0, 5),
+        ]
+        lines = timing.show(events)
+        self.assertEquals(len(lines), 2)
+        self.assertTrue(lines[0].startswith('+0.000s init: 5.000s'))
+        self.assertTrue(lines[1].startswith('  +1.000s fetch: 2.000s'))
+
+    def test_blame(self):
+        events = [
+            _event('init', 0, 5),
+            _event('init/fetch', 0, 1),
+            _event('init/config-ssh', 1, 3),
+        ]
+        lines = timing.blame(events)
+        self.assertEquals([l.split()[-1] for l in lines],
+                          ['init/config-ssh', 'init/fetch'])
+        lines = timing.blame(events, stages_too=True)
+        self.assertEquals(lines[0].split()[-1], 'init')
+
+    def test_diff(self):
+        old = [_event('init', 0, 5), _event('init/fetch', 0, 4)]
+        new = [_event('init', 0, 2), _event('init/config-ssh', 0, 1)]
+        lines = timing.diff(old, new)
+        self.assertEquals([l.split()[-1] for l in lines],
+                          ['init/config-ssh', 'init', 'init/fetch'])
+        self.assertTrue(lines[0].strip().startswith('+1.000s'))
+        self.assertTrue(lines[-1].strip().startswith('-4.000s'))
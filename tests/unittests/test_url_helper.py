@@ -0,0 +1,352 @@
+import BaseHTTPServer
+import gzip
+import threading
+
+from StringIO import StringIO
+
+from mocker import MockerTestCase
+
+from cloudinit import url_helper
+
+from tests.unittests import helpers
+
+
+class CountingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+
+    def do_GET(self):
+        body = self.path
+        if self.path == '/slow':
+            # Answered once the test is done
+            self.server.release.wait(10)
+        if self.path == '/ok':
+            # Answered only after '/bad' was (when it is being read)
+            self.server.bad_answered.wait(10)
+        if self.path == '/empty':
+            body = ''
+        if self.path == '/cookies':
+            body = self.headers.get('Cookie', '')
+        if self.path.startswith('/big'):
+            body = 'x' * int(self.path.split('/')[-1])
+        encoding = None
+        if (self.path.startswith('/big') and
+            'gzip' in self.headers.get('Accept-Encoding', '')):
+            buf = StringIO()
+            gh = gzip.GzipFile(fileobj=buf, mode='wb')
+            gh.write(body)
+            gh.close()
+            body = buf.getvalue()
+            encoding = 'gzip'
+        if self.path == '/bad':
+            self.send_response(500)
+        elif self.path == '/flaky' and self.server.failures > 0:
+            self.server.failures -= 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+        else:
+            self.send_response(200)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if self.path == '/set-cookie':
+            self.send_header('Set-Cookie', 'seen=1; Path=/')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/bad':
+            self.server.bad_answered.set()
+
+    def log_message(self, *_args):
+        pass
+
+
+class CountingTestCase(helpers.HTTPServerTestCase):
+    handler = CountingHandler
+
+    def setUp(self):
+        url_helper.close_sessions()
+        super(CountingTestCase, self).setUp()
+        self.server.connections = []
+        self.server.failures = 0
+        self.server.release = threading.Event()
+        self.server.bad_answered = threading.Event()
+        self.base_url = self.server.url
+
+    def tearDown(self):
+        self.server.release.set()
+        super(CountingTestCase, self).tearDown()
+
+
+class TestSessions(CountingTestCase):
+
+    def test_reuses_connections(self):
+        for i in range(0, 20):
+            resp = url_helper.readurl("%s/key-%s" % (self.base_url, i))
+            self.assertEquals("/key-%s" % (i), resp.contents)
+        self.assertEquals(1, len(self.server.connections))
+        url = url_helper.wait_for_url([self.base_url + "/ready"],
+                                      max_wait=1, timeout=1)
+        self.assertEquals(self.base_url + "/ready", url)
+        self.assertEquals(1, len(self.server.connections))
+
+    def test_close_sessions(self):
+        url_helper.readurl(self.base_url + "/a")
+        self.assertEquals(1, len(url_helper._SESSIONS))
+        url_helper.close_sessions()
+        self.assertEquals({}, url_helper._SESSIONS)
+        url_helper.readurl(self.base_url + "/b")
+        self.assertEquals(2, len(self.server.connections))
+
+    def test_bounded_sessions(self):
+        old_max = url_helper.MAX_SESSIONS
+        url_helper.MAX_SESSIONS = 2
+        try:
+            for host in ['127.0.0.1', 'localhost', '127.0.0.1', 'ip6-x']:
+                url = "http://%s:%s/a" % (host, self.server.server_port)
+                url_helper._release_session(
+                    url_helper._acquire_session(url, {}))
+                self.assertTrue(len(url_helper._SESSIONS) <= 2)
+            self.assertEquals(['127.0.0.1', 'ip6-x'],
+                              [k[1].split(":")[0]
+                               for k in url_helper._SESSIONS_USED])
+        finally:
+            url_helper.MAX_SESSIONS = old_max
+
+    def _watch_close(self, pooled, closed):
+        closer = pooled.session.close
+
+        def close():
+            closed.append(pooled)
+            closer()
+
+        pooled.session.close = close
+
+    def test_evicted_closed_when_unused(self):
+        old_max = url_helper.MAX_SESSIONS
+        url_helper.MAX_SESSIONS = 1
+        closed = []
+        try:
+            first = url_helper._acquire_session(self.base_url, {})
+            self._watch_close(first, closed)
+            second = url_helper._acquire_session("http://localhost/", {})
+            self._watch_close(second, closed)
+            self.assertEquals([second], url_helper._SESSIONS.values())
+            # Still being used (by the first read)
+            self.assertEquals([], closed)
+            self.assertEquals('/a', first.session.get(self.base_url +
+                                                      '/a').content)
+            url_helper._release_session(first)
+            self.assertEquals([first], closed)
+            url_helper._release_session(second)
+            self.assertEquals([first], closed)
+            url_helper.close_sessions()
+            self.assertEquals([first, second], closed)
+        finally:
+            url_helper.MAX_SESSIONS = old_max
+
+    def test_close_sessions_in_use(self):
+        closed = []
+        pooled = url_helper._acquire_session(self.base_url, {})
+        self._watch_close(pooled, closed)
+        url_helper.close_sessions()
+        self.assertEquals([], closed)
+        url_helper._release_session(pooled)
+        self.assertEquals([pooled], closed)
+
+    def test_no_cookies_kept(self):
+        url_helper.readurl(self.base_url + "/set-cookie")
+        self.assertEquals('', url_helper.readurl(self.base_url +
+                                                 "/cookies").contents)
+
+
+class TestWaitForUrl(CountingTestCase):
+    def setUp(self):
+        super(TestWaitForUrl, self).setUp()
+        self.statuses = []
+        self.exceptions = []
+
+    def _wait(self, paths, **kwargs):
+        def exception_cb(msg, exception):
+            self.exceptions.append(exception)
+
+        return url_helper.wait_for_url([self.base_url + p for p in paths],
+                                       status_cb=self.statuses.append,
+                                       exception_cb=exception_cb,
+                                       **kwargs)
+
+    def test_race(self):
+        url = self._wait(['/slow', '/bad', '/ok'], max_wait=5, timeout=5,
+                         race=True)
+        self.assertEquals(self.base_url + '/ok', url)
+        # Without waiting for '/slow' (which is answered after the test)
+        self.assertFalse(self.server.release.is_set())
+        self.assertEquals(1, len(self.statuses))
+        self.assertIn('bad status code [500]', self.statuses[0])
+        self.assertEquals([500], [e.code for e in self.exceptions])
+
+    def test_race_gives_up(self):
+        url = self._wait(['/bad', '/empty'], max_wait=1, timeout=1,
+                         race=True)
+        self.assertEquals(False, url)
+        self.assertTrue(len(self.statuses) >= 2)
+        # Both were probed (in whichever order they were answered)
+        reasons = "\n".join(self.statuses)
+        self.assertIn('bad status code [500]', reasons)
+        self.assertIn('empty response [200]', reasons)
+
+    def test_race_probes(self):
+
+        def headers_cb(_url):
+            return {}
+
+        probe = self.mocker.replace(url_helper._probe_url,
+                                    passthrough=False)
+        probe(self.base_url + '/a', headers_cb, 1)
+        self.mocker.result(("broken", None))
+        probe(self.base_url + '/b', headers_cb, 1)
+        self.mocker.result((None, None))
+        self.mocker.replay()
+        self.assertEquals(self.base_url + '/b',
+                          self._wait(['/a', '/b'], max_wait=1, timeout=1,
+                                     headers_cb=headers_cb, race=True))
+        self.assertEquals(["Calling '%s/a' failed [0/1s]: broken"
+                           % (self.base_url)], self.statuses)
+
+    def test_sequential(self):
+        url = self._wait(['/bad', '/ok'], max_wait=5, timeout=5)
+        self.assertEquals(self.base_url + '/ok', url)
+        self.assertEquals(1, len(self.statuses))
+
+
+class TestRetryPolicy(MockerTestCase):
+    def test_delays(self):
+        policy = url_helper.RetryPolicy(max_attempts=5, base_delay=1,
+                                        max_delay=3, jitter=False)
+        tries = policy.start()
+        delays = []
+        while True:
+            tries.attempted()
+            delay = tries.next_delay()
+            if delay is None:
+                break
+            delays.append(delay)
+        self.assertEquals([1, 2, 3, 3], delays)
+
+    def test_jitter(self):
+        policy = url_helper.RetryPolicy(base_delay=1, max_delay=4)
+        tries = policy.start()
+        for _i in range(0, 10):
+            tries.attempted()
+            delay = tries.next_delay()
+            self.assertTrue(0 <= delay <= 4)
+        # Retry-After is a lower bound (within the max delay)
+        self.assertTrue(tries.next_delay(retry_after=3) >= 3)
+        self.assertEquals(4, tries.next_delay(retry_after=60))
+
+    def test_deadline(self):
+        policy = url_helper.RetryPolicy(deadline=0.5, base_delay=1,
+                                        jitter=False)
+        tries = policy.start()
+        tries.attempted()
+        self.assertEquals(None, tries.next_delay())
+        self.assertTrue(tries.timeout(10) <= 0.5)
+        self.assertTrue(tries.timeout(None) <= 0.5)
+        self.assertEquals(0.2, tries.timeout(0.2))
+
+    def test_from_config(self):
+        self.assertEquals(None, url_helper.retry_policy_from_config(None))
+        self.assertEquals(None, url_helper.retry_policy_from_config("x"))
+        self.assertEquals(None, url_helper.retry_policy_from_config(
+            {'max_attempts': 'many'}))
+        policy = url_helper.retry_policy_from_config({
+            'max_attempts': '3',
+            'deadline': 30,
+            'max_delay': 10,
+            'jitter': 'false',
+        })
+        self.assertEquals(3, policy.max_attempts)
+        self.assertEquals(30.0, policy.deadline)
+        self.assertEquals(1.0, policy.base_delay)
+        self.assertEquals(10.0, policy.max_delay)
+        self.assertFalse(policy.jitter)
+
+    def test_retry_after(self):
+        self.assertEquals(None, url_helper._retry_after(500, {
+            'Retry-After': '5'}))
+        self.assertEquals(5.0, url_helper._retry_after(503, {
+            'Retry-After': '5'}))
+        self.assertEquals(0.0, url_helper._retry_after(429, {
+            'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+        self.assertEquals(None, url_helper._retry_after(429, {
+            'Retry-After': 'soon'}))
+
+
+class TestReadurlRetries(CountingTestCase):
+    def setUp(self):
+        super(TestReadurlRetries, self).setUp()
+        self.url = self.base_url + "/flaky"
+
+    def test_retries(self):
+        policy = url_helper.RetryPolicy(max_attempts=3, base_delay=0.01)
+        self.server.failures = 2
+        self.assertEquals("/flaky", url_helper.readurl(
+            self.url, retry_policy=policy).contents)
+        self.server.failures = 2
+        self.assertEquals("/flaky", url_helper.readurl(
+            self.url, retry_policy=policy, check_status=False).contents)
+        self.server.failures = 3
+        self.assertRaises(url_helper.UrlError, url_helper.readurl,
+                          self.url, retry_policy=policy)
+        # Without a policy nothing is retried (by default)
+        self.server.failures = 1
+        self.assertRaises(url_helper.UrlError, url_helper.readurl, self.url)
+
+    def test_wait_for_url(self):
+        policy = url_helper.RetryPolicy(max_attempts=2, base_delay=0.01)
+        self.server.failures = 2
+        self.assertEquals(False, url_helper.wait_for_url(
+            [self.url], max_wait=30, timeout=5, retry_policy=policy))
+        self.server.failures = 1
+        self.assertEquals(self.url, url_helper.wait_for_url(
+            [self.url], max_wait=30, timeout=5, retry_policy=policy))
+
+
+class TestStreaming(CountingTestCase):
+
+    def test_gzip(self):
+        resp = url_helper.readurl(self.base_url + "/big/5000")
+        self.assertEquals('gzip', resp.headers.get('Content-Encoding'))
+        self.assertEquals('x' * 5000, resp.contents)
+        resp = url_helper.readurl(self.base_url + "/big/5000", stream=True)
+        self.assertEquals(5000, resp.size)
+        self.assertEquals('x' * 5000, resp.open().read())
+
+    def test_spools(self):
+        old_threshold = url_helper.SPOOL_THRESHOLD
+        url_helper.SPOOL_THRESHOLD = 1000
+        try:
+            resp = url_helper.readurl(self.base_url + "/big/5000",
+                                      stream=True)
+            self.assertTrue(resp.open()._rolled)
+            self.assertEquals('x' * 5000, resp.contents)
+            resp = url_helper.readurl(self.base_url + "/big/500",
+                                      stream=True)
+            self.assertFalse(resp.open()._rolled)
+            self.assertEquals('x' * 500, str(resp))
+        finally:
+            url_helper.SPOOL_THRESHOLD = old_threshold
+
+    def test_max_bytes(self):
+        resp = url_helper.readurl(self.base_url + "/big/5000",
+                                  max_bytes=5000)
+        self.assertEquals(5000, resp.size)
+        # Limits what it decodes to (not the compressed size)
+        self.assertRaises(url_helper.UrlError, url_helper.readurl,
+                          self.base_url + "/big/5000", max_bytes=4999)
+        # Which is also checked up front (when not compressed)
+        self.assertRaises(url_helper.UrlError, url_helper.readurl,
+                          self.base_url + "/big/5000", max_bytes=10,
+                          headers={'Accept-Encoding': 'identity'})
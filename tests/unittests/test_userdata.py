@@ -1,9 +1,13 @@
 """Tests for handling of userdata within cloud init."""
 
+import BaseHTTPServer
 import StringIO
 
+import base64
+import gzip
 import logging
 import os
+import time
 
 from email.mime.base import MIMEBase
 
@@ -12,6 +16,7 @@ from cloudinit import helpers as c_helpers
 from cloudinit import log
 from cloudinit import sources
 from cloudinit import stages
+from cloudinit import user_data as ud
 from cloudinit import util
 
 INSTANCE_ID = "i-testing"
@@ -205,3 +210,316 @@ p: 1
         ci.fetch()
         ci.consume_userdata()
         self.assertEqual("", log_file.getvalue())
+
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # /<seconds to wait>/<name>
+        (delay, name) = self.path.strip("/").split("/", 1)
+        with self.server.answering():
+            time.sleep(float(delay))
+        body = "#cloud-config\n%s: true\n" % (name)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):
+        pass
+
+
+class ValidatingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # /<name> (at the version the server has for it)
+        name = self.path.strip("/")
+        version = self.server.versions.get(name, 0)
+        etag = '"%s-%s"' % (name, version)
+        body = "#cloud-config\n%s: %s\n" % (name, version)
+        if name == 'plain':
+            etag = None
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            body = ''
+        else:
+            self.send_response(200)
+        self.server.codes.append((name, self.headers.get('If-None-Match'),
+                                  self.headers.get('User-Agent')))
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):
+        pass
+
+
+class TestIncludes(helpers.HTTPServerTestCase):
+
+    def setUp(self):
+        super(TestIncludes, self).setUp()
+        self.tmp = self.makeDir()
+        self.paths = c_helpers.Paths({'cloud_dir': self.tmp})
+
+    def _write(self, name, contents):
+        fn = os.path.join(self.tmp, name)
+        util.write_file(fn, contents)
+        return fn
+
+    def _included(self, blob, **limits):
+        proc = ud.UserDataProcessor(self.paths, include_limits=limits)
+        msg = proc.process(blob)
+        names = []
+        for part in msg.walk():
+            if part.get_content_maintype() == 'multipart':
+                continue
+            names.append(part.get_payload().split("\n")[1].split(":")[0])
+        return names
+
+    def test_order_and_nesting(self):
+        inner = self._write("inner", "#include\n%s\n%s\n" % (
+            self._write("c", "#cloud-config\nc: 1\n"),
+            self._write("d", "#cloud-config\nd: 1\n")))
+        blob = "#include\n%s\n%s\n%s\n" % (
+            self._write("a", "#cloud-config\na: 1\n"), inner,
+            self._write("b", "#cloud-config\nb: 1\n"))
+        self.assertEquals(['a', 'c', 'd', 'b'], self._included(blob))
+
+    def test_budget(self):
+        fns = [self._write(n, "#cloud-config\n%s: 1\n" % (n))
+               for n in ['a', 'b', 'c']]
+        blob = "#include\n%s\n" % ("\n".join(fns))
+        self.assertEquals(['a', 'b'], self._included(blob, max_count=2))
+        self.assertEquals(['a'], self._included(blob, max_bytes=20))
+        self.assertEquals([], self._included(blob, max_seconds=0))
+        # Runaway recursion stops
+        loop = os.path.join(self.tmp, "loop")
+        self._write("loop", "#include\n%s\n" % (loop))
+        self.assertEquals([], self._included("#include\n%s\n" % (loop),
+                                             max_count=10))
+
+    def test_encoded(self):
+        content = "#cloud-config\na: 1\n"
+        gzipped = StringIO.StringIO()
+        gh = gzip.GzipFile(fileobj=gzipped, mode='wb')
+        gh.write(content)
+        gh.close()
+        for (i, raw) in enumerate([content, base64.b64encode(content),
+                                   gzipped.getvalue(),
+                                   base64.b64encode(gzipped.getvalue())]):
+            fn = self._write("enc-%s" % (i), raw)
+            self.assertEquals(['a'], self._included("#include\n%s\n" % (fn)))
+
+    def test_concurrent(self):
+        server = self.startServer(SlowHandler)
+        blob = "#include\n%s\n" % ("\n".join([
+            "%s/0.5/a" % (server.url), "%s/0.1/b" % (server.url),
+            "%s/0.5/c" % (server.url), "%s/0.3/d" % (server.url)]))
+        self.assertEquals(['a', 'b', 'c', 'd'], self._included(blob))
+        # The includes were fetched at the same time (not one by one)
+        self.assertTrue(server.most_in_flight > 1)
+
+
+class TestIncludeCache(helpers.HTTPServerTestCase):
+    handler = ValidatingHandler
+
+    def setUp(self):
+        super(TestIncludeCache, self).setUp()
+        self.paths = c_helpers.Paths({'cloud_dir': self.makeDir()})
+        self.server.versions = {}
+        self.server.codes = []
+        self.url = self.server.url
+
+    def _process(self, names):
+        proc = ud.UserDataProcessor(self.paths)
+        self.server.codes = []
+        msg = proc.process("#include\n%s\n" % ("\n".join(
+            ["%s/%s" % (self.url, n) for n in names])))
+        payloads = [p.get_payload() for p in msg.walk()
+                    if p.get_content_maintype() != 'multipart']
+        return (payloads, proc.include_cache)
+
+    def test_revalidates(self):
+        (payloads, cache) = self._process(['a', 'b', 'plain'])
+        self.assertEquals(["#cloud-config\na: 0\n", "#cloud-config\nb: 0\n",
+                           "#cloud-config\nplain: 0\n"], payloads)
+        self.assertEquals({'hits': 0, 'misses': 3, 'evicted': 0},
+                          cache.stats)
+        self.assertEquals([None, None, None],
+                          [c[1] for c in sorted(self.server.codes)])
+        self.server.versions['b'] = 1
+        (payloads, cache) = self._process(['a', 'b', 'plain'])
+        self.assertEquals(["#cloud-config\na: 0\n", "#cloud-config\nb: 1\n",
+                           "#cloud-config\nplain: 0\n"], payloads)
+        # What can not be validated is not kept (or asked for conditionally)
+        self.assertEquals([('a', '"a-0"'), ('b', '"b-0"'), ('plain', None)],
+                          [c[0:2] for c in sorted(self.server.codes)])
+        self.assertEquals({'hits': 1, 'misses': 2, 'evicted': 0},
+                          cache.stats)
+        for (_name, _etag, agent) in self.server.codes:
+            self.assertTrue(agent.startswith('Cloud-Init/'))
+
+    def test_lost_content(self):
+        (_payloads, cache) = self._process(['a'])
+        os.unlink(cache._entry_fn("%s/a" % (self.url)))
+        (payloads, cache) = self._process(['a'])
+        self.assertEquals(["#cloud-config\na: 0\n"], payloads)
+        self.assertEquals([('a', '"a-0"'), ('a', None)],
+                          [c[0:2] for c in self.server.codes])
+
+    def test_evicts_least_recently_used(self):
+        cache_dir = self.makeDir()
+        cache = ud.IncludeCache(cache_dir, max_bytes=10)
+
+        def put(url, content, headers):
+            return cache.put(url, StringIO.StringIO(content), headers)
+
+        def get(url):
+            body = cache.get(url)
+            if body is None:
+                return None
+            try:
+                return body.read()
+            finally:
+                body.close()
+
+        self.assertTrue(put('a', 'aaaa', {'ETag': 'a'}))
+        self.assertTrue(put('b', 'bbbb', {'Last-Modified': 'x'}))
+        self.assertEquals('aaaa', get('a'))
+        self.assertTrue(put('c', 'cccc', {'ETag': 'c'}))
+        self.assertEquals(None, get('b'))
+        self.assertFalse(put('d', 'd' * 11, {'ETag': 'd'}))
+        self.assertEquals(1, cache.stats['evicted'])
+        self.assertTrue(cache.save())
+        cache = ud.IncludeCache(cache_dir, max_bytes=10)
+        self.assertEquals({'If-None-Match': 'c'}, cache.validators('c'))
+        self.assertEquals({}, cache.validators('b'))
+        self.assertEquals('aaaa', get('a'))
+        self.assertEquals('cccc', get('c'))
+        # Both entries and the index
+        self.assertEquals(3, len(os.listdir(cache_dir)))
+
+    def test_records_stats(self):
+        from cloudinit import timing
+
+        self._process(['a'])
+        events = []
+        with timing.timed('init'):
+            self._process(['a'])
+            events = [e for e in timing._PENDING
+                      if e['name'] == 'init/include-cache']
+        self.assertEquals({'hits': 1, 'misses': 0, 'evicted': 0},
+                          events[-1]['stats'])
+        self.assertIn('[evicted=0, hits=1, misses=0]',
+                      timing.show([events[-1]])[0])
+
+
+class TestParts(helpers.MockerTestCase):
+
+    def setUp(self):
+        super(TestParts, self).setUp()
+        self.tmp = self.makeDir()
+        self.paths = c_helpers.Paths({'cloud_dir': self.tmp})
+
+    def _blob(self):
+        from email.mime.multipart import MIMEMultipart
+
+        inc_fn = os.path.join(self.tmp, "inc")
+        util.write_file(inc_fn, "#cloud-config\nincluded: 1\n")
+        outer = MIMEMultipart()
+        script = MIMEBase("text", "x-shellscript")
+        script.set_payload("#!/bin/sh\necho hi")
+        script.add_header('Content-Disposition', 'attachment',
+                          filename='hi.sh')
+        outer.attach(script)
+        binary = MIMEBase("application", "octet-stream")
+        binary.set_payload("\x00\x1f\x8b\xff\r\n--%s\n" % ("=" * 15))
+        binary.add_header('Content-Transfer-Encoding', 'base64')
+        binary.set_payload(base64.b64encode(binary.get_payload()))
+        outer.attach(binary)
+        plain = MIMEBase("text", "plain")
+        plain.set_payload("#include\n%s\n" % (inc_fn))
+        outer.attach(plain)
+        archive = MIMEBase("text", "cloud-config-archive")
+        archive.set_payload("- {content: '#!/bin/sh\n\n  true',"
+                            " launch-index: 1}\n"
+                            "- {content: 'dont', type: text/x-mine,"
+                            " X-Mine: 'yes', filename: mine}\n")
+        outer.attach(archive)
+        return outer.as_string()
+
+    def _flat(self, parts):
+        return [(p.ctype, p.filename, p.payload, sorted(p.headers.items()))
+                for p in parts]
+
+    def test_same_as_process(self):
+        blob = self._blob()
+        proc = ud.UserDataProcessor(self.paths)
+        expected = self._flat(handlers.message_parts(proc.process(blob)))
+        self.assertEquals(5, len(expected))
+        self.assertEquals(expected, self._flat(proc.iter_parts(blob)))
+        self.assertEquals(['text/x-shellscript', 'application/octet-stream',
+                           'text/cloud-config', 'text/x-shellscript',
+                           'text/x-mine'], [p[0] for p in expected])
+
+    def test_lazy(self):
+        inc_fn = os.path.join(self.tmp, "inc")
+        util.write_file(inc_fn, "#cloud-config\nincluded: 1\n")
+        blob = "#include\n%s\n" % (inc_fn)
+        proc = ud.UserDataProcessor(self.paths)
+        parts = proc.iter_parts(blob)
+        util.del_file(inc_fn)
+        # Nothing is included until the parts are asked for
+        self.assertEquals([], list(parts))
+
+    def test_write_read(self):
+        proc = ud.UserDataProcessor(self.paths)
+        parts = list(proc.iter_parts(self._blob()))
+        out = StringIO.StringIO()
+        self.assertEquals(5, ud.write_parts(iter(parts), out))
+        written = out.getvalue()
+        # Text is kept readable, the rest is encoded
+        self.assertIn("#!/bin/sh\necho hi\n", written)
+        self.assertNotIn("\x00", written)
+        read = list(ud.read_parts(StringIO.StringIO(written)))
+        ignored = ['Content-Transfer-Encoding', 'MIME-Version']
+
+        def headers(p):
+            return sorted([(k, v) for (k, v) in p.headers.items()
+                           if k not in ignored])
+
+        self.assertEquals([(p.ctype, p.filename, p.payload, headers(p))
+                           for p in parts],
+                          [(p.ctype, p.filename, p.payload, headers(p))
+                           for p in read])
+        # And the email package agrees
+        import email
+        msg = email.message_from_string(written)
+        self.assertEquals([p.payload for p in parts],
+                          [p.payload for p in handlers.message_parts(msg)])
+        self.assertEquals([], list(ud.read_parts(StringIO.StringIO(
+            "Content-Type: multipart/mixed; boundary=\"b\"\n\n--b--\n"))))
+
+    def test_stored_and_consumed(self):
+        ds = FakeDataSource(self._blob())
+        ds.metadata['launch-index'] = 2
+        ci = stages.Init()
+        ci.datasource = ds
+        ci._paths = c_helpers.Paths({'cloud_dir': self.tmp}, ds)
+        ci._store_userdata()
+        self.assertEquals(None, ds.userdata)
+        ud_fn = ci.paths.get_ipath('userdata')
+        self.assertTrue(os.path.isfile(ud_fn))
+        self.assertEquals(0600, os.stat(ud_fn).st_mode & 0777)
+        expected = self._flat(ds.get_userdata_parts(True))
+        # The part for launch index 1 is filtered out
+        self.assertEquals(4, len(expected))
+        util.del_file(ci.paths.get_ipath('userdata_raw'))
+        ds.userdata_raw = None
+        self.assertEquals([(c, f, p) for (c, f, p, _h) in expected],
+                          [(c, f, p) for (c, f, p, _h) in
+                           self._flat(ci._userdata_parts())])
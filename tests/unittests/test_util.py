@@ -1,15 +1,26 @@
 # pylint: disable=C0301
 # the mountinfo data lines are too long
+import BaseHTTPServer
+import base64
+import gzip
+import json
 import os
+import socket
 import stat
+import threading
+import time
 import yaml
 
+from StringIO import StringIO
+
 from mocker import MockerTestCase
 from unittest import TestCase
 
 from cloudinit import importer
 from cloudinit import util
 
+from tests.unittests import helpers
+
 
 class FakeSelinux(object):
 
@@ -213,6 +224,167 @@ class TestGetCmdline(TestCase):
         self.assertEqual(os.environ['DEBUG_PROC_CMDLINE'], util.get_cmdline())
 
 
+class TestDecodeStream(TestCase):
+
+    def _gzip(self, blob):
+        buf = StringIO()
+        gh = gzip.GzipFile(fileobj=buf, mode='wb')
+        gh.write(blob)
+        gh.close()
+        return buf.getvalue()
+
+    def test_same_as_strings(self):
+        blob = "#!/bin/sh\n" + "".join([chr(i % 256) for i in range(0, 999)])
+        samples = ['', '==', 'abc', 'abcd', 'abc=', 'ab==\n', 'ab=\ncd',
+                   '#cloud-config\n', blob, self._gzip(blob),
+                   self._gzip(blob)[0:-4], base64.b64encode(blob),
+                   base64.b64encode(self._gzip(blob)),
+                   base64.encodestring(blob), base64.urlsafe_b64encode(blob)]
+        for raw in samples:
+            expected = util.decomp_gzip(util.decode_base64(raw))
+            self.assertEqual(expected, util.decode_stream(StringIO(raw)))
+            for chunk_size in [1, 3, 4, 7]:
+                decoded = StringIO()
+                try:
+                    util.decode_base64_stream(StringIO(raw), decoded,
+                                              chunk_size=chunk_size)
+                except util.DecodingError:
+                    decoded = StringIO(raw)
+                self.assertEqual(util.decode_base64(raw), decoded.getvalue())
+
+    def test_errors(self):
+        self.assertRaises(util.DecodingError, util.decode_base64_stream,
+                          StringIO("not base64!"), StringIO())
+        self.assertRaises(util.DecompressionError, util.decomp_gzip_stream,
+                          StringIO("not gzip"), StringIO())
+        out = StringIO()
+        self.assertEqual(4, util.decomp_gzip_stream(
+            StringIO(self._gzip("abcd")), out, chunk_size=1))
+        self.assertEqual("abcd", out.getvalue())
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        with self.server.answering():
+            if self.server.hold:
+                # Answered once the test is done
+                self.server.hold.wait(10)
+            time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *_args):
+        pass
+
+
+class TestSearchForMirror(helpers.HTTPServerTestCase):
+    def setUp(self):
+        super(TestSearchForMirror, self).setUp()
+        # Do not look for dns redirection (only local addresses are used)
+        self._redirect_ip = util._DNS_REDIRECT_IP
+        util._DNS_REDIRECT_IP = set()
+
+    def tearDown(self):
+        util._DNS_REDIRECT_IP = self._redirect_ip
+        super(TestSearchForMirror, self).tearDown()
+
+    def _server(self, delay=0, status=200, hold=None):
+        server = self.startServer(MirrorHandler)
+        server.delay = delay
+        server.status = status
+        server.hold = hold
+        return server
+
+    def _mirror(self, delay=0, status=200):
+        return self._server(delay, status).url + "/ubuntu/"
+
+    def _closed(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return "http://127.0.0.1:%s/ubuntu/" % (port)
+
+    def test_resolve(self):
+        # The first that resolves (in the order given) still wins
+        closed = self._closed()
+        self.assertEquals(closed, util.search_for_mirror(
+            ['http:///nohost', closed, '127.0.0.2']))
+        self.assertEquals('127.0.0.2', util.search_for_mirror(
+            ['http:///nohost', '127.0.0.2']))
+        self.assertEquals(None, util.search_for_mirror(['http:///nohost']))
+        self.assertEquals(None, util.search_for_mirror([]))
+
+    def test_connect(self):
+        closed = self._closed()
+        mirror = self._mirror()
+        self.assertEquals(mirror, util.search_for_mirror(
+            [closed, mirror], probe=util.MIRROR_PROBE_CONNECT))
+        self.assertEquals(None, util.search_for_mirror(
+            [closed], probe=util.MIRROR_PROBE_CONNECT))
+
+    def test_head_fastest(self):
+        slow = self._mirror(delay=0.5)
+        broken = self._mirror(status=404)
+        fast = self._mirror(delay=0.05)
+        self.assertEquals(fast, util.search_for_mirror(
+            [slow, broken, fast], probe=util.MIRROR_PROBE_HEAD))
+        self.assertEquals(None, util.search_for_mirror(
+            [broken], probe=util.MIRROR_PROBE_HEAD))
+
+    def test_deadline(self):
+        server = self._server(hold=threading.Event())
+        mirrors = ["%s/ubuntu-%s/" % (server.url, i) for i in range(0, 3)]
+        try:
+            # Abandoned at the deadline (none are answered before)
+            self.assertEquals(None, util.search_for_mirror(
+                mirrors, probe=util.MIRROR_PROBE_HEAD, deadline=0.5))
+        finally:
+            server.hold.set()
+        # All were probed at the same time
+        self.assertEquals(3, server.most_in_flight)
+
+    def test_cached(self):
+        cache_fn = os.path.join(self.makeDir(), 'mirror-search.json')
+        closed = self._closed()
+        mirror = self._mirror()
+        self.assertEquals(mirror, util.search_for_mirror(
+            [closed, mirror], probe='connect', cache_fn=cache_fn))
+        cache = json.loads(util.load_file(cache_fn))
+        self.assertEquals(1, len(cache))
+        self.assertEquals(mirror, cache.values()[0]['mirror'])
+        self.assertEquals(None, cache.values()[0]['latencies'][closed])
+        # Not probed again (the mirror has gone away since)
+        self.stopServer(self.servers[-1])
+        self.assertEquals(mirror, util.search_for_mirror(
+            [closed, mirror], probe='connect', cache_fn=cache_fn))
+        # Only for the same candidates and probe (and only when found)
+        self.assertEquals(None, util.search_for_mirror(
+            [closed], probe='connect', cache_fn=cache_fn))
+        self.assertEquals(1, len(json.loads(util.load_file(cache_fn))))
+
+    def test_miss_not_cached(self):
+        cache_fn = os.path.join(self.makeDir(), 'mirror-search.json')
+        server = self._server(status=404)
+        mirror = server.url + "/ubuntu/"
+        self.assertEquals(None, util.search_for_mirror(
+            [mirror], probe='head', cache_fn=cache_fn))
+        self.assertFalse(os.path.exists(cache_fn))
+        # Probed again (and found) by the next search
+        server.status = 200
+        self.assertEquals(mirror, util.search_for_mirror(
+            [mirror], probe='head', cache_fn=cache_fn))
+        self.assertEquals(1, len(json.loads(util.load_file(cache_fn))))
+
+    def test_not_cached_without_instance(self):
+        cache_fn = os.path.join(self.makeDir(), 'instance',
+                                'mirror-search.json')
+        self.assertEquals('127.0.0.2', util.search_for_mirror(
+            ['127.0.0.2'], cache_fn=cache_fn))
+        self.assertFalse(os.path.exists(os.path.dirname(cache_fn)))
+
+
 class TestLoadYaml(TestCase):
     mydefault = "7b03a8ebace993d806255121073fed52"
 
@@ -250,6 +422,74 @@ class TestLoadYaml(TestCase):
                          myobj)
 
 
+class TestYamlCache(MockerTestCase):
+    def setUp(self):
+        super(TestYamlCache, self).setUp()
+        self.parsed = []
+
+    def _loader(self, blob):
+        self.parsed.append(blob)
+        return yaml.safe_load(blob)
+
+    def test_parsed_once(self):
+        cache = util.YamlCache()
+        blob = "a: [1, 2]\nb: {c: d}\n"
+        first = cache.load(blob, self._loader)
+        first['a'].append(3)
+        first['b']['c'] = 'e'
+        # Each caller gets its own copy
+        self.assertEquals({'a': [1, 2], 'b': {'c': 'd'}},
+                          cache.load(blob, self._loader))
+        self.assertEquals([blob], self.parsed)
+        self.assertEquals({'hits': 1, 'misses': 1}, cache.stats)
+
+    def test_load_yaml(self):
+        blob = "yaml-cache-test: [1]\n"
+        stats = dict(util._YAML_CACHE.stats)
+        util.load_yaml(blob)['yaml-cache-test'].append(2)
+        self.assertEquals({'yaml-cache-test': [1]}, util.load_yaml(blob))
+        self.assertEquals(stats['hits'] + 1, util._YAML_CACHE.stats['hits'])
+        self.assertEquals(stats['misses'] + 1,
+                          util._YAML_CACHE.stats['misses'])
+
+    def test_failures_not_kept(self):
+        cache = util.YamlCache()
+        for _i in range(0, 2):
+            self.assertRaises(yaml.YAMLError, cache.load, "1\n 2:",
+                              self._loader)
+        self.assertEquals(2, len(self.parsed))
+
+    def test_evicts_least_recently_used(self):
+        cache = util.YamlCache(max_entries=2, max_bytes=10)
+        for blob in ['a: 1', 'b: 1', 'a: 1', 'c: 1', 'a: 1', 'b: 1']:
+            cache.load(blob, self._loader)
+        self.assertEquals(['a: 1', 'b: 1', 'c: 1', 'b: 1'], self.parsed)
+        # Too big to be kept
+        cache.load('d: 1234567890', self._loader)
+        cache.load('d: 1234567890', self._loader)
+        self.assertEquals(2, self.parsed.count('d: 1234567890'))
+
+    def test_between_processes(self):
+        fn = os.path.join(self.makeDir(), 'data', 'yaml-cache.pkl')
+        cache = util.YamlCache()
+        cache.set_file(fn)
+        self.assertFalse(cache.save())
+        cache.load("a: 1", self._loader)
+        self.assertTrue(cache.save())
+        self.assertFalse(cache.save())
+        self.assertEquals(0600, os.stat(fn).st_mode & 0777)
+        cache = util.YamlCache()
+        cache.set_file(fn)
+        self.assertEquals({'a': 1}, cache.load("a: 1", self._loader))
+        self.assertEquals(["a: 1"], self.parsed)
+        # Broken (or old) files are ignored
+        util.write_file(fn, "broken")
+        cache = util.YamlCache()
+        cache.set_file(fn)
+        self.assertEquals({'a': 1}, cache.load("a: 1", self._loader))
+        self.assertEquals(["a: 1", "a: 1"], self.parsed)
+
+
 class TestMountinfoParsing(TestCase):
     precise_ext4_mountinfo = \
 """15 20 0:14 / /sys rw,nosuid,nodev,noexec,relatime - sysfs sysfs rw
@@ -0,0 +1,120 @@
+import threading
+
+from unittest import TestCase
+
+from cloudinit import workers
+
+
+class TestPool(TestCase):
+
+    def test_results(self):
+        with workers.Pool(3) as pool:
+            tasks = [pool.submit(lambda x: x * 2, i) for i in range(0, 10)]
+            self.assertEquals([t.result() for t in tasks],
+                              [i * 2 for i in range(0, 10)])
+
+    def test_exception_reraised(self):
+
+        def boom():
+            raise ValueError("boom")
+
+        with workers.Pool(1) as pool:
+            task = pool.submit(boom)
+            self.assertRaises(ValueError, task.result)
+            self.assertTrue(isinstance(task.exception(), ValueError))
+
+    def test_bounded(self):
+        pool = workers.Pool(2)
+        release = threading.Event()
+        for _i in range(0, 5):
+            pool.submit(release.wait)
+        self.assertEquals(len(pool._threads), 2)
+        release.set()
+        pool.shutdown()
+
+    def test_cancel_pending(self):
+        release = threading.Event()
+        pool = workers.Pool(1)
+        first = pool.submit(release.wait)
+        second = pool.submit(lambda: 1)
+        self.assertTrue(second.cancel())
+        self.assertRaises(workers.CancelledError, second.result)
+        release.set()
+        first.result()
+        pool.shutdown()
+        self.assertFalse(first.cancel())
+
+
+class TestRunOrdered(TestCase):
+
+    def test_first_accepted_in_order(self):
+        release = threading.Event()
+
+        def slow():
+            release.wait()
+            return 'slow'
+
+        def fast():
+            release.set()
+            return 'fast'
+
+        functors = [
+            (lambda: None, ()),
+            (slow, ()),
+            (fast, ()),
+        ]
+        self.assertEquals(workers.run_ordered(functors, 3), (1, 'slow'))
+
+    def test_nothing_accepted(self):
+        functors = [(lambda: 0, ()), (lambda: '', ())]
+        self.assertEquals(workers.run_ordered(functors, 2), (None, None))
+
+
+class TestRunDependent(TestCase):
+
+    def test_dependencies_ordered(self):
+        order = []
+        lock = threading.Lock()
+
+        def record(i):
+            with lock:
+                order.append(i)
+            return i
+
+        functors = [(record, (i,)) for i in range(0, 6)]
+        depends_on = [[], [0], [], [1, 2], [], [3]]
+        tasks = workers.run_dependent(functors, depends_on, 3)
+        self.assertEquals([t.result() for t in tasks], range(0, 6))
+        for (i, deps) in enumerate(depends_on):
+            for j in deps:
+                self.assertTrue(order.index(j) < order.index(i))
+
+    def test_independent_run_together(self):
+        first_running = threading.Event()
+        second_running = threading.Event()
+
+        def first():
+            first_running.set()
+            return second_running.wait(5)
+
+        def second():
+            second_running.set()
+            return first_running.wait(5)
+
+        tasks = workers.run_dependent([(first, ()), (second, ())],
+                                      [[], []], 2)
+        self.assertEquals([t.result() for t in tasks], [True, True])
+
+    def test_failures_do_not_block(self):
+
+        def boom():
+            raise ValueError("boom")
+
+        tasks = workers.run_dependent([(boom, ()), (lambda: 2, ())],
+                                      [[], [0]], 2)
+        self.assertRaises(ValueError, tasks[0].result)
+        self.assertEquals(tasks[1].result(), 2)
+
+    def test_only_earlier_dependencies(self):
+        self.assertRaises(ValueError, workers.run_dependent,
+                          [(lambda: 1, ()), (lambda: 2, ())], [[1], []], 2)
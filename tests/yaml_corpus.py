@@ -0,0 +1,39 @@
+"""Large configs (of random content) that the safeyaml tests and
+tools/bench-yaml load and dump."""
+
+import base64
+import yaml
+
+
+def random_b64(rand, size):
+    return base64.b64encode("".join([chr(rand.randint(0, 255))
+                                     for _i in range(0, size)]))
+
+
+def write_files_config(rand, size=1024 * 1024):
+    # write_files with a file of size bytes embedded as base64
+    content = random_b64(rand, size)
+    return yaml.dump({
+        'write_files': [{
+            'path': '/opt/blob.bin',
+            'encoding': 'b64',
+            'owner': 'root:root',
+            'permissions': '0644',
+            'content': "\n".join([content[i:i + 76] for i in
+                                  range(0, len(content), 76)]),
+        }],
+    }, default_flow_style=False)
+
+
+def ca_certs_config(rand, count=150, style=None):
+    # A ca-certs bundle of count certificates
+    certs = []
+    for _i in range(0, count):
+        body = random_b64(rand, 1200)
+        certs.append("-----BEGIN CERTIFICATE-----\n%s\n"
+                     "-----END CERTIFICATE-----\n"
+                     % ("\n".join([body[i:i + 64] for i in
+                                   range(0, len(body), 64)])))
+    return yaml.dump({'ca-certs': {'remove-defaults': True,
+                                   'trusted': certs}},
+                     default_flow_style=False, default_style=style)
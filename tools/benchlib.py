@@ -0,0 +1,13 @@
+"""What the bench-* tools share."""
+
+import time
+
+
+def best_of(repeat, functor, *args):
+    # How long the quickest of repeat calls of functor(*args) took
+    times = []
+    for _i in range(0, repeat):
+        start = time.time()
+        functor(*args)
+        times.append(time.time() - start)
+    return min(times)
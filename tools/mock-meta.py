@@ -15,21 +15,43 @@ Then:
   wget -q http://169.254.169.254/latest/meta-data/instance-id -O -; echo
   curl --silent http://169.254.169.254/latest/meta-data/instance-id ; echo
   ec2metadata --instance-id
+
+To load test against it, faults can be injected into the paths matching a
+(fnmatch) pattern and a large synthetic tree (under meta-data/synthetic/)
+can be served, for example:
+
+  ./mock-meta.py -q -p 8080 \\
+      --latency '/latest/meta-data/*=0.05:0.02' \\
+      --error '/latest/meta-data/*=503:0.05' --error '*=drop:0.01' \\
+      --burst '*=503:10' --rate-limit 100:20 --synthetic-keys 5000
+
+Latency is seconds (plus up to the given jitter) before the first byte, an
+error is a http code (or drop, which closes the connection) served with the
+given probability, a burst fails the first requests and the rate limit
+(requests per second, with a burst size) is enforced by answering 429.
+How many requests were served (by path and code) and how long they took is
+logged when the server exits (and every --stats-interval seconds), and is
+also served as json by /_stats (/_stats/reset starts counting again).
 """
 
+import fnmatch
 import functools
 import httplib
 import json
 import logging
 import os
 import random
+import signal
 import string  # pylint: disable=W0402
 import sys
+import threading
+import time
 import yaml
 
 from optparse import OptionParser
 
 from BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+from SocketServer import ThreadingMixIn
 
 log = logging.getLogger('meta-server')
 
@@ -117,6 +139,18 @@ PLACEMENT_CAPABILITIES = {
 
 NOT_IMPL_RESPONSE = json.dumps({})
 
+# Served (without any faults) with what the server has served so far
+STATS_PATH = '/_stats'
+
+# A injected error that closes the connection (without any response)
+DROP = 'drop'
+
+# What throttled requests are answered with (httplib has no name for it)
+TOO_MANY_REQUESTS = 429
+
+# Each group of the synthetic tree has (at most) this many keys
+SYNTHETIC_FANOUT = 50
+
 
 class WebException(Exception):
     def __init__(self, code, msg):
@@ -183,21 +217,194 @@ def get_ssh_keys():
     return keys
 
 
+def _split_spec(spec):
+    # PATTERN=VALUE (or just VALUE, which applies to every path)
+    if '=' in spec:
+        (pattern, value) = spec.rsplit('=', 1)
+    else:
+        (pattern, value) = ('*', spec)
+    return (pattern.strip() or '*', value.split(':'))
+
+
+def parse_latency(spec):
+    (pattern, values) = _split_spec(spec)
+    jitter = 0.0
+    if len(values) > 1:
+        jitter = float(values[1])
+    return (pattern, float(values[0]), jitter)
+
+
+def parse_error(spec):
+    (pattern, values) = _split_spec(spec)
+    code = values[0].strip().lower()
+    if code != DROP:
+        code = int(code)
+    probability = 1.0
+    if len(values) > 1:
+        probability = float(values[1])
+    return (pattern, code, probability)
+
+
+def parse_burst(spec):
+    (pattern, values) = _split_spec(spec)
+    code = values[0].strip().lower()
+    if code != DROP:
+        code = int(code)
+    return [pattern, code, int(values[1])]
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if not burst:
+            burst = max(1, int(rate))
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def take(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FaultInjector(object):
+
+    def __init__(self, latencies=None, errors=None, bursts=None,
+                 limiter=None, seed=None):
+        self.latencies = latencies or []
+        self.errors = errors or []
+        self.bursts = bursts or []
+        self.limiter = limiter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay_for(self, path):
+        # The first matching latency wins
+        for (pattern, secs, jitter) in self.latencies:
+            if fnmatch.fnmatch(path, pattern):
+                with self.lock:
+                    return secs + self.random.uniform(0, jitter)
+        return 0
+
+    def error_for(self, path):
+        with self.lock:
+            for burst in self.bursts:
+                if burst[2] > 0 and fnmatch.fnmatch(path, burst[0]):
+                    burst[2] -= 1
+                    return burst[1]
+            if self.limiter and not self.limiter.take():
+                return TOO_MANY_REQUESTS
+            for (pattern, code, probability) in self.errors:
+                if (fnmatch.fnmatch(path, pattern) and
+                    self.random.random() < probability):
+                    return code
+        return None
+
+
+class RequestStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.requests = 0
+            self.seconds = 0.0
+            self.slowest = 0.0
+            self.by_code = {}
+            self.by_path = {}
+
+    def record(self, path, code, secs):
+        code = str(code)
+        with self.lock:
+            self.requests += 1
+            self.seconds += secs
+            self.slowest = max(self.slowest, secs)
+            self.by_code[code] = self.by_code.get(code, 0) + 1
+            self.by_path[path] = self.by_path.get(path, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'elapsed': time.time() - self.started,
+                'seconds': self.seconds,
+                'slowest': self.slowest,
+                'by_code': dict(self.by_code),
+                'by_path': dict(self.by_path),
+            }
+
+    def summary(self):
+        snap = self.snapshot()
+        avg = 0.0
+        if snap['requests']:
+            avg = snap['seconds'] / snap['requests']
+        lines = [
+            ("Served %s requests in %.3fs (%.4fs on average, %.4fs at"
+             " most)") % (snap['requests'], snap['elapsed'], avg,
+                          snap['slowest']),
+        ]
+        for (code, count) in sorted(snap['by_code'].items()):
+            lines.append("  %6s %s" % (count, code))
+        busiest = sorted(snap['by_path'].items(), key=lambda p: p[1],
+                         reverse=True)
+        for (path, count) in busiest[0:10]:
+            lines.append("  %6s %s" % (count, path))
+        return "\n".join(lines)
+
+
 class MetaDataHandler(object):
 
     def __init__(self, opts):
         self.opts = opts
         self.instances = {}
 
+    def _get_synthetic(self, params):
+        # synthetic/group-N/key-M = value-M
+        keys = self.opts.get('synthetic_keys', 0)
+        fanout = self.opts.get('synthetic_fanout') or SYNTHETIC_FANOUT
+        groups = (keys + fanout - 1) // fanout
+        if not params:
+            return "\n".join(["group-%s/" % (i) for i in range(0, groups)])
+        try:
+            group = int(params[0][len('group-'):])
+            if not params[0].startswith('group-') or group >= groups:
+                raise ValueError()
+            start = group * fanout
+            end = min(keys, start + fanout)
+            if len(params) == 1:
+                return "\n".join(["key-%s" % (i)
+                                  for i in range(start, end)])
+            key = int(params[1][len('key-'):])
+            if start <= key < end and len(params) == 2:
+                return "value-%s" % (key)
+        except ValueError:
+            pass
+        raise WebException(httplib.NOT_FOUND,
+                           "Unknown synthetic key %r" % "/".join(params))
+
     def get_data(self, params, who, **kwargs):
         if not params:
             # Show the root level capabilities when
             # no params are passed...
-            caps = sorted(META_CAPABILITIES)
-            return "\n".join(caps)
+            caps = list(META_CAPABILITIES)
+            if self.opts.get('synthetic_keys'):
+                caps.append('synthetic/')
+            return "\n".join(sorted(caps))
         action = params[0]
         action = action.lower()
-        if action == 'instance-id':
+        if action == 'synthetic' and self.opts.get('synthetic_keys'):
+            return self._get_synthetic(params[1:])
+        elif action == 'instance-id':
             return 'i-%s' % (id_generator(lower=True))
         elif action == 'ami-launch-index':
             return "%s" % random.choice([0, 1, 2, 3])
@@ -286,6 +493,33 @@ class MetaDataHandler(object):
             return NOT_IMPL_RESPONSE
 
 
+class IdentityHandler(object):
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def get_data(self, params, who, **kwargs):  # pylint: disable=W0613
+        if not params or params[0] != 'instance-identity':
+            return "instance-identity/"
+        nparams = params[1:]
+        if not nparams:
+            return "\n".join(['document', 'pkcs7', 'signature'])
+        what = nparams[0].lower()
+        if what == 'document':
+            return json.dumps({
+                'instanceId': 'i-%s' % (id_generator(lower=True)),
+                'imageId': 'ami-%s' % (id_generator(lower=True)),
+                'instanceType': random.choice(INSTANCE_TYPES),
+                'availabilityZone': random.choice(AVAILABILITY_ZONES),
+                'privateIp': kwargs.get('client_ip', '10.0.0.1'),
+                'version': '2010-08-31',
+            }, indent=2)
+        elif what in ['pkcs7', 'signature']:
+            return "\n".join([id_generator(size=64) for _i in range(0, 4)])
+        raise WebException(httplib.NOT_FOUND,
+                           "Unknown identity data %r" % what)
+
+
 class UserDataHandler(object):
 
     def __init__(self, opts):
@@ -317,9 +551,16 @@ class UserDataHandler(object):
 # Puke!
 meta_fetcher = None
 user_fetcher = None
+identity_fetcher = None
+faults = FaultInjector()
+stats = RequestStats()
 
 
 class Ec2Handler(BaseHTTPRequestHandler):
+    # Like the real metadata service, connections are kept alive (and
+    # the headers and body, written separately, are not held back)
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
 
     def _get_versions(self):
         versions = ['latest'] + EC2_VERSIONS
@@ -328,16 +569,17 @@ class Ec2Handler(BaseHTTPRequestHandler):
 
     def log_message(self, fmt, *args):
         msg = "%s - %s" % (self.address_string(), fmt % (args))
-        log.info(msg)
+        log.debug(msg)
 
     def _find_method(self, path):
         # Puke! (globals)
         func_mapping = {
             'user-data': user_fetcher.get_data,
             'meta-data': meta_fetcher.get_data,
+            'dynamic': identity_fetcher.get_data,
         }
         segments = [piece for piece in path.split('/') if len(piece)]
-        log.info("Received segments %s", segments)
+        log.debug("Received segments %s", segments)
         if not segments:
             return self._get_versions
         date = segments[0].strip().lower()
@@ -363,28 +605,71 @@ class Ec2Handler(BaseHTTPRequestHandler):
         }
         return functools.partial(base_func, **kwargs)
 
+    def _send_data(self, code, data, headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "binary/octet-stream")
+        self.send_header("Content-Length", len(data))
+        for (k, v) in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _do_stats(self):
+        if self.path.rstrip('/') == STATS_PATH + '/reset':
+            stats.reset()
+        self._send_data(httplib.OK, json.dumps(stats.snapshot(), indent=2,
+                                               sort_keys=True))
+
+    def _do_fault(self, code):
+        if code == DROP:
+            log.debug("Dropping the connection of %s", self.path)
+            self.close_connection = 1
+            return
+        headers = {}
+        if code in (TOO_MANY_REQUESTS, httplib.SERVICE_UNAVAILABLE):
+            headers['Retry-After'] = '1'
+        self._send_data(code, httplib.responses.get(code, 'Too Many Requests'),
+                        headers)
+
     def _do_response(self):
         who = self.client_address
-        log.info("Got a call from %s for path %s", who, self.path)
+        log.debug("Got a call from %s for path %s", who, self.path)
+        if self.path.startswith(STATS_PATH):
+            self._do_stats()
+            return
+        start = time.time()
+        path = "/" + "/".join([p for p in self.path.split('/') if p])
+        if self.path.endswith('/') and path != '/':
+            path += '/'
+        code = httplib.OK
         try:
+            delay = faults.delay_for(path)
+            if delay > 0:
+                time.sleep(delay)
+            error = faults.error_for(path)
+            if error is not None:
+                code = error
+                self._do_fault(error)
+                return
             func = self._find_method(self.path)
             data = func()
             if not data:
                 data = ''
-            self.send_response(httplib.OK)
-            self.send_header("Content-Type", "binary/octet-stream")
-            self.send_header("Content-Length", len(data))
-            log.info("Sending data (len=%s):\n%s", len(data),
-                     format_text(data))
-            self.end_headers()
-            self.wfile.write(data)
+            log.debug("Sending data (len=%s):\n%s", len(data),
+                      format_text(data))
+            self._send_data(httplib.OK, data)
         except RuntimeError as e:
             log.exception("Error somewhere in the server.")
-            self.send_error(httplib.INTERNAL_SERVER_ERROR, message=str(e))
+            code = httplib.INTERNAL_SERVER_ERROR
+            self.send_error(code, message=str(e))
         except WebException as e:
             code = e.code
-            log.exception(str(e))
+            log.debug(str(e))
             self.send_error(code, message=str(e))
+        finally:
+            secs = time.time() - start
+            stats.record(path, code, secs)
+            log.debug("Served %s with %s in %.4fs", path, code, secs)
 
     def do_GET(self):
         self._do_response()
@@ -412,12 +697,49 @@ def extract_opts():
     parser.add_option("-f", '--user-data-file', dest='user_data_file',
         action='store', metavar='FILE',
         help="user data filename to serve back to incoming requests")
+    parser.add_option("-q", "--quiet", dest="quiet", action="store_true",
+        default=False,
+        help="only log the request stats (not every request)")
+    parser.add_option("--latency", dest="latencies", action="append",
+        default=[], metavar="[PATTERN=]SECS[:JITTER]",
+        help="wait before answering the matching paths")
+    parser.add_option("--error", dest="errors", action="append",
+        default=[], metavar="[PATTERN=]CODE|drop[:PROBABILITY]",
+        help="fail (some of) the requests for the matching paths")
+    parser.add_option("--burst", dest="bursts", action="append",
+        default=[], metavar="[PATTERN=]CODE|drop:COUNT",
+        help="fail the first COUNT requests for the matching paths")
+    parser.add_option("--rate-limit", dest="rate_limit", action="store",
+        metavar="RATE[:BURST]",
+        help="answer 429 to requests past RATE per second")
+    parser.add_option("--synthetic-keys", dest="synthetic_keys",
+        action="store", type=int, default=0, metavar="COUNT",
+        help="serve a tree of COUNT keys under meta-data/synthetic/")
+    parser.add_option("--seed", dest="seed", action="store", type=int,
+        help="seed for which requests get injected errors")
+    parser.add_option("--stats-interval", dest="stats_interval",
+        action="store", type=float, default=0, metavar="SECS",
+        help="also log the request stats every SECS seconds")
     (options, args) = parser.parse_args()
     out = dict()
     out['extra'] = args
     out['port'] = options.port
     out['user_data_file'] = None
     out['address'] = options.address
+    out['quiet'] = options.quiet
+    out['synthetic_keys'] = max(0, options.synthetic_keys)
+    out['seed'] = options.seed
+    out['stats_interval'] = options.stats_interval
+    try:
+        out['latencies'] = [parse_latency(s) for s in options.latencies]
+        out['errors'] = [parse_error(s) for s in options.errors]
+        out['bursts'] = [parse_burst(s) for s in options.bursts]
+        out['rate_limit'] = None
+        if options.rate_limit:
+            out['rate_limit'] = [float(v) for v in
+                                 options.rate_limit.split(":", 1)]
+    except (ValueError, IndexError) as e:
+        parser.error("Invalid fault specification: %s" % (e))
     if options.user_data_file:
         if not os.path.isfile(options.user_data_file):
             parser.error("Option -f specified a non-existent file")
@@ -429,22 +751,65 @@ def extract_opts():
 def setup_fetchers(opts):
     global meta_fetcher  # pylint: disable=W0603
     global user_fetcher  # pylint: disable=W0603
+    global identity_fetcher  # pylint: disable=W0603
     meta_fetcher = MetaDataHandler(opts)
     user_fetcher = UserDataHandler(opts)
+    identity_fetcher = IdentityHandler(opts)
+
+
+def setup_faults(opts):
+    global faults  # pylint: disable=W0603
+    limiter = None
+    if opts.get('rate_limit'):
+        limiter = TokenBucket(*opts['rate_limit'])
+    faults = FaultInjector(latencies=opts.get('latencies'),
+                           errors=opts.get('errors'),
+                           bursts=opts.get('bursts'),
+                           limiter=limiter, seed=opts.get('seed'))
+
+
+def _log_stats_every(secs):
+    while True:
+        time.sleep(secs)
+        log.info(stats.summary())
+
+
+def _exit_on_term(_signum, _frame):
+    raise SystemExit(0)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Like the real metadata service, requests are served concurrently
+    daemon_threads = True
 
 
 def run_server():
     # Using global here since it doesn't seem like we
     # can pass opts into a request handler constructor...
     opts = extract_opts()
-    setup_logging(logging.DEBUG)
+    if opts['quiet']:
+        setup_logging(logging.INFO)
+    else:
+        setup_logging(logging.DEBUG)
     setup_fetchers(opts)
+    setup_faults(opts)
     log.info("CLI opts: %s", opts)
     server_address = (opts['address'], opts['port'])
-    server = HTTPServer(server_address, Ec2Handler)
+    server = ThreadingHTTPServer(server_address, Ec2Handler)
     sa = server.socket.getsockname()
     log.info("Serving ec2 metadata on %s using port %s ...", sa[0], sa[1])
-    server.serve_forever()
+    if opts['stats_interval'] > 0:
+        t = threading.Thread(target=_log_stats_every,
+                             args=(opts['stats_interval'],))
+        t.daemon = True
+        t.start()
+    signal.signal(signal.SIGTERM, _exit_on_term)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info(stats.summary())
 
 
 if __name__ == '__main__':